@@ -0,0 +1,490 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import traceback
+from time import time
+from typing import Optional
+
+import numpy as np
+import SimpleITK as sitk
+
+from miua2024b.source.pool import IsolatingPool
+
+# version of the build state, and of each stage, a new stage version rebuilds all outputs of the stage
+_state_version = 1
+_stage_versions = dict(orient=1, predict=1, label=1, register=1, resample=1)
+_file_ending = '.nii.gz'
+
+
+def _atomic_json(obj, path: str):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _abspath(base: str, path: Optional[str]) -> Optional[str]:
+    return os.path.normpath(os.path.join(base, path)) if path else None
+
+
+def read_subjects(path: str) -> list:
+    """
+    reads the subjects of a .json manifest, a list (or an object with the entry 'subjects') of subjects with the entries:
+    * 'name': name of the subject, e.g., IXI002-Guys-0828
+    * 'tof': the TOF MRA scan
+    * 'label': (optional) the label of the TOF MRA, predicted with --predict if missing
+    * 'segmentation': (optional) vessel segmentation of the TOF MRA to register the sMRI to, defaults to the label
+    * 'sequences': object of the sMRI by sequence, e.g., "PD", each with the entry 'image' and either 'transform', e.g.,
+      the prepared forward.hdf, or 'segmentation', the vessel segmentation of the sMRI to register it with MIUA2024b
+    relative paths are resolved against the folder of the manifest
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        entries = json.load(f)
+    if isinstance(entries, dict):
+        entries = entries['subjects']
+
+    subjects = list()
+    for entry in entries:
+        missing = list(k for k in ('name', 'tof') if not entry.get(k))
+        if missing:
+            raise RuntimeError("Subject {} is missing: {}".format(len(subjects), ", ".join(missing)))
+        sequences = dict()
+        for seq, s in entry.get('sequences', dict()).items():
+            if not s.get('image') or not (s.get('transform') or s.get('segmentation')):
+                raise RuntimeError("Sequence {} of {} requires an image and a transform or segmentation".format(
+                    seq, entry['name']))
+            sequences[seq] = dict((k, _abspath(base, s.get(k))) for k in ('image', 'transform', 'segmentation'))
+        subjects.append(dict(name=entry['name'], tof=_abspath(base, entry['tof']),
+                             label=_abspath(base, entry.get('label')),
+                             segmentation=_abspath(base, entry.get('segmentation')), sequences=sequences))
+    return subjects
+
+
+def make_graph(subjects: list, output_dir: str, work_dir: str, predict: Optional[str]=None,
+               register_params: Optional[dict]=None, register_options: Optional[dict]=None,
+               interpolator: str='linear', orientation: str='RAI') -> list:
+    """
+    returns the build graph of the nnU-Net dataset, the nodes of each subject are:
+    * 'orient:<name>-MRA': the TOF MRA reoriented to imagesTr/<name>-MRA_0000.nii.gz
+    * 'predict:<name>-MRA': (without label) the label predicted from the reoriented TOF MRA, see run_predict
+    * 'label:<name>-MRA': the label reoriented to labelsTr/<name>-MRA.nii.gz and duplicated for each sequence
+    * 'register:<name>-<seq>': (without transform) the transform of the sMRI registered with MIUA2024b
+    * 'resample:<name>-<seq>': the sMRI resampled to the TOF MRA and reoriented to imagesTr/<name>-<seq>_0000.nii.gz
+    a node depends on the nodes which produce its inputs, see build
+    :param subjects: subjects, see read_subjects
+    :param output_dir: the dataset folder, e.g., Dataset505_ArterySMRI
+    :param work_dir: folder for intermediate results, i.e., predicted labels and transforms
+    :param predict: command to predict the label of a TOF MRA, see run_predict
+    :param register_params: parameters of miua2024b.source.main.run
+    :param register_options: parameters of miua2024b.source.main.run which do not change the result, e.g., cache_dir,
+    unlike the parameters they are not part of the fingerprint, see fingerprint
+    :param interpolator: interpolator to resample the sMRI with, 'linear' or 'bspline'
+    :param orientation: the orientation of all images, see SimpleITK.DICOMOrient
+    :return: list of nodes with the entries 'id', 'stage', 'inputs', 'outputs', 'params' and 'options'
+    """
+    images_dir, labels_dir = os.path.join(output_dir, 'imagesTr'), os.path.join(output_dir, 'labelsTr')
+    nodes = list()
+
+    def _node(stage, case, inputs, outputs, options=None, **params):
+        nodes.append(dict(id='{}:{}'.format(stage, case), stage=stage, inputs=inputs, outputs=outputs, params=params,
+                          options=options or dict()))
+        return outputs[0]
+
+    for s in subjects:
+        name, subject_dir = s['name'], os.path.join(work_dir, s['name'])
+        case = name + '-MRA'
+        tof = _node('orient', case, dict(image=s['tof']), [os.path.join(images_dir, case + '_0000' + _file_ending)],
+                    orientation=orientation)
+        label = s['label']
+        if label is None:
+            if not predict:
+                raise RuntimeError("Subject {} has no label and no command to predict it".format(name))
+            label = _node('predict', case, dict(image=tof), [os.path.join(subject_dir, case + _file_ending)],
+                          command=predict)
+        label = _node('label', case, dict(label=label),
+                      list(os.path.join(labels_dir, c + _file_ending)
+                           for c in [case] + list('{}-{}'.format(name, seq) for seq in s['sequences'])),
+                      orientation=orientation)
+
+        for seq, sequence in s['sequences'].items():
+            case = '{}-{}'.format(name, seq)
+            transform = sequence['transform']
+            if transform is None:
+                transform = _node('register', case, dict(fixed=s['segmentation'] or label,
+                                                         moving=sequence['segmentation']),
+                                  [os.path.join(subject_dir, case + '.forward.hdf')], options=register_options,
+                                  **(register_params or dict()))
+            _node('resample', case, dict(image=sequence['image'], reference=tof, transform=transform),
+                  [os.path.join(images_dir, case + '_0000' + _file_ending)],
+                  interpolator=interpolator, orientation=orientation)
+
+    producers = dict()
+    for node in nodes:
+        for path in node['outputs']:
+            if path in producers:
+                raise RuntimeError("{} is written by {} and {}".format(path, producers[path], node['id']))
+            producers[path] = node['id']
+    for node in nodes:
+        node['deps'] = sorted(set(producers[p] for p in node['inputs'].values() if p in producers))
+    return nodes
+
+
+def _write_image(img: sitk.Image, path: str, work_dir: str):
+    # written next to the intermediate results and moved, so that the dataset never holds partially written images
+    tmp = os.path.join(work_dir, 'tmp', '{}-{}'.format(os.getpid(), os.path.basename(path)))
+    os.makedirs(os.path.dirname(tmp), exist_ok=True)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sitk.WriteImage(img, tmp, True)
+    shutil.move(tmp, path)
+
+
+def run_orient(inputs: dict, outputs: list, work_dir: str, orientation: str='RAI') -> dict:
+    """
+    reorients an image, which only permutes and flips the voxel axes, the physical space is unchanged
+    """
+    _write_image(sitk.DICOMOrient(sitk.ReadImage(inputs['image']), orientation), outputs[0], work_dir)
+    return dict()
+
+
+def run_predict(inputs: dict, outputs: list, work_dir: str, command: str='') -> dict:
+    """
+    predicts the label of an image with a command, e.g., of nnU-Net with model M_A:
+    nnUNetv2_predict_from_modelfolder -m <path-to/models> -i {input} -o {output}
+    the placeholders {input} and {output} are replaced by a folder with the image as only case
+    and the folder the prediction is expected in, named like the case without the channel postfix
+    """
+    output_dir = os.path.dirname(outputs[0])
+    case = os.path.basename(outputs[0])[:-len(_file_ending)]
+    input_dir = os.path.join(work_dir, 'predict', case)
+    shutil.rmtree(input_dir, ignore_errors=True)
+    os.makedirs(input_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    os.symlink(os.path.abspath(inputs['image']), os.path.join(input_dir, case + '_0000' + _file_ending))
+    subprocess.run(shlex.split(command.format(input=input_dir, output=output_dir)), check=True,
+                   stdout=sys.stdout, stderr=subprocess.STDOUT)
+    shutil.rmtree(input_dir)
+    if not os.path.exists(outputs[0]):
+        raise RuntimeError("Prediction was not written to: {}".format(outputs[0]))
+    return dict()
+
+
+def run_label(inputs: dict, outputs: list, work_dir: str, orientation: str='RAI') -> dict:
+    """
+    reorients a label and writes it to all outputs, i.e., the TOF MRA and each sMRI of a subject
+    :return: the label values of the image as 'values'
+    """
+    img = sitk.DICOMOrient(sitk.ReadImage(inputs['label']), orientation)
+    values = np.flatnonzero(np.bincount(sitk.GetArrayViewFromImage(img).ravel().astype(np.int64)))
+    _write_image(img, outputs[0], work_dir)
+    for path in outputs[1:]:
+        shutil.copyfile(outputs[0], path)
+    return dict(values=values.tolist())
+
+
+def run_register(inputs: dict, outputs: list, work_dir: str, **kwargs) -> dict:
+    """
+    registers the segmentation of an sMRI (moving) to the segmentation of the TOF MRA (fixed), see
+    miua2024b.source.main.run, the transform maps points of the TOF MRA to the sMRI as required to resample the sMRI
+    """
+    from miua2024b.source.main import run
+    os.makedirs(os.path.dirname(outputs[0]), exist_ok=True)
+    run(inputs['fixed'], inputs['moving'], outputs[0], **kwargs)
+    return dict()
+
+
+def run_resample(inputs: dict, outputs: list, work_dir: str, interpolator: str='linear',
+                 orientation: str='RAI') -> dict:
+    """
+    resamples an sMRI to the grid of the (reoriented) TOF MRA with the transform of the registration
+    """
+    img = sitk.ReadImage(inputs['image'])
+    reference = sitk.ReadImage(inputs['reference'])
+    interpolator = dict(linear=sitk.sitkLinear, bspline=sitk.sitkBSpline)[interpolator]
+    img = sitk.Resample(img, reference, sitk.ReadTransform(inputs['transform']), interpolator, 0.0, img.GetPixelID())
+    _write_image(sitk.DICOMOrient(img, orientation), outputs[0], work_dir)
+    return dict()
+
+
+_stages = dict(orient=run_orient, predict=run_predict, label=run_label, register=run_register, resample=run_resample)
+
+
+def _run_node_safe(node: dict, work_dir: str):
+    """
+    runs the stage of a node with the output redirected to its log in the work folder
+    :return: the id of the node, the info of the stage, the error or None and the duration in seconds
+    """
+    log_path = os.path.join(work_dir, 'logs', node['id'].replace(':', '_') + '.log')
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    t0 = time()
+    with open(log_path, 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            info = _stages[node['stage']](node['inputs'], node['outputs'], work_dir, **node['params'],
+                                          **node['options'])
+            return node['id'], info, None, time() - t0
+        except Exception:
+            err = traceback.format_exc()
+            log.write(err)
+            return node['id'], None, err, time() - t0
+
+
+class FileHashes:
+    """
+    content hashes of files, which are only recomputed if the size or modification time of a file changed
+    """
+
+    def __init__(self, entries: Optional[dict]=None):
+        self.entries = dict(entries or dict())
+
+    def get(self, path: str) -> Optional[str]:
+        """
+        returns the sha1 hash of the content of a file, or None if it does not exist
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.entries.pop(path, None)
+            return None
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        self.entries[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+
+def fingerprint(node: dict, hashes: FileHashes) -> Optional[str]:
+    """
+    returns the hash of everything a node's outputs depend on: the stage and its version, the parameters,
+    the content of the inputs and the output paths, or None if an input is missing. the options of a node, e.g., the
+    cache of the registration, do not change its outputs and are left out
+    """
+    inputs = dict((k, hashes.get(p)) for k, p in node['inputs'].items())
+    if any(h is None for h in inputs.values()):
+        return None
+    desc = dict(stage=node['stage'], version=_stage_versions[node['stage']], params=node['params'], inputs=inputs,
+                outputs=node['outputs'])
+    return hashlib.sha1(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_state(work_dir: str) -> dict:
+    """
+    reads the build state of the work folder: the file hashes and, per node, the fingerprint it was built with,
+    the hashes of its outputs and the info of its stage
+    """
+    path = os.path.join(work_dir, 'state.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            state = json.load(f)
+        if state.get('version') == _state_version:
+            return state
+    return dict(version=_state_version, files=dict(), nodes=dict())
+
+
+def build(nodes: list, work_dir: str, workers: int=1, force: bool=False) -> list:
+    """
+    builds the nodes of a graph (see make_graph) in a pool of worker processes, a node is run once all nodes it depends
+    on succeeded. a node is skipped if its fingerprint matches the last build and its outputs are unchanged, so that
+    only outputs whose inputs or parameters changed are rebuilt. the state is saved after each node, so that an
+    interrupted build resumes where it stopped. a worker which dies, e.g., by a segfault or the OOM killer, fails its
+    node with the exit code, if several nodes were in flight they are rerun one at a time to find the node which
+    crashed it
+    :param nodes: nodes of the graph
+    :param work_dir: folder of the build state and the logs of each node
+    :param workers: number of worker processes, for 0 the nodes are run sequentially in this process
+    :param force: whether to rebuild all nodes
+    :return: list of records with the entries 'id', 'stage', 'status' ('built', 'skipped', 'failed' or 'blocked'),
+    'deps', 'info', 'error' and 't' (seconds) in the order of the nodes
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    state = read_state(work_dir)
+    hashes = FileHashes(state['files'])
+    state_path = os.path.join(work_dir, 'state.json')
+
+    def _save():
+        state['files'] = hashes.entries
+        _atomic_json(state, state_path)
+
+    by_id = dict((node['id'], node) for node in nodes)
+    records = dict((node['id'], dict(id=node['id'], stage=node['stage'], status='pending', deps=node['deps'],
+                                     info=None, error=None, t=0.0)) for node in nodes)
+    fingerprints = dict()
+
+    def _up_to_date(node, fp) -> bool:
+        prev = state['nodes'].get(node['id'])
+        if force or prev is None or prev['fingerprint'] != fp:
+            return False
+        return all(hashes.get(p) == prev['outputs'].get(p) for p in node['outputs'])
+
+    def _complete(idx, info, err, t):
+        node, r = by_id[idx], records[idx]
+        r['t'] = t
+        if err is None:
+            r.update(status='built', info=info)
+            state['nodes'][idx] = dict(fingerprint=fingerprints[idx], info=info,
+                                       outputs=dict((p, hashes.get(p)) for p in node['outputs']))
+        else:
+            r.update(status='failed', error=err.strip().splitlines()[-1])
+            state['nodes'].pop(idx, None)
+            print("{} failed: {}".format(idx, r['error']))
+        _save()
+
+    pool = IsolatingPool(workers)
+    pending = list(node['id'] for node in nodes)
+    try:
+        while pending or pool.running:
+            waiting = list()
+            for idx in pending:
+                node = by_id[idx]
+                deps = list(records[d]['status'] for d in node['deps'])
+                if any(s in ('failed', 'blocked') for s in deps):
+                    records[idx]['status'] = 'blocked'
+                    continue
+                if any(s not in ('built', 'skipped') for s in deps):
+                    waiting.append(idx)
+                    continue
+                fp = fingerprints.get(idx) or fingerprint(node, hashes)
+                if fp is None:
+                    missing = list(p for p in node['inputs'].values() if not os.path.exists(p))
+                    records[idx].update(status='failed', error="Missing input: {}".format(", ".join(missing)))
+                    print("{} failed: {}".format(idx, records[idx]['error']))
+                    continue
+                fingerprints[idx] = fp
+                if _up_to_date(node, fp):
+                    records[idx].update(status='skipped', info=state['nodes'][idx]['info'])
+                    continue
+                if workers <= 0:
+                    _complete(*_run_node_safe(node, work_dir))
+                    continue
+                if not pool.can_submit(idx):
+                    waiting.append(idx)
+                    continue
+                pool.submit(idx, idx, _run_node_safe, node, work_dir)
+            pending = waiting
+            if not pool.running:
+                continue
+
+            finished, rerun = pool.wait()
+            for idx, t0, res, err in finished:
+                # a node which crashed its worker has no result, see miua2024b.source.pool.IsolatingPool
+                _complete(*(res if err is None else (idx, None, err, time() - t0)))
+            if rerun:
+                print("A worker died while running {}, they are run alone to find the cause".format(
+                    ", ".join(idx for idx, _ in rerun)))
+                pending = list(idx for idx, _ in rerun) + pending
+    finally:
+        pool.shutdown()
+        _save()
+    return list(records[node['id']] for node in nodes)
+
+
+def dataset_cases(nodes: list, records: list) -> list:
+    """
+    returns the names of the complete cases of the dataset, i.e., whose image and label were built or are up to date,
+    images left in the dataset by an earlier build of a node which failed since are not counted
+    :param nodes: nodes of the graph, see make_graph
+    :param records: records of the build, see build
+    """
+    done = set(r['id'] for r in records if r['status'] in ('built', 'skipped'))
+    images, labels = list(), set()
+    for node in nodes:
+        if node['id'] not in done:
+            continue
+        if node['stage'] in ('orient', 'resample'):
+            images.append(os.path.basename(node['outputs'][0])[:-len('_0000' + _file_ending)])
+        elif node['stage'] == 'label':
+            labels.update(os.path.basename(p)[:-len(_file_ending)] for p in node['outputs'])
+    return list(case for case in images if case in labels)
+
+
+def write_dataset_json(output_dir: str, n_training: int, label_values, label_names: Optional[list]=None,
+                       channel: str='MRI'):
+    """
+    writes the dataset.json of nnU-Net v2
+    :param n_training: the number of training cases
+    :param label_values: the label values occurring in the labels, see run_label
+    :param label_names: names of the labels 0, 1, ..., by default 'background' and 'label_<value>'
+    :param channel: name of the single input channel
+    """
+    n_labels = int(max(label_values, default=0)) + 1
+    if label_names is None:
+        label_names = ['background'] + list('label_{}'.format(v) for v in range(1, n_labels))
+    if len(label_names) < n_labels:
+        raise RuntimeError("Labels contain {} values, but {} names are given".format(n_labels, len(label_names)))
+    _atomic_json(dict(channel_names={'0': channel}, labels=dict((n, v) for v, n in enumerate(label_names)),
+                      numTraining=n_training, file_ending=_file_ending), os.path.join(output_dir, 'dataset.json'))
+
+
+def write_timings(records: list, path: str, t_total: float):
+    """
+    writes the timing manifest of a build: the duration and status of each node and their sums per stage
+    """
+    stages = dict()
+    for r in records:
+        s = stages.setdefault(r['stage'], dict(built=0, skipped=0, failed=0, blocked=0, t=0.0))
+        s[r['status']] += 1
+        s['t'] += r['t']
+    _atomic_json(dict(t_total=t_total, stages=stages,
+                      nodes=list(dict((k, r[k]) for k in ('id', 'stage', 'status', 't', 'error')) for r in records)),
+                 path)
+
+
+def entry_point():
+    parser = argparse.ArgumentParser(description='Incremental build of the nnU-Net dataset of TOF MRA and resampled sMRI with the TOF MRA labels.')
+    parser.add_argument('--subjects', dest='subjects', type=str, required=True, help="Manifest of the subjects, a .json file, see read_subjects")
+    parser.add_argument('--output', dest='output', type=str, required=True, help="The dataset folder, e.g., Dataset505_ArterySMRI")
+    parser.add_argument('--work', dest='work', type=str, default="", help="Folder for predicted labels, transforms, logs and the build state, defaults to <output>/.build")
+    parser.add_argument('--timings', dest='timings', type=str, default="", help="Output path for the timing manifest, defaults to <work>/timings.json")
+    parser.add_argument('--workers', dest='workers', type=int, default=os.cpu_count(), help="Number of worker processes, 0 runs all stages sequentially")
+    parser.add_argument('--force', dest='force', action='store_true', help="Whether to rebuild all outputs")
+    parser.add_argument('--predict', dest='predict', type=str, default="", help="Command to predict labels of TOF MRA without label, e.g., 'nnUNetv2_predict_from_modelfolder -m <path-to/models> -i {input} -o {output}'")
+    parser.add_argument('--labels', dest='labels', type=str, nargs='*', default=None, help="Names of the labels 0, 1, ... for the dataset.json, by default 'background' and 'label_<value>'")
+    parser.add_argument('--interpolator', dest='interpolator', type=str, default='linear', choices=['linear', 'bspline'], help="Interpolator to resample the sMRI with")
+    parser.add_argument('--binary', dest='binary', action='store_true', help="Whether to register using all labels instead of the left and right labels predicted by model theta m")
+    parser.add_argument('--search', dest='search', type=float, default='1.5', help="Resolution for the global RANSAC registration (in mm for the poison disk radius)")
+    parser.add_argument('--fine', dest='fine', type=float, default='1.0', help="Resolution for the fine ICP registration (in mm for the poison disk radius)")
+    parser.add_argument('--cache', dest='cache', type=str, default=None, help="Folder to cache converted volumes and point clouds of the registration in")
+    args, _ = parser.parse_known_args(args=sys.argv)
+
+    work_dir = args.work or os.path.join(args.output, '.build')
+    subjects = read_subjects(args.subjects)
+    register_params = dict(binary=args.binary, search_mm=args.search, fine_mm=args.fine)
+    nodes = make_graph(subjects, args.output, work_dir, predict=args.predict or None,
+                       register_params=register_params, register_options=dict(cache_dir=args.cache),
+                       interpolator=args.interpolator)
+    print(f"Building {len(nodes)} stages of {len(subjects)} subjects using {args.workers} workers...")
+    t0 = time()
+    records = build(nodes, work_dir, workers=args.workers, force=args.force)
+    t_total = time() - t0
+
+    values = set()
+    for r in records:
+        if r['stage'] == 'label' and r['info'] is not None:
+            values.update(r['info']['values'])
+    cases = dataset_cases(nodes, records)
+    write_dataset_json(args.output, len(cases), values, label_names=args.labels)
+    print(f"Finished writing results to: {os.path.join(args.output, 'dataset.json')}")
+    timings = args.timings or os.path.join(work_dir, 'timings.json')
+    write_timings(records, timings, t_total)
+    print(f"Finished writing results to: {timings}")
+
+    counts = dict()
+    for r in records:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+    print("{} cases in {:.1f} seconds: {}".format(len(cases), t_total,
+                                                ", ".join('{} {}'.format(v, k) for k, v in sorted(counts.items()))))
+    if counts.get('failed') or counts.get('blocked'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    entry_point()
@@ -0,0 +1,241 @@
+import argparse
+import csv
+import multiprocessing as mp
+import os
+import sys
+from typing import Optional
+
+import numpy as np
+import SimpleITK as sitk
+
+_resource_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'resource'))
+_default_roi = os.path.join(_resource_dir, 'MNI_eval_roi.nrrd')
+_image_exts = ('.nii.gz', '.nrrd', '.nii', '.mha')
+_transform_exts = ('.hdf', '.h5', '.tfm', '.txt', '.mat')
+
+
+def _stem(path: str, exts=_image_exts) -> str:
+    name = os.path.basename(path)
+    for ext in exts:
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def _find(folder: Optional[str], name: str, exts) -> Optional[str]:
+    """
+    returns the path of the file named name (with any of the extensions) in the folder, or None
+    """
+    if not folder:
+        return None
+    for ext in exts:
+        path = os.path.join(folder, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def find_cases(pred_dirs: list, label_dir: str, roi_mask_dir: Optional[str]=None,
+               roi_transform_dir: Optional[str]=None) -> list:
+    """
+    matches the predictions of one or more folders (e.g. the validation folders of all folds) to the labels by name
+    :param pred_dirs: folders of the predictions
+    :param label_dir: folder of the labels, e.g., labelsTr of the nnU-Net dataset
+    :param roi_mask_dir: optional folder of prepared CoW masks matched by name
+    :param roi_transform_dir: optional folder of transforms mapping points of each scan to MNI space matched by name,
+    which are used to resample the MNI ROI to scans without a prepared mask
+    :return: list of cases with the entries 'id', 'pred', 'label', 'roi_mask' and 'roi_transform'
+    """
+    cases = list()
+    for pred_dir in pred_dirs:
+        for f in sorted(os.listdir(pred_dir)):
+            if not f.lower().endswith(_image_exts):
+                continue
+            name = _stem(f)
+            label = _find(label_dir, name, _image_exts)
+            if label is None:
+                continue
+            cases.append(dict(id=name, pred=os.path.join(pred_dir, f), label=label,
+                              roi_mask=_find(roi_mask_dir, name, _image_exts),
+                              roi_transform=_find(roi_transform_dir, name, _transform_exts)))
+    return cases
+
+
+def confusion_matrices(pred: np.ndarray, label: np.ndarray, n_labels: int, roi: Optional[np.ndarray]=None,
+                       slab_size: int=16) -> np.ndarray:
+    """
+    computes the confusion matrices of the full volume and the region of interest in one pass,
+    the volumes are processed in slabs along the first axis to bound the size of temporary arrays
+    :param pred: predicted labels
+    :param label: ground-truth labels
+    :param n_labels: the number of labels, raises a RuntimeError for values out of the range 0 to n_labels - 1
+    :param roi: optional mask of the region of interest
+    :param slab_size: the number of slices per slab
+    :return: (2, n_labels, n_labels) array of the full and roi confusion matrix (rows: label, columns: prediction)
+    """
+    n2 = n_labels * n_labels
+    counts = np.zeros(2 * n2, dtype=np.int64)
+    for z in range(0, label.shape[0], slab_size):
+        label_slab, pred_slab = label[z:z + slab_size], pred[z:z + slab_size]
+        # values out of range would be counted in the cells of other labels
+        for name, slab in (('label', label_slab), ('prediction', pred_slab)):
+            if slab.size and not 0 <= slab.min() <= slab.max() < n_labels:
+                raise RuntimeError("Values of the {} out of the range of {} labels: {} to {}".format(
+                    name, n_labels, slab.min(), slab.max()))
+        key = label_slab.astype(np.int64) * n_labels + pred_slab
+        if roi is not None:
+            # voxels of the roi are counted in the second half
+            key += (roi[z:z + slab_size] > 0) * n2
+        counts += np.bincount(key.ravel(), minlength=2 * n2)
+    full, in_roi = counts[:n2], counts[n2:]
+    return np.stack([full + in_roi, in_roi]).reshape(2, n_labels, n_labels)
+
+
+def dice_scores(cm: np.ndarray) -> dict:
+    """
+    returns the DSC of the foreground (all labels except 0) and of each label from a confusion matrix,
+    the DSC is nan if neither label nor prediction contain the foreground or label
+    """
+    def _dsc(tp, n_label, n_pred):
+        return 2 * tp / (n_label + n_pred) if n_label + n_pred > 0 else np.nan
+
+    res = dict(dsc=_dsc(cm[1:, 1:].sum(), cm[1:].sum(), cm[:, 1:].sum()))
+    if len(cm) > 2:
+        for k in range(1, len(cm)):
+            res['dsc.{}'.format(k)] = _dsc(cm[k, k], cm[k].sum(), cm[:, k].sum())
+    return res
+
+
+def _same_grid(img: sitk.Image, reference: sitk.Image, tol: float=1e-4) -> bool:
+    """
+    whether an image has the size, origin, spacing and direction of the reference
+    """
+    return img.GetSize() == reference.GetSize() and all(
+        np.allclose(a, b, atol=tol) for a, b in ((img.GetOrigin(), reference.GetOrigin()),
+                                                 (img.GetSpacing(), reference.GetSpacing()),
+                                                 (img.GetDirection(), reference.GetDirection())))
+
+
+def _read_roi(case: dict, reference: sitk.Image, roi_path: str):
+    """
+    reads the prepared CoW mask of a case or resamples the MNI ROI to the case,
+    a prepared mask on another grid than the label is resampled onto the grid of the label
+    """
+    if case.get('roi_mask'):
+        roi = sitk.ReadImage(case['roi_mask'])
+        if not _same_grid(roi, reference):
+            roi = sitk.Resample(roi, reference, sitk.Transform(), sitk.sitkNearestNeighbor)
+        return roi
+    if case.get('roi_transform'):
+        tf = sitk.ReadTransform(case['roi_transform'])
+        return sitk.Resample(sitk.ReadImage(roi_path), reference, tf, sitk.sitkNearestNeighbor)
+    return None
+
+
+def evaluate_case(case: dict, roi_path: str=_default_roi, n_labels: Optional[int]=None, slab_size: int=16) -> dict:
+    """
+    computes the DSC of a case for the full volume and the CoW region
+    :param case: case with the entries 'id', 'pred', 'label' and optionally 'roi_mask' or 'roi_transform'
+    :param roi_path: the CoW region in MNI space, resampled to the case if it has a 'roi_transform'
+    :param n_labels: the number of labels, derived from the maximum label by default
+    :return: dictionary with the 'id', the scores of the 'full' volume and the 'cow' region (None without ROI or if
+    the ROI could not be read)
+    """
+    label_img = sitk.ReadImage(case['label'])
+    pred_img = sitk.ReadImage(case['pred'])
+    label = sitk.GetArrayViewFromImage(label_img)
+    pred = sitk.GetArrayViewFromImage(pred_img)
+    if label.shape != pred.shape:
+        raise RuntimeError("Prediction and label of {} differ in size: {} != {}".format(
+            case['id'], pred.shape, label.shape))
+    try:
+        roi_img = _read_roi(case, label_img, roi_path)
+    except Exception as e:
+        # the full volume is scored without the region
+        print("Failed to read the CoW region of {}: {}".format(case['id'], str(e).strip().splitlines()[-1]))
+        roi_img = None
+    roi = None if roi_img is None else sitk.GetArrayViewFromImage(roi_img)
+    if n_labels is None:
+        n_labels = int(max(label.max(), pred.max())) + 1
+    cm = confusion_matrices(pred, label, n_labels, roi=roi, slab_size=slab_size)
+    return dict(id=case['id'], full=dice_scores(cm[0]), cow=None if roi is None else dice_scores(cm[1]))
+
+
+def _evaluate_case_safe(args):
+    case, kwargs = args
+    try:
+        return evaluate_case(case, **kwargs)
+    except Exception as e:
+        print("Failed to evaluate {}: {}".format(case['id'], str(e).strip().splitlines()[-1]))
+        return dict(id=case['id'], full=None, cow=None)
+
+
+def evaluate_cases(cases: list, workers: int=0, **kwargs):
+    """
+    evaluates the cases in a pool of worker processes, see evaluate_case
+    :param workers: number of worker processes, 0 evaluates the cases sequentially
+    :return: generator of the results in the order of the cases
+    """
+    jobs = ((case, kwargs) for case in cases)
+    if workers <= 0:
+        yield from map(_evaluate_case_safe, jobs)
+        return
+    with mp.Pool(workers) as pool:
+        yield from pool.imap(_evaluate_case_safe, jobs)
+
+
+def sequence_of(case_id: str) -> str:
+    """
+    returns the MR sequence of a case, the last part of its name, e.g. PD for IXI002-Guys-0828-PD
+    """
+    return case_id.rsplit('-', 1)[-1]
+
+
+def write_scores(results: list, region: str, path: str):
+    """
+    writes the scores of a region ('full' or 'cow') in the schema of the val_dsc tables: ,id,label,metric,value
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['', 'id', 'label', 'metric', 'value'])
+        idx = 0
+        for res in results:
+            if res[region] is None:
+                continue
+            for metric, value in res[region].items():
+                writer.writerow([idx, res['id'], sequence_of(res['id']), metric, value])
+                idx += 1
+
+
+def entry_point():
+    parser = argparse.ArgumentParser(description='DSC evaluation of predicted brain artery segmentations for the full volume and the CoW region.')
+    parser.add_argument('--pred', dest='pred', type=str, nargs='+', required=True, help="Folders of the predictions, e.g., the validation folders of each fold")
+    parser.add_argument('--labels', dest='labels', type=str, required=True, help="Folder of the labels matched to the predictions by file name, e.g., labelsTr")
+    parser.add_argument('--output-full', dest='output_full', type=str, required=True, help="Output path for the .csv table of the full volume DSC")
+    parser.add_argument('--output-cow', dest='output_cow', type=str, default="", help="Output path for the .csv table of the CoW region DSC")
+    parser.add_argument('--roi-masks', dest='roi_masks', type=str, default="", help="Folder of prepared CoW masks matched by file name")
+    parser.add_argument('--roi-transforms', dest='roi_transforms', type=str, default="", help="Folder of transforms mapping points of each scan to MNI space matched by file name, used to resample the MNI ROI to scans without a prepared mask")
+    parser.add_argument('--roi', dest='roi', type=str, default=_default_roi, help="CoW region in MNI space, defaults to the bundled MNI_eval_roi.nrrd")
+    parser.add_argument('--labels-count', dest='labels_count', type=int, default=None, help="Number of labels including background, by default derived per case from the maximum label")
+    parser.add_argument('--workers', dest='workers', type=int, default=os.cpu_count(), help="Number of worker processes, 0 evaluates all cases sequentially")
+    args, _ = parser.parse_known_args(args=sys.argv)
+
+    cases = find_cases(args.pred, args.labels, roi_mask_dir=args.roi_masks or None,
+                       roi_transform_dir=args.roi_transforms or None)
+    print(f"Evaluating {len(cases)} cases using {args.workers} workers...")
+    results = list()
+    for res in evaluate_cases(cases, workers=args.workers, roi_path=args.roi, n_labels=args.labels_count):
+        results.append(res)
+        if res['full'] is not None:
+            print("{}: full: {:.3f}{}".format(res['id'], res['full']['dsc'],
+                                             '' if res['cow'] is None else ', cow: {:.3f}'.format(res['cow']['dsc'])))
+
+    write_scores(results, 'full', args.output_full)
+    print(f"Finished writing results to: {args.output_full}")
+    if args.output_cow:
+        write_scores(results, 'cow', args.output_cow)
+        print(f"Finished writing results to: {args.output_cow}")
+
+
+if __name__ == '__main__':
+    entry_point()
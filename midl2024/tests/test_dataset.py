@@ -0,0 +1,233 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from midl2024.source import dataset
+
+
+def _copy(inputs, outputs, work_dir, crash=False, **options):
+    if crash:
+        os._exit(3)
+    shutil.copyfile(inputs['image'], outputs[0])
+    return dict()
+
+
+@pytest.fixture
+def copy_stage(monkeypatch):
+    # the workers are forked and inherit the patched stages, the crash isolation itself is tested in miua2024b
+    monkeypatch.setitem(dataset._stages, 'copy', _copy)
+    monkeypatch.setitem(dataset._stage_versions, 'copy', 1)
+
+
+def _graph(tmp_path, crash=None, options=None):
+    """
+    returns chains of two copies a -> b -> c for the subjects 0 to 3
+    """
+    nodes = list()
+    for i in range(4):
+        src = tmp_path / 'src{}.txt'.format(i)
+        if not src.exists():
+            src.write_text('subject {}'.format(i))
+        paths = list(str(tmp_path / '{}{}.txt'.format(k, i)) for k in 'bc')
+        for k, (image, output) in enumerate(zip([str(src)] + paths, paths)):
+            idx = 'copy:{}{}'.format(i, 'bc'[k])
+            nodes.append(dict(id=idx, stage='copy', inputs=dict(image=image), outputs=[output],
+                              params=dict(crash=idx == crash), options=dict(options or dict()),
+                              deps=['copy:{}b'.format(i)] if k else []))
+    return nodes
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_build_worker_died(tmp_path, copy_stage, workers):
+    records = dataset.build(_graph(tmp_path, crash='copy:1b'), str(tmp_path / 'work'), workers=workers)
+    status = dict((r['id'], r['status']) for r in records)
+    assert status.pop('copy:1b') == 'failed'
+    assert status.pop('copy:1c') == 'blocked'
+    assert set(status.values()) == {'built'}
+    error = next(r['error'] for r in records if r['id'] == 'copy:1b')
+    assert error == "BrokenProcessPool: the worker process died with exit code 3"
+
+
+def test_build_incremental(tmp_path, copy_stage):
+    work_dir = str(tmp_path / 'work')
+    assert set(r['status'] for r in dataset.build(_graph(tmp_path), work_dir, workers=2)) == {'built'}
+    # options are not part of the fingerprint
+    records = dataset.build(_graph(tmp_path, options=dict(cache_dir='cache')), work_dir, workers=2)
+    assert set(r['status'] for r in records) == {'skipped'}
+
+    (tmp_path / 'src2.txt').write_text('changed')
+    records = dataset.build(_graph(tmp_path), work_dir, workers=0)
+    built = set(r['id'] for r in records if r['status'] == 'built')
+    assert built == {'copy:2b', 'copy:2c'}
+    assert (tmp_path / 'c2.txt').read_text() == 'changed'
+
+
+def _subjects(tmp_path) -> list:
+    return [dict(name='s1', tof='s1/tof.nii.gz', label='s1/label.nii.gz',
+                 sequences=dict(PD=dict(image='s1/pd.nii.gz', transform='s1/forward.hdf'))),
+            dict(name='s2', tof='s2/tof.nii.gz', segmentation='s2/vessels.nrrd',
+                 sequences=dict(T1=dict(image='s2/t1.nii.gz', segmentation='s2/t1_vessels.nrrd'),
+                                T2=dict(image='s2/t2.nii.gz', transform='/data/t2.hdf')))]
+
+
+def _read_subjects(tmp_path, entries) -> list:
+    path = tmp_path / 'manifest' / 'subjects.json'
+    path.parent.mkdir(exist_ok=True)
+    path.write_text(json.dumps(entries))
+    return dataset.read_subjects(str(path))
+
+
+def test_read_subjects(tmp_path):
+    subjects = _read_subjects(tmp_path, dict(subjects=_subjects(tmp_path)))
+    base = str(tmp_path / 'manifest')
+    # relative paths are resolved against the folder of the manifest
+    assert subjects[0]['tof'] == os.path.join(base, 's1', 'tof.nii.gz')
+    assert subjects[0]['segmentation'] is None
+    assert subjects[1]['label'] is None
+    assert subjects[1]['sequences']['T1'] == dict(image=os.path.join(base, 's2', 't1.nii.gz'), transform=None,
+                                                  segmentation=os.path.join(base, 's2', 't1_vessels.nrrd'))
+    assert subjects[1]['sequences']['T2']['transform'] == '/data/t2.hdf'
+    assert _read_subjects(tmp_path, _subjects(tmp_path)) == subjects
+
+    with pytest.raises(RuntimeError, match='missing: tof'):
+        _read_subjects(tmp_path, [dict(name='s3')])
+    with pytest.raises(RuntimeError, match='Sequence PD of s3'):
+        _read_subjects(tmp_path, [dict(name='s3', tof='tof.nii.gz', sequences=dict(PD=dict(image='pd.nii.gz')))])
+
+
+def test_make_graph(tmp_path):
+    subjects = _read_subjects(tmp_path, _subjects(tmp_path))
+    out, work = str(tmp_path / 'Dataset'), str(tmp_path / 'work')
+    nodes = dict((n['id'], n) for n in dataset.make_graph(subjects, out, work, predict='predict {input} {output}'))
+    assert list(nodes) == ['orient:s1-MRA', 'label:s1-MRA', 'resample:s1-PD',
+                           'orient:s2-MRA', 'predict:s2-MRA', 'label:s2-MRA', 'register:s2-T1', 'resample:s2-T1',
+                           'resample:s2-T2']
+    assert nodes['orient:s1-MRA']['deps'] == []
+    assert nodes['label:s1-MRA']['deps'] == []
+    assert nodes['resample:s1-PD']['deps'] == ['orient:s1-MRA']
+    assert nodes['predict:s2-MRA']['deps'] == ['orient:s2-MRA']
+    assert nodes['label:s2-MRA']['deps'] == ['predict:s2-MRA']
+    # the prepared segmentation of the TOF MRA is registered instead of the label
+    assert nodes['register:s2-T1']['deps'] == []
+    assert nodes['resample:s2-T1']['deps'] == ['orient:s2-MRA', 'register:s2-T1']
+    assert nodes['resample:s2-T2']['deps'] == ['orient:s2-MRA']
+    assert nodes['label:s2-MRA']['outputs'] == list(os.path.join(out, 'labelsTr', c + '.nii.gz')
+                                                    for c in ('s2-MRA', 's2-T1', 's2-T2'))
+
+    # the label is registered without a prepared segmentation
+    subjects[1]['segmentation'] = None
+    nodes = dict((n['id'], n) for n in dataset.make_graph(subjects, out, work, predict='predict'))
+    assert nodes['register:s2-T1']['deps'] == ['label:s2-MRA']
+
+    with pytest.raises(RuntimeError, match='no label'):
+        dataset.make_graph(subjects, out, work)
+    with pytest.raises(RuntimeError, match='is written by orient:s1-MRA and orient:s1-MRA'):
+        dataset.make_graph(subjects[:1] * 2, out, work)
+
+
+def _image(arr: np.ndarray, direction=(-1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, -1.0, 0.0)) -> sitk.Image:
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([0.5, 0.7, 0.9])
+    img.SetOrigin([10.0, -5.0, 3.0])
+    img.SetDirection(direction)
+    return img
+
+
+def _assert_same_image(res: sitk.Image, ref: sitk.Image):
+    assert res.GetSize() == ref.GetSize()
+    assert np.allclose(res.GetOrigin(), ref.GetOrigin(), atol=1e-5)
+    assert np.allclose(res.GetSpacing(), ref.GetSpacing(), atol=1e-5)
+    assert np.allclose(res.GetDirection(), ref.GetDirection(), atol=1e-5)
+    assert np.array_equal(sitk.GetArrayFromImage(res), sitk.GetArrayFromImage(ref))
+
+
+def test_run_orient(tmp_path):
+    img = _image(np.random.default_rng(0).normal(size=(4, 5, 6)).astype(np.float32))
+    sitk.WriteImage(img, str(tmp_path / 'img.nrrd'))
+    out = str(tmp_path / 'Dataset' / 'imagesTr' / 'a_0000.nii.gz')
+    assert dataset.run_orient(dict(image=str(tmp_path / 'img.nrrd')), [out], str(tmp_path / 'work')) == dict()
+    res = sitk.ReadImage(out)
+    _assert_same_image(res, sitk.DICOMOrient(img, 'RAI'))
+    assert sitk.DICOMOrientImageFilter.GetOrientationFromDirectionCosines(res.GetDirection()) == 'RAI'
+    # reorienting only permutes and flips the voxels, the first voxel keeps its position
+    idx = np.argwhere(sitk.GetArrayViewFromImage(res) == sitk.GetArrayViewFromImage(img)[0, 0, 0])[0][::-1]
+    assert np.allclose(res.TransformIndexToPhysicalPoint(idx.tolist()), img.GetOrigin(), atol=1e-5)
+    # the temporary file is moved
+    assert os.listdir(str(tmp_path / 'work' / 'tmp')) == []
+
+
+def test_run_label(tmp_path):
+    arr = np.zeros((4, 5, 6), dtype=np.uint8)
+    arr[1:3, 2:4, 1:5] = 3
+    arr[0, 0, 0] = 1
+    sitk.WriteImage(_image(arr), str(tmp_path / 'label.nrrd'))
+    outputs = list(str(tmp_path / 'labelsTr' / '{}.nii.gz'.format(c)) for c in ('a-MRA', 'a-PD', 'a-T1'))
+    info = dataset.run_label(dict(label=str(tmp_path / 'label.nrrd')), outputs, str(tmp_path / 'work'))
+    assert info == dict(values=[0, 1, 3])
+    ref = sitk.DICOMOrient(_image(arr), 'RAI')
+    for path in outputs:
+        _assert_same_image(sitk.ReadImage(path), ref)
+
+
+@pytest.mark.parametrize('interpolator', ['linear', 'bspline'])
+def test_run_resample(tmp_path, interpolator):
+    rng = np.random.default_rng(1)
+    identity = tuple(np.eye(3).ravel())
+    img = _image(rng.normal(size=(4, 5, 6)).astype(np.float32), direction=identity)
+    reference = _image(np.zeros((4, 5, 6), dtype=np.float32), direction=identity)
+    for name, i in (('img', img), ('reference', reference)):
+        sitk.WriteImage(i, str(tmp_path / (name + '.nrrd')))
+    # a translation of one voxel along x maps the voxels of the reference to their neighbours in the image
+    sitk.WriteTransform(sitk.TranslationTransform(3, [0.5, 0.0, 0.0]), str(tmp_path / 'forward.tfm'))
+
+    out = str(tmp_path / 'imagesTr' / 'a-PD_0000.nii.gz')
+    dataset.run_resample(dict(image=str(tmp_path / 'img.nrrd'), reference=str(tmp_path / 'reference.nrrd'),
+                              transform=str(tmp_path / 'forward.tfm')), [out], str(tmp_path / 'work'),
+                         interpolator=interpolator)
+    arr = np.zeros((4, 5, 6), dtype=np.float32)
+    arr[..., :-1] = sitk.GetArrayViewFromImage(img)[..., 1:]
+    expected = sitk.DICOMOrient(_image(arr, direction=identity), 'RAI')
+    res = sitk.ReadImage(out)
+    assert res.GetPixelID() == img.GetPixelID()
+    assert res.GetSize() == expected.GetSize()
+    assert np.allclose(res.GetOrigin(), expected.GetOrigin(), atol=1e-5)
+    assert np.allclose(res.GetDirection(), expected.GetDirection(), atol=1e-5)
+    assert np.allclose(sitk.GetArrayFromImage(res), sitk.GetArrayFromImage(expected), atol=1e-5)
+
+
+def test_write_dataset_json(tmp_path):
+    dataset.write_dataset_json(str(tmp_path), 12, {0, 1, 3})
+    with open(tmp_path / 'dataset.json') as f:
+        content = json.load(f)
+    assert content == dict(channel_names={'0': 'MRI'}, numTraining=12, file_ending='.nii.gz',
+                           labels=dict(background=0, label_1=1, label_2=2, label_3=3))
+
+    dataset.write_dataset_json(str(tmp_path), 1, [0, 1], label_names=['background', 'artery'], channel='TOF')
+    with open(tmp_path / 'dataset.json') as f:
+        content = json.load(f)
+    assert content['labels'] == dict(background=0, artery=1) and content['channel_names'] == {'0': 'TOF'}
+    with pytest.raises(RuntimeError):
+        dataset.write_dataset_json(str(tmp_path), 1, [0, 3], label_names=['background', 'artery'])
+
+
+def test_dataset_cases(tmp_path):
+    subjects = _read_subjects(tmp_path, _subjects(tmp_path))
+    out = str(tmp_path / 'Dataset')
+    nodes = dataset.make_graph(subjects, out, str(tmp_path / 'work'), predict='predict')
+    status = dict((n['id'], 'built') for n in nodes)
+    status.update({'resample:s1-PD': 'skipped', 'resample:s2-T2': 'failed', 'register:s2-T1': 'failed',
+                   'resample:s2-T1': 'blocked'})
+    records = list(dict(id=n['id'], stage=n['stage'], status=status[n['id']]) for n in nodes)
+    # the images of failed nodes from an earlier build are still in the dataset, but are not counted
+    for node in nodes:
+        for path in node['outputs']:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+    assert dataset.dataset_cases(nodes, records) == ['s1-MRA', 's1-PD', 's2-MRA']
+    status['label:s2-MRA'] = 'failed'
+    records = list(dict(id=n['id'], stage=n['stage'], status=status[n['id']]) for n in nodes)
+    assert dataset.dataset_cases(nodes, records) == ['s1-MRA', 's1-PD']
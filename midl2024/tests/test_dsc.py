@@ -0,0 +1,108 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from midl2024.source.dsc import (_resource_dir, confusion_matrices, dice_scores, evaluate_cases, find_cases,
+                                 sequence_of, write_scores)
+
+
+def test_confusion_matrices():
+    label = np.zeros((5, 4, 3), dtype=np.uint8)
+    label[1:3] = 1
+    label[4] = 2
+    pred = label.copy()
+    pred[1] = 0
+    roi = np.zeros(label.shape, dtype=np.uint8)
+    roi[2:] = 1
+    cm = confusion_matrices(pred, label, 3, roi=roi, slab_size=2)
+    assert cm.shape == (2, 3, 3)
+    assert cm[0].sum() == label.size and cm[1].sum() == roi.sum()
+    assert cm[0, 1, 0] == 12 and cm[0, 1, 1] == 12 and cm[1, 1, 0] == 0
+    assert dice_scores(cm[1])['dsc'] == 1.0
+
+
+def test_confusion_matrices_labels_out_of_range():
+    label = np.zeros((5, 4, 3), dtype=np.uint8)
+    label[4] = 2
+    with pytest.raises(RuntimeError):
+        confusion_matrices(label.copy(), label, 2, slab_size=2)
+    with pytest.raises(RuntimeError):
+        confusion_matrices(label.astype(np.int8) - 1, label.astype(np.int8), 3)
+
+
+def _image(arr: np.ndarray, spacing=(0.5, 0.5, 0.8), origin=(-4.0, 2.0, 10.0)) -> sitk.Image:
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    img.SetDirection(sitk.Euler3DTransform([0.0, 0.0, 0.0], 0.0, 0.0, 0.2).GetMatrix())
+    return img
+
+
+def _case(rng, n_labels: int):
+    label = rng.integers(0, n_labels, size=(8, 10, 12), dtype=np.uint8)
+    pred = np.where(rng.uniform(size=label.shape) < 0.8, label, 0).astype(np.uint8)
+    return label, pred
+
+
+def _roi() -> np.ndarray:
+    roi = np.zeros((8, 10, 12), dtype=np.uint8)
+    roi[2:6, 2:8, 4:10] = 1
+    return roi
+
+
+def _rows(path: str) -> list:
+    # the tables of the paper are written with a byte order mark
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return list(csv.reader(f))
+
+
+def test_evaluate_end_to_end(tmp_path):
+    rng = np.random.default_rng(5)
+    folders = dict((k, tmp_path / k) for k in ('pred', 'labels', 'roi'))
+    for folder in folders.values():
+        folder.mkdir()
+    cases = dict(('case{}-{}'.format(i, seq), _case(rng, n)) for i, (seq, n) in
+                 enumerate([('MRA', 2), ('PD', 2), ('T1', 4), ('T2', 2)]))
+    for name, (label, pred) in cases.items():
+        sitk.WriteImage(_image(label), str(folders['labels'] / (name + '.nii.gz')))
+        sitk.WriteImage(_image(pred), str(folders['pred'] / (name + '.nii.gz')))
+    # a prediction without label is skipped
+    sitk.WriteImage(_image(pred), str(folders['pred'] / 'unlabeled-MRA.nii.gz'))
+
+    # a mask on the grid of the label, a mask on a coarser grid covering the same voxels and an unreadable mask
+    sitk.WriteImage(_image(_roi()), str(folders['roi'] / 'case0-MRA.nrrd'))
+    coarse = _image(_roi()[::2, ::2, ::2], spacing=(1.0, 1.0, 1.6))
+    coarse.SetOrigin(_image(_roi()).TransformContinuousIndexToPhysicalPoint([0.25, 0.25, 0.25]))
+    sitk.WriteImage(coarse, str(folders['roi'] / 'case1-PD.nrrd'))
+    (folders['roi'] / 'case2-T1.nrrd').write_text('not an image')
+
+    found = find_cases([str(folders['pred'])], str(folders['labels']), roi_mask_dir=str(folders['roi']))
+    assert list(c['id'] for c in found) == list(cases)
+    results = list(evaluate_cases(found, workers=0))
+    for res in results:
+        label, pred = cases[res['id']]
+        cm = confusion_matrices(pred, label, int(max(label.max(), pred.max())) + 1, roi=_roi())
+        assert res['full'] == pytest.approx(dice_scores(cm[0]))
+        # the full volume is scored when the mask cannot be read
+        if res['id'] in ('case0-MRA', 'case1-PD'):
+            assert res['cow'] == pytest.approx(dice_scores(cm[1]))
+        else:
+            assert res['cow'] is None
+
+    for region in ('full', 'cow'):
+        path = str(tmp_path / 'val_dsc_{}.csv'.format(region))
+        write_scores(results, region, path)
+        rows = _rows(path)
+        ref = _rows(os.path.join(_resource_dir, 'val_dsc_{}.csv'.format(region)))
+        assert rows[0] == ref[0]
+        assert list(int(r[0]) for r in rows[1:]) == list(range(len(rows) - 1))
+        assert all(r[2] == sequence_of(r[1]) for r in rows[1:])
+        # binary labels are scored by the dsc only, as in the tables of the paper
+        for case_id in set(r[1] for r in rows[1:]):
+            metrics = list(r[3] for r in rows[1:] if r[1] == case_id)
+            assert metrics == (['dsc', 'dsc.1', 'dsc.2', 'dsc.3'] if case_id == 'case2-T1' else ['dsc'])
+        assert set(r[1] for r in rows[1:]) == ({'case0-MRA', 'case1-PD'} if region == 'cow' else set(cases))
+        assert all(np.isfinite(float(r[4])) for r in rows[1:])
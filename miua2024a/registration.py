@@ -1,43 +1,247 @@
+import csv
 import os
+import time
 import ants
-import tempfile
+import numpy as np
 import SimpleITK as sitk
+from concurrent.futures import ProcessPoolExecutor
 
 
-def registeration_rigid(fixed_path: str, moving_path: str, output_dir: str):
-    """ Rigid registration using the ANTSPy package """
-    fixed_volume = ants.image_read(fixed_path)
-    moving_volume = ants.image_read(moving_path)
+def _stem(path: str):
+    """ File name without the (possibly double, e.g. .nii.gz) extension """
+    name = os.path.basename(path)
+    for ext in ('.nii.gz', '.nrrd', '.nii', '.mha'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def _read_volume(volume):
+    """ Reads a volume from a path or passes a SimpleITK image through """
+    return sitk.ReadImage(volume) if isinstance(volume, str) else volume
+
+
+def _as_float(volume):
+    """ Casts a volume to float for the registration """
+    return sitk.Cast(volume, sitk.sitkFloat32)
+
+
+def _to_ants(volume):
+    """ Converts a SimpleITK image to an ANTs image in memory """
+    return ants.from_numpy(sitk.GetArrayFromImage(volume).T, origin=volume.GetOrigin(), spacing=volume.GetSpacing(),
+                           direction=np.reshape(volume.GetDirection(), (3, 3)))
+
+
+def registeration_rigid(fixed_path, moving_path, output_dir=None):
+    """
+    Rigid registration using the ANTSPy package, the volumes can be passed as paths or SimpleITK images
+    If output_dir is given, the rigidly registered moving volume is written to it, named after the moving volume,
+    which therefore has to be passed as path
+    Returns the rigid transform (fixed to moving points) as SimpleITK transform
+    """
+    if output_dir is not None and not isinstance(moving_path, str):
+        raise ValueError("The registered volume is named after the moving volume, pass it as path to write to output_dir")
+    fixed_volume = ants.image_read(fixed_path) if isinstance(fixed_path, str) else _to_ants(_as_float(fixed_path))
+    moving_volume = ants.image_read(moving_path) if isinstance(moving_path, str) else _to_ants(_as_float(moving_path))
     result = ants.registration(
         fixed=fixed_volume,
         moving=moving_volume,
         type_of_transform='DenseRigid'
     )
-    output_path = os.path.join(output_dir, f"rigid_{os.path.basename(moving_path)}")
-    ants.image_write(result['warpedmovout'], output_path)
+    if output_dir is not None:
+        output_path = os.path.join(output_dir, f"rigid_{os.path.basename(moving_path)}")
+        ants.image_write(result['warpedmovout'], output_path)
+    # ANTs writes its linear transforms in the ITK format, which SimpleITK reads directly
+    return sitk.ReadTransform(result['fwdtransforms'][0])
+
+
+def _block_mask(volume, block_size: int, fraction: float):
+    """ Mask of the blocks with the highest intensity variance, as selected by block matching (e.g. in NiftyReg) """
+    arr = sitk.GetArrayViewFromImage(volume)
+    pad = list((0, -s % block_size) for s in arr.shape)
+    blocks = np.pad(arr, pad, mode='edge')
+    shape = blocks.shape
+    blocks = blocks.reshape(shape[0] // block_size, block_size, shape[1] // block_size, block_size,
+                            shape[2] // block_size, block_size)
+    var = blocks.var(axis=(1, 3, 5))
+    keep = (var >= np.quantile(var, 1 - fraction)) & (var > 0)
+    for axis in range(3):
+        keep = np.repeat(keep, block_size, axis=axis)
+    mask = sitk.GetImageFromArray(keep[:arr.shape[0], :arr.shape[1], :arr.shape[2]].astype(np.uint8))
+    mask.CopyInformation(volume)
+    return mask
+
+
+def registration_affine(fixed_path, moving_path, output_dir=None, initial_transform=None,
+                        shrink_factors=(4, 2, 1), smoothing_sigmas=(2, 1, 0), iterations=200,
+                        block_size=4, block_fraction=0.5, sampling=0.1):
+    """
+    Affine registration using a multi-resolution SimpleITK registration with block-matching-like sampling:
+    the metric (Mattes mutual information) is sampled regularly within the blocks of the fixed volume with the
+    highest variance, like the block selection of the NiftyReg block matching algorithm.
+    The volumes can be passed as paths or SimpleITK images, the initial transform, e.g. the result of
+    registeration_rigid, is chained in front of the affine transform, otherwise the volume centers are aligned.
+    Returns the composed (initial + affine) transform mapping fixed to moving points as SimpleITK transform
+    """
+    moving_original = _read_volume(moving_path)
+    fixed_volume = _as_float(_read_volume(fixed_path))
+    moving_volume = _as_float(moving_original)
+    if initial_transform is None:
+        initial_transform = sitk.CenteredTransformInitializer(fixed_volume, moving_volume, sitk.Euler3DTransform(),
+                                                              sitk.CenteredTransformInitializerFilter.GEOMETRY)
+
+    affine = sitk.AffineTransform(3)
+    affine.SetCenter(fixed_volume.TransformContinuousIndexToPhysicalPoint(
+        list((s - 1) / 2 for s in fixed_volume.GetSize())))
+
+    registration = sitk.ImageRegistrationMethod()
+    registration.SetMetricAsMattesMutualInformation(numberOfHistogramBins=32)
+    registration.SetMetricFixedMask(_block_mask(fixed_volume, block_size, block_fraction))
+    registration.SetMetricSamplingStrategy(registration.REGULAR)
+    registration.SetMetricSamplingPercentage(sampling, seed=0)
+    registration.SetInterpolator(sitk.sitkLinear)
+    registration.SetOptimizerAsRegularStepGradientDescent(learningRate=1.0, minStep=1e-4, numberOfIterations=iterations,
+                                                         relaxationFactor=0.5)
+    registration.SetOptimizerScalesFromPhysicalShift()
+    registration.SetShrinkFactorsPerLevel(list(shrink_factors))
+    registration.SetSmoothingSigmasPerLevel(list(smoothing_sigmas))
+    registration.SmoothingSigmasAreSpecifiedInPhysicalUnitsOff()
+    registration.SetMovingInitialTransform(initial_transform)
+    registration.SetInitialTransform(affine, inPlace=True)
+    registration.Execute(fixed_volume, moving_volume)
+
+    # the last transform of a composite is applied first: fixed points are mapped by the affine, then the initial one
+    transform = sitk.CompositeTransform([initial_transform, affine])
+    if output_dir is not None and isinstance(moving_path, str):
+        _write_result(transform, fixed_volume, moving_original, moving_path, output_dir)
+    return transform
+
+
+def _write_result(transform, fixed_volume, moving_volume, moving_path: str, output_dir: str,
+                  interpolator=sitk.sitkLinear, prefix='affine', name=None):
+    """ Writes the transform and the moving volume resampled by it as <prefix>_<name> to output_dir,
+    the name defaults to the file name of the moving volume """
+    stem = _stem(moving_path)
+    name = stem if name is None else name
+    sitk.WriteTransform(transform, os.path.join(output_dir, f"{prefix}_{name}.tfm"))
+    sitk.WriteImage(sitk.Resample(moving_volume, fixed_volume, transform, interpolator),
+                    os.path.join(output_dir, f"{prefix}_{name}{os.path.basename(moving_path)[len(stem):]}"))
+
+
+class RegistrationPipeline:
+    """
+    Rigid (ANTsPy) and affine (SimpleITK) registration of a subject: the volumes are read once, the affine step chains
+    on the rigid transform and the moving volume is resampled once with the composed transform at the end.
+    Intermediate results (the rigid transform and volume) are only written if write_intermediate is set.
+    The duration of each stage (in seconds) of the last run is kept in timings
+    """
+
+    def __init__(self, output_dir=None, write_intermediate=False, interpolator=sitk.sitkLinear, **affine_args):
+        self.output_dir = output_dir
+        self.write_intermediate = write_intermediate
+        self.interpolator = interpolator
+        self.affine_args = affine_args
+        self.timings = dict()
+
+    def _stage(self, name, fn):
+        t0 = time.perf_counter()
+        res = fn()
+        self.timings[name] = time.perf_counter() - t0
+        return res
+
+    def run(self, fixed_path, moving_path, name=None):
+        """ Registers the moving to the fixed volume (paths or SimpleITK images), returns the composed transform,
+        the results are named after the moving volume unless a name is given """
+        self.timings = dict()
+        fixed_volume, moving_volume = self._stage('read', lambda: (_read_volume(fixed_path), _read_volume(moving_path)))
+        fixed_float, moving_float = _as_float(fixed_volume), _as_float(moving_volume)
+
+        rigid = self._stage('rigid', lambda: registeration_rigid(fixed_float, moving_float))
+        write = self.output_dir is not None and isinstance(moving_path, str)
+        if write and self.write_intermediate:
+            self._stage('write_intermediate', lambda: _write_result(rigid, fixed_volume, moving_volume, moving_path,
+                                                                    self.output_dir, self.interpolator, 'rigid',
+                                                                    name))
+        transform = self._stage('affine', lambda: registration_affine(fixed_float, moving_float,
+                                                                      initial_transform=rigid, **self.affine_args))
+        if write:
+            self._stage('resample_write', lambda: _write_result(transform, fixed_volume, moving_volume, moving_path,
+                                                                self.output_dir, self.interpolator, name=name))
+        self.timings['total'] = sum(self.timings.values())
+        return transform
+
+
+def registration_rigid_affine(fixed_path, moving_path, output_dir=None):
+    """ Rigid registration using ANTsPy followed by the affine registration, returns the composed transform """
+    return RegistrationPipeline(output_dir).run(fixed_path, moving_path)
+
+
+def _unique_names(paths):
+    """ Names of the results of each moving volume: its file name, with the index of the pair for duplicate names """
+    stems = list(_stem(p) for p in paths)
+    return list(stem if stems.count(stem) == 1 else f"{stem}_{i}" for i, stem in enumerate(stems))
+
+
+def registration_batch(pairs, output_dir: str, workers: int = 1, write_intermediate=False):
+    """
+    Runs the rigid and affine registration for many subjects, pairs is a list of (fixed_path, moving_path).
+    Writes the composed transform and the registered moving volume of each subject to output_dir, named after the
+    moving volume (with the index of the pair if several moving volumes share a file name),
+    the subjects are processed by a pool of worker processes, both registrations are multithreaded themselves.
+    A subject which fails does not stop the others, the timings and errors of each subject are written to timings.csv
+    in output_dir
+    Returns the paths of the written transforms, None for subjects which failed
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    names = _unique_names(list(m for _, m in pairs))
+    jobs = list((f, m, output_dir, write_intermediate, name) for (f, m), name in zip(pairs, names))
+    if workers <= 1:
+        timings = list(_register_subject(*job) for job in jobs)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            futures = list(ex.submit(_register_subject, *job) for job in jobs)
+            timings = list(_subject_result(f) for f in futures)
+
+    paths = list()
+    keys = list()
+    for t in timings:
+        keys.extend(k for k in t if k not in keys + ['error'])
+    with open(os.path.join(output_dir, 'timings.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['fixed', 'moving', 'transform'] + keys + ['error'])
+        writer.writeheader()
+        for (fixed_path, moving_path), name, t in zip(pairs, names, timings):
+            path = None if t.get('error') else os.path.join(output_dir, f"affine_{name}.tfm")
+            if path is None:
+                print(f"Failed to register {moving_path}: {t['error']}")
+            paths.append(path)
+            writer.writerow(dict(t, fixed=fixed_path, moving=moving_path, transform=path or ''))
+    return paths
+
 
+def _subject_result(future):
+    """ Timings of a subject of the pool, errors of the pool itself, e.g. a worker which died, are returned as well """
+    try:
+        return future.result()
+    except Exception as e:
+        return dict(error=f"{type(e).__name__}: {e}")
 
-def registration_affine(fixed_path: str, moving_path: str, output_dir: str):
-    """ Affine registration using the NiftyReg package """
-    fixed_volume = sitk.ReadImage(fixed_path)
-    moving_volume = sitk.ReadImage(moving_path)
-    with tempfile.TemporaryDirectory(dir=output_dir) as temp_dir:
-        fixed_temp = os.path.join(temp_dir, f"fixed_volume.nii.gz")
-        moving_temp = os.path.join(temp_dir, f"moving_volume.nii.gz")
-        sitk.WriteImage(fixed_volume, fixed_temp)
-        sitk.WriteImage(moving_volume, moving_temp)
-        output_name = os.path.join(output_dir, os.path.basename(fixed_path))
-        output_name = f"affine_{output_name}"
 
-        # Perform registration
-        os.system(f"niftyreg aladin.exe -ref {fixed_temp} -flo {moving_temp} -res {output_name}")
+def _register_subject(fixed_path: str, moving_path: str, output_dir: str, write_intermediate: bool, name=None):
+    """ Worker of registration_batch, the transform is written and the timings (or the error) are returned to the
+    main process """
+    pipeline = RegistrationPipeline(output_dir, write_intermediate=write_intermediate)
+    try:
+        pipeline.run(fixed_path, moving_path, name=name)
+    except Exception as e:
+        return dict(pipeline.timings, error=f"{type(e).__name__}: {e}")
+    return pipeline.timings
 
 
 if __name__ == '__main__':
     fixed = r"path to fixed image"
     moving = r"path to moving image"
     output_folder = r"folder to store output file"
-    registeration_rigid(
+    registration_rigid_affine(
         fixed_path=fixed,
         moving_path=moving,
         output_dir=output_folder
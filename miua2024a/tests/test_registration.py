@@ -0,0 +1,115 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+pytest.importorskip('ants')
+
+from miua2024a.registration import (RegistrationPipeline, registeration_rigid, registration_affine,
+                                    registration_batch)
+
+_offset = (3.0, -2.0, 1.5)
+
+
+def _volume() -> sitk.Image:
+    """ a few blobs of different intensities, which have a unique alignment """
+    rng = np.random.default_rng(0)
+    z, y, x = np.mgrid[:40, :44, :48].astype(np.float32)
+    arr = np.zeros(z.shape, dtype=np.float32)
+    for center, sigma, value in zip(rng.uniform(10, 30, size=(6, 3)), rng.uniform(2, 5, size=6), (100, 200, 300) * 2):
+        arr += value * np.exp(-((z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2) / (2 * sigma ** 2))
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([1.2, 1.0, 1.5])
+    img.SetOrigin([-20.0, 10.0, 5.0])
+    return img
+
+
+def _pair(tmp_path, name='moving.nrrd'):
+    """ writes the fixed and moving volume, which the translation by _offset maps the fixed points onto """
+    fixed = _volume()
+    moving = sitk.Resample(fixed, fixed, sitk.TranslationTransform(3, list(-o for o in _offset)), sitk.sitkLinear)
+    paths = list()
+    for img, path in ((fixed, tmp_path / 'fixed.nrrd'), (moving, tmp_path / name)):
+        path.parent.mkdir(exist_ok=True)
+        sitk.WriteImage(img, str(path))
+        paths.append(str(path))
+    return paths
+
+
+def _assert_offset(transform, volume, tol=1.0):
+    center = volume.TransformContinuousIndexToPhysicalPoint(list((s - 1) / 2 for s in volume.GetSize()))
+    assert np.allclose(np.subtract(transform.TransformPoint(center), center), _offset, atol=tol)
+
+
+def test_registeration_rigid(tmp_path):
+    fixed_path, moving_path = _pair(tmp_path)
+    out = tmp_path / 'out'
+    out.mkdir()
+    tf = registeration_rigid(fixed_path, moving_path, output_dir=str(out))
+    _assert_offset(tf, sitk.ReadImage(fixed_path))
+    # the rigidly registered volume is written to output_dir
+    assert os.listdir(out) == ['rigid_moving.nrrd']
+    registeration_rigid(sitk.ReadImage(fixed_path), sitk.ReadImage(moving_path))
+    assert os.listdir(out) == ['rigid_moving.nrrd']
+    with pytest.raises(ValueError):
+        registeration_rigid(fixed_path, sitk.ReadImage(moving_path), output_dir=str(out))
+
+
+def test_registration_affine_order():
+    fixed = _volume()
+    initial = sitk.Euler3DTransform([0.0, 10.0, 5.0], 0.1, -0.05, 0.2, [1.0, 2.0, 3.0])
+    transform = registration_affine(fixed, fixed, initial_transform=initial, iterations=5)
+    assert transform.GetNumberOfTransforms() == 2
+    affine = transform.GetNthTransform(1)
+    # the fixed points are mapped by the affine transform first, then by the initial transform
+    for p in ([0.0, 0.0, 0.0], [-15.0, 20.0, 30.0]):
+        assert np.allclose(transform.TransformPoint(p), initial.TransformPoint(affine.TransformPoint(p)), atol=1e-9)
+        assert np.allclose(transform.GetNthTransform(0).TransformPoint(p), initial.TransformPoint(p), atol=1e-9)
+
+
+@pytest.mark.parametrize('write_intermediate', [False, True])
+def test_registration_pipeline(tmp_path, write_intermediate):
+    fixed_path, moving_path = _pair(tmp_path)
+    out = tmp_path / 'out'
+    out.mkdir()
+    pipeline = RegistrationPipeline(str(out), write_intermediate=write_intermediate)
+    transform = pipeline.run(fixed_path, moving_path)
+    fixed = sitk.ReadImage(fixed_path)
+    _assert_offset(transform, fixed)
+
+    expected = ['affine_moving.nrrd', 'affine_moving.tfm']
+    if write_intermediate:
+        expected += ['rigid_moving.nrrd', 'rigid_moving.tfm']
+    assert sorted(os.listdir(out)) == expected
+    _assert_offset(sitk.ReadTransform(str(out / 'affine_moving.tfm')), fixed)
+    assert sorted(pipeline.timings) == sorted(['read', 'rigid', 'affine', 'resample_write', 'total']
+                                              + (['write_intermediate'] if write_intermediate else []))
+    assert pipeline.timings['total'] == pytest.approx(sum(v for k, v in pipeline.timings.items() if k != 'total'))
+
+    # images are registered in memory without writing
+    pipeline = RegistrationPipeline(str(tmp_path / 'missing'))
+    _assert_offset(pipeline.run(fixed, sitk.ReadImage(moving_path)), fixed)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_registration_batch(tmp_path, workers):
+    pairs = list()
+    for folder in ('a', 'b'):
+        pairs.append(tuple(_pair(tmp_path / folder)))
+    pairs.append((pairs[0][0], str(tmp_path / 'missing.nrrd')))
+    out = tmp_path / 'out'
+    paths = registration_batch(pairs, str(out), workers=workers)
+    # the moving volumes sharing a file name are told apart by the index of their pair
+    assert paths == [str(out / 'affine_moving_0.tfm'), str(out / 'affine_moving_1.tfm'), None]
+    for path in paths[:2]:
+        _assert_offset(sitk.ReadTransform(path), _volume())
+
+    with open(out / 'timings.csv', newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert list(r['moving'] for r in rows) == list(m for _, m in pairs)
+    assert list(r['transform'] for r in rows) == list(p or '' for p in paths)
+    # the failed subject does not stop the others
+    assert list(bool(r['error']) for r in rows) == [False, False, True]
+    assert float(rows[0]['total']) > 0
@@ -0,0 +1,326 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import sys
+import traceback
+from functools import lru_cache
+from time import time
+from typing import Optional
+
+from miua2024b.source.cache import PointCache
+from miua2024b.source.lazy import lazy_import
+from miua2024b.source.main import read_segmentation, segmentation_key, snapshot_path, symmetric_paths
+from miua2024b.source.pool import IsolatingPool
+from miua2024b.source.profiling import profile, stage, write_outputs
+from miua2024b.source.registration import is_suspicious, register_points_affine, register_points_symmetric
+from miua2024b.source.resample import resample_image
+from miua2024b.source.roi import label_extent
+from miua2024b.source.snapshot import write_snapshot
+from miua2024b.source.transform import evaluate_transforms
+from miua2024b.source.util import default, transform_from_affine, get_center
+
+sitk = lazy_import('SimpleITK')
+
+_manifest_keys = ['fixed', 'moving', 'output', 'truth', 'warped']
+_result_keys = ['index', 'fixed', 'moving', 'output', 'status', 'attempts',
+                't_read', 't_register', 't_write', 't_total', 'icp_steps', 'fitness', 'inlier_rmse',
+                'fitness_inverse', 'inlier_rmse_inverse', 'consistency_error', 'consistency_max', 'suspicious',
+                'trans_err', 'rot_err', 'error']
+
+
+def read_manifest(path: str) -> list:
+    """
+    reads a manifest of registration jobs from a .csv or .json file
+    each job has the entries 'fixed', 'moving' and 'output' and optionally 'truth' and 'warped'
+    relative paths are resolved against the folder of the manifest
+    :param path: path to the manifest, a .csv file with a header row or a .json file with a list of objects
+    :return: list of jobs
+    """
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, newline='') as f:
+        if ext == '.json':
+            entries = json.load(f)
+        elif ext == '.csv':
+            entries = list(csv.DictReader(f))
+        else:
+            raise RuntimeError("Unsupported manifest format: {}".format(ext))
+
+    root = os.path.dirname(os.path.abspath(path))
+    jobs = list()
+    for idx, entry in enumerate(entries):
+        missing = list(k for k in _manifest_keys[:3] if not entry.get(k))
+        if missing:
+            raise RuntimeError("Manifest entry {} is missing: {}".format(idx, ", ".join(missing)))
+        job = dict((k, os.path.join(root, entry[k]) if entry.get(k) else None) for k in _manifest_keys)
+        job['index'] = idx
+        jobs.append(job)
+    return jobs
+
+
+@lru_cache(maxsize=4)
+def _read_fixed(img_path: str, mtime_ns: int, binary: bool, cache_dir: Optional[str], cache_size: float,
+                use_cache: bool, dtype: str, grid: Optional[float]=None):
+    """
+    cached reading of the fixed segmentation, pairs sharing a fixed image reuse its point cloud within a process,
+    the modification time is part of the key, so that long-lived processes (see worker.py) read changed files again
+    """
+    cache = PointCache(cache_dir, max_size=int(cache_size * 2**30), enabled=use_cache)
+    return read_segmentation(img_path, binary=binary, cache=cache, dtype=dtype, grid=grid)
+
+
+@lru_cache(maxsize=4)
+def _fixed_key(img_path: str, mtime_ns: int, binary: bool, dtype: str, grid: Optional[float]=None):
+    """
+    cached cache key of the fixed segmentation, which avoids hashing the file for each pair
+    """
+    return segmentation_key(img_path, binary, dtype, grid)
+
+
+def run_job(job: dict, binary=False, search_mm: float=1.0, fine_mm: float=1.5,
+            cache_dir: Optional[str]=None, cache_size: float=4.0, use_cache=True,
+            icp_steps: int=1000, icp_tol: Optional[float]=None, icp_levels: Optional[list]=None,
+            ransac_seeds: Optional[list]=None, ransac_scales: Optional[list]=None, ransac_fpfh: Optional[list]=None,
+            ransac_workers: Optional[int]=None, ransac_budget: Optional[float]=None, downsampling='pcu',
+            warped_interpolator: Optional[str]=None, dtype='float64', symmetric=False,
+            max_consistency: float=1.0, min_fitness: float=0.1, snapshot=False,
+            point_grid: Optional[float]=None) -> dict:
+    """
+    registers a single pair of a manifest, same as main.run but returns the timings and metrics instead of printing
+    symmetric registrations write the inverse transform and quality record next to the output, see main.symmetric_paths,
+    and flag the pair as 'suspicious'. retries of a job (its 'attempt' entry) shift the RANSAC seeds, so that a
+    suspicious pair is registered with other hypotheses. with snapshot, a QC image is written next to the output,
+    see main.snapshot_path
+    :param job: manifest entry, see read_manifest
+    :return: dictionary with the timings in seconds, the quality of symmetric registrations and,
+    if a truth transform is specified, the errors
+    """
+    res = dict()
+    t0 = time()
+    cache = PointCache(cache_dir, max_size=int(cache_size * 2**30), enabled=use_cache)
+    mtime_ns = os.stat(job['fixed']).st_mtime_ns
+    fixed_img, fixed = _read_fixed(job['fixed'], mtime_ns, binary, cache_dir, cache_size, use_cache, dtype, point_grid)
+    moving_img, moving = read_segmentation(job['moving'], binary=binary, cache=cache, dtype=dtype, grid=point_grid)
+    cache_keys = None
+    if cache.enabled:
+        cache_keys = (_fixed_key(job['fixed'], mtime_ns, binary, dtype, point_grid),
+                      segmentation_key(job['moving'], binary, dtype, point_grid))
+    if ransac_seeds is not None and job.get('attempt'):
+        ransac_seeds = list(seed + job['attempt'] * len(ransac_seeds) for seed in ransac_seeds)
+    t1 = time()
+    kwargs = dict(spacing_search=search_mm, spacing_refine=fine_mm, cache=cache,
+                  icp_steps=icp_steps, icp_tol=icp_tol, icp_levels=icp_levels,
+                  ransac_seeds=ransac_seeds, ransac_scales=ransac_scales, ransac_fpfh=ransac_fpfh,
+                  ransac_workers=ransac_workers, ransac_budget=ransac_budget, downsampling=downsampling)
+    if symmetric:
+        tf, tf_inv, info = register_points_symmetric(fixed, moving, cache_keys=cache_keys, **kwargs)
+        info['suspicious'] = is_suspicious(info, max_consistency=max_consistency, min_fitness=min_fitness)
+    else:
+        tf, info = register_points_affine(fixed, moving, cache_keys=cache_keys, return_info=True, **kwargs)
+    res.update(info)
+    t2 = time()
+
+    tf = transform_from_affine(tf)
+    sitk.WriteTransform(tf, job['output'])
+    if symmetric:
+        inverse_path, quality_path = symmetric_paths(job['output'])
+        sitk.WriteTransform(transform_from_affine(tf_inv), inverse_path)
+        with open(quality_path, 'w') as f:
+            json.dump(info, f, indent=2)
+    if snapshot:
+        write_snapshot(snapshot_path(job['output']), source=fixed, target=moving, tf=tf)
+    if job.get('warped'):
+        with stage('warp'):
+            resample_image(moving_img, fixed_img, tf, output_path=job['warped'], interpolator=warped_interpolator,
+                           labels=True, extent=label_extent(moving_img))
+    t3 = time()
+
+    if job.get('truth'):
+        tf_truth = sitk.ReadTransform(job['truth'])
+        res['trans_err'], res['rot_err'] = evaluate_transforms(pred=tf, truth=tf_truth, ref=get_center(fixed_img))
+
+    res.update(t_read=t1 - t0, t_register=t2 - t1, t_write=t3 - t2)
+    return res
+
+
+def _run_job_safe(job: dict, kwargs: dict):
+    """
+    runs a job and catches any exception, as they are passed back to the scheduler as part of the result
+    if kwargs contains profile=True, the profiling events of the job are added to the result as 'profile'
+    """
+    kwargs = dict(kwargs)
+    try:
+        with profile(enabled=kwargs.pop('profile', False)) as prof:
+            res = run_job(job, **kwargs)
+        if prof is not None:
+            res['profile'] = list(dict(e, job=job['index']) for e in prof.events)
+        return job['index'], res, None
+    except Exception:
+        return job['index'], None, traceback.format_exc()
+
+
+def run_batch(jobs: list, workers: int=1, timeout: Optional[float]=None, retries: int=0, **kwargs) -> list:
+    """
+    registers the pairs of a manifest using a pool of worker processes
+    jobs are ordered by their fixed image so that pairs sharing the fixed image are likely run by the same worker
+    which can then reuse the cached point cloud.
+    a job which exceeds the timeout causes the pool to be restarted, jobs interrupted by a restart are rescheduled
+    without counting as an attempt. a worker which dies, e.g., by a segfault or the OOM killer, fails its job with
+    the exit code, if several jobs were in flight they are rerun one at a time to find the job which crashed it
+    :param jobs: list of jobs, see read_manifest
+    :param workers: number of worker processes, for 0 the jobs are run sequentially in this process (without timeout)
+    :param timeout: maximum duration of a single job in seconds
+    :param retries: how often to retry a job which failed, timed out or, for symmetric registrations, is suspicious,
+    the result of the last attempt is kept
+    :param kwargs: parameters passed to run_job, e.g., binary, search_mm, fine_mm or cache_dir,
+    profile=True adds the profiling events of each job to its result
+    :return: list of results, one dictionary per job in the order of the jobs
+    """
+    results = dict((job['index'], dict(job, status='pending', attempts=0)) for job in jobs)
+    pending = sorted(jobs, key=lambda j: (j['fixed'], j['index']))
+
+    def _complete(idx, res, err, t_total):
+        r = results[idx]
+        r['attempts'] += 1
+        r['t_total'] = t_total
+        if err is None and res.get('suspicious'):
+            r.update(res, status='suspicious', error=None)
+            print("Job {} is suspicious (attempt {}): consistency error: {:.3f} mm, fitness: {:.3f}/{:.3f}".format(
+                idx, r['attempts'], res['consistency_error'], res['fitness'], res['fitness_inverse']))
+            return r['attempts'] > retries
+        if err is None:
+            r.update(res, status='ok', error=None)
+            return True
+        r.update(status='failed', error=err.strip().splitlines()[-1])
+        print("Job {} failed (attempt {}): {}".format(idx, r['attempts'], r['error']))
+        return r['attempts'] > retries
+
+    def _retry(job):
+        # the attempt is passed to the job, see run_job
+        return dict(job, attempt=results[job['index']]['attempts'])
+
+    if workers <= 0:
+        for job in pending:
+            while True:
+                t0 = time()
+                idx, res, err = _run_job_safe(job, kwargs)
+                if _complete(idx, res, err, time() - t0):
+                    break
+                job = _retry(job)
+        return list(results[job['index']] for job in jobs)
+
+    # the number of jobs in flight never exceeds the number of workers, so a job starts when submitted.
+    # the workers may have children, the hypotheses of a multi-seed RANSAC are run sequentially unless set otherwise
+    kwargs = dict(kwargs, ransac_workers=default(kwargs.get('ransac_workers'), 0))
+    pool = IsolatingPool(workers)
+    pending = list(reversed(pending))
+    try:
+        while pending or pool.running:
+            while pending and pool.can_submit(pending[-1]['index']):
+                job = pending.pop()
+                pool.submit(job['index'], job, _run_job_safe, job, kwargs)
+
+            wait_time = None
+            if timeout is not None:
+                wait_time = max(0.0, min(t0 for _, _, t0 in pool.running.values()) + timeout - time())
+            finished, rerun = pool.wait(wait_time)
+            if not finished and not rerun:
+                # stop the pool to stop the expired jobs, the others are rescheduled
+                now = time()
+                for job, t0 in pool.stop():
+                    if now - t0 >= timeout:
+                        err = "TimeoutError: job exceeded {:.1f} seconds".format(timeout)
+                        if not _complete(job['index'], None, err, now - t0):
+                            pending.append(_retry(job))
+                    else:
+                        pending.append(job)
+                continue
+
+            for job, t0, res, err in finished:
+                # a job which crashed its worker has no result, see pool.IsolatingPool
+                idx, res, err = res if err is None else (job['index'], None, err)
+                if not _complete(idx, res, err, time() - t0):
+                    pending.append(_retry(job))
+            if rerun:
+                print("A worker died while running jobs {}, they are run alone to find the cause".format(
+                    ", ".join(str(job['index']) for job, _ in rerun)))
+                pending.extend(job for job, _ in rerun)
+    finally:
+        pool.shutdown()
+    return list(results[job['index']] for job in jobs)
+
+
+def write_results(results: list, path: str):
+    """
+    writes the results of a batch run as a .csv table
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=_result_keys, extrasaction='ignore')
+        writer.writeheader()
+        for r in results:
+            writer.writerow(r)
+
+
+def entry_point():
+    parser = argparse.ArgumentParser(description='Batch registration of cerebral vasculature for a manifest of image pairs.')
+    parser.add_argument('--manifest', dest='manifest', type=str, required=True, help="Manifest of the pairs to register, a .csv or .json file with the entries: fixed, moving, output and optionally truth and warped")
+    parser.add_argument('--results', dest='results', type=str, required=True, help="Output path for the .csv table of per-pair timings, errors and metrics")
+    parser.add_argument('--workers', dest='workers', type=int, default=os.cpu_count(), help="Number of worker processes, 0 runs all pairs sequentially in the main process")
+    parser.add_argument('--timeout', dest='timeout', type=float, default=None, help="Maximum duration of a single registration in seconds")
+    parser.add_argument('--retries', dest='retries', type=int, default=0, help="How often to retry a registration which failed, timed out or, with --symmetric, is suspicious")
+    parser.add_argument('--binary', dest='binary', action='store_true', help="Whether to mask all lables instead of extracting the left and right labels predicted by model theta m")
+    parser.add_argument('--search', dest='search', type=float, default='1.5', help="Resolution for the global RANSAC registration (in mm for the poison disk radius)")
+    parser.add_argument('--fine', dest='fine', type=float, default='1.0', help="Resolution for the fine ICP registration (in mm for the poison disk radius)")
+    parser.add_argument('--cache', dest='cache', type=str, default=None, help="Folder to cache converted volumes, downsampled point clouds and features in, defaults to the MIUA2024B_CACHE environment variable")
+    parser.add_argument('--cache-size', dest='cache_size', type=float, default=4.0, help="Maximum size of the cache in GB, the least recently used entries are evicted")
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', help="Whether to disable the cache")
+    parser.add_argument('--icp-steps', dest='icp_steps', type=int, default=1000, help="Number of ICP runs per resolution level")
+    parser.add_argument('--icp-tol', dest='icp_tol', type=float, default=None, help="Tolerance (in mm) for the adaptive ICP schedule, which skips ahead once the transform converged, by default all steps are run")
+    parser.add_argument('--icp-pyramid', dest='icp_pyramid', type=float, nargs='*', default=None, help="Coarser resolutions (in mm for the poison disk radius) to run ICP on before the fine resolution")
+    parser.add_argument('--ransac-seeds', dest='ransac_seeds', type=int, default=None, help="Number of seeds for multiple global registration hypotheses run concurrently, the best one is selected after a short ICP refinement")
+    parser.add_argument('--ransac-scales', dest='ransac_scales', type=float, nargs='*', default=None, help="Voxel sizes of the global registration hypotheses relative to the search resolution, e.g., 1.0 1.5")
+    parser.add_argument('--ransac-fpfh', dest='ransac_fpfh', type=float, nargs='*', default=None, help="FPFH feature radii of the global registration hypotheses relative to the voxel size, e.g., 5 7.5")
+    parser.add_argument('--ransac-workers', dest='ransac_workers', type=int, default=None, help="Number of worker processes for the global registration hypotheses")
+    parser.add_argument('--ransac-budget', dest='ransac_budget', type=float, default=None, help="Wall-clock limit in seconds for the global registration hypotheses")
+    parser.add_argument('--downsampling', dest='downsampling', type=str, default='pcu', choices=['pcu', 'poisson', 'voxel'], help="Method to downsample the point clouds with, the point_cloud_utils Poisson-disk sampling (default), the grid-based Poisson-disk sampling or voxel sampling")
+    parser.add_argument('--warped-interpolator', dest='warped_interpolator', type=str, default=None, choices=['nearest', 'label_gaussian', 'linear', 'bspline'], help="Interpolator for the warped images, defaults to nearest neighbour")
+    parser.add_argument('--dtype', dest='dtype', type=str, default='float64', choices=['float32', 'float64'], help="Floating point type of the point clouds, float32 halves their memory")
+    parser.add_argument('--point-grid', dest='point_grid', type=float, default=None, help="Grid spacing (in mm) to subsample the point clouds with while they are extracted, one point per occupied cell, by default all voxels are kept")
+    parser.add_argument('--symmetric', dest='symmetric', action='store_true', help="Whether to register each pair in both directions and check the inverse consistency, the inverse transforms and quality records are written next to the outputs")
+    parser.add_argument('--max-consistency', dest='max_consistency', type=float, default=1.0, help="Consistency error (in mm) above which a symmetric registration is flagged as suspicious")
+    parser.add_argument('--min-fitness', dest='min_fitness', type=float, default=0.1, help="Fitness below which a symmetric registration is flagged as suspicious")
+    parser.add_argument('--snapshots', dest='snapshots', action='store_true', help="Whether to write a QC image (.png) of the point clouds before and after the registration next to each output")
+    parser.add_argument('--profile', dest='profile', type=str, default="", help="Output path for the timings and values of each stage of each pair, a .json or .csv file")
+    parser.add_argument('--trace', dest='trace', type=str, default="", help="Output path for a Chrome trace file of the stages, each pair is shown as a process")
+    args, _ = parser.parse_known_args(args=sys.argv)
+
+    jobs = read_manifest(args.manifest)
+    print(f"Registering {len(jobs)} pairs using {args.workers} workers...")
+    t0 = time()
+    results = run_batch(jobs, workers=args.workers, timeout=args.timeout, retries=args.retries,
+                        binary=args.binary, search_mm=args.search, fine_mm=args.fine,
+                        cache_dir=args.cache, cache_size=args.cache_size, use_cache=not args.no_cache,
+                        icp_steps=args.icp_steps, icp_tol=args.icp_tol, icp_levels=args.icp_pyramid,
+                        ransac_seeds=None if args.ransac_seeds is None else list(range(args.ransac_seeds)),
+                        ransac_scales=args.ransac_scales, ransac_fpfh=args.ransac_fpfh,
+                        ransac_workers=args.ransac_workers, ransac_budget=args.ransac_budget,
+                        downsampling=args.downsampling, warped_interpolator=args.warped_interpolator, dtype=args.dtype,
+                        symmetric=args.symmetric, max_consistency=args.max_consistency, min_fitness=args.min_fitness,
+                        snapshot=args.snapshots, point_grid=args.point_grid,
+                        profile=bool(args.profile or args.trace))
+    n_ok = sum(r['status'] == 'ok' for r in results)
+    print("Finished {}/{} registrations in {:.2f} seconds!".format(n_ok, len(results), time() - t0))
+    n_suspicious = sum(r['status'] == 'suspicious' for r in results)
+    if n_suspicious:
+        print("{} registrations are suspicious, see the consistency_error and fitness in the results".format(n_suspicious))
+    write_results(results, args.results)
+    print(f"Finished writing results to: {args.results}")
+    if args.profile or args.trace:
+        events = list(e for r in results for e in r.get('profile', []))
+        write_outputs(events, profile_path=args.profile, trace_path=args.trace)
+
+
+if __name__ == '__main__':
+    entry_point()
@@ -0,0 +1,219 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from time import time, process_time
+from typing import Optional
+
+_resource_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'resource'))
+_default_fixed = os.path.join(_resource_dir, 'IXI002-PD.seg.nrrd')
+_default_moving = os.path.join(_resource_dir, 'IXI002-TOF.seg.nrrd')
+_default_truth = os.path.join(_resource_dir, 'IXI002-truth.tfm')
+_root_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+# commands of a fresh interpreter to measure the startup time of
+_startup_commands = {
+    'python': ['-c', 'pass'],
+    'import.main': ['-c', 'import miua2024b.source.main'],
+    'import.libraries': ['-c', 'import miua2024b.source.main, SimpleITK, open3d'],
+    'cli.help': ['-m', 'miua2024b.source.main', '--help'],
+    'worker.client': ['-m', 'miua2024b.source.worker', '--help'],
+}
+
+
+def peak_rss() -> Optional[int]:
+    """
+    returns the peak resident set size of this process in bytes, or None if not supported by the platform
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_config(fixed_img_path: str, moving_img_path: str, truth_path: Optional[str]=None,
+               search_mm: float=1.5, fine_mm: float=1.0, binary=False, icp_tol: Optional[float]=None,
+               downsampling='pcu', dtype='float64', memory=False, cache_dir: Optional[str]=None, **kwargs) -> dict:
+    """
+    runs the registration with main.run (including writing the transform and the warped image) and reports the
+    stages recorded by the profiler, see profiling.profile
+    :param dtype: floating point type of the point clouds
+    :param memory: whether to trace the peak memory of the python and numpy allocations of the run, which slows it
+    down, the memory of open3d is not traced
+    :param cache_dir: folder of the cache to use, by default the cache is disabled so that each run starts cold
+    :param kwargs: further parameters of main.run, e.g., icp_levels or ransac_seeds
+    :return: dictionary with the wall and cpu time and the number of calls of each stage by name ('stages'), the
+    profiling 'events', point counts ('points'), the bytes of the full resolution point arrays ('point_bytes'), the ICP
+    'icp_steps', 'fitness' and 'inlier_rmse', the 'total' wall and cpu time (and traced peak memory in bytes),
+    the peak RSS in bytes and, if a truth transform is specified, the translation (mm) and rotation (degrees) errors
+    """
+    import numpy as np
+    import SimpleITK as sitk
+    from miua2024b.source.main import run
+    from miua2024b.source.profiling import profile
+    from miua2024b.source.transform import evaluate_transforms
+    from miua2024b.source.util import get_center
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dest_path = os.path.join(tmp_dir, 'transform.tfm')
+        if memory:
+            tracemalloc.start()
+        t0, c0 = time(), process_time()
+        with profile() as prof, contextlib.redirect_stdout(io.StringIO()):
+            run(fixed_img_path, moving_img_path, dest_path, truth_path=truth_path,
+                warped_path=os.path.join(tmp_dir, 'warped.nrrd'), binary=binary, search_mm=search_mm,
+                fine_mm=fine_mm, cache_dir=cache_dir, use_cache=cache_dir is not None, icp_tol=icp_tol,
+                downsampling=downsampling, dtype=dtype, **kwargs)
+        values = dict(total=dict(wall=time() - t0, cpu=process_time() - c0))
+        if memory:
+            values['total']['memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        tf = sitk.ReadTransform(dest_path)
+
+    stages = dict()
+    for e in prof.events:
+        s = stages.setdefault(e['name'], dict(wall=0.0, cpu=0.0, calls=0))
+        s.update(wall=s['wall'] + e['wall'], cpu=s['cpu'] + e['cpu'], calls=s['calls'] + 1)
+    events = list(dict((k, e[k]) for k in ('name', 'depth', 'start', 'wall', 'cpu', 'values')) for e in prof.events)
+
+    # the segmentations are read fixed first, the downsampled point counts are reported per radius
+    counts = list(e['values']['points'] for e in prof.events if e['name'] == 'read_segmentation')
+    values['points'] = dict(zip(('fixed', 'moving'), counts))
+    values['point_bytes'] = dict((k, n * 3 * np.dtype(dtype).itemsize) for k, n in values['points'].items())
+    for e in prof.events:
+        if e['name'] == 'downsample_points':
+            values['points'].setdefault('downsampled.{}'.format(e['values']['radius']), list()).append(
+                e['values']['points_out'])
+    icp = list(e['values'] for e in prof.events if e['name'] == 'register_points_icp')
+    steps = list(e['values']['icp_steps'] for e in prof.events if 'icp_steps' in e['values'])
+    values.update(icp_steps=steps[-1] if steps else None, fitness=icp[-1]['fitness'] if icp else None,
+                  inlier_rmse=icp[-1]['inlier_rmse'] if icp else None)
+
+    if truth_path:
+        fixed_img = sitk.ReadImage(fixed_img_path)
+        values['trans_err'], values['rot_err'] = evaluate_transforms(pred=tf, truth=sitk.ReadTransform(truth_path),
+                                                                     ref=get_center(fixed_img))
+    values['peak_rss'] = peak_rss()
+    values['stages'] = stages
+    values['events'] = events
+    return values
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        res = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True)
+    except OSError:
+        return None
+    return res.stdout.strip() if res.returncode == 0 else None
+
+
+def measure_startup(repeats: int=5) -> dict:
+    """
+    measures the startup time of the command line tools, each command is run repeatedly in a fresh interpreter
+    :return: dictionary with the median and minimum wall time in seconds of each command, see _startup_commands
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (_root_dir, os.environ.get('PYTHONPATH')) if p))
+    res = dict()
+    for name, args in _startup_commands.items():
+        times = list()
+        for _ in range(repeats):
+            t0 = time()
+            subprocess.run([sys.executable] + args, env=env, capture_output=True, check=True)
+            times.append(time() - t0)
+        res[name] = dict(median=sorted(times)[len(times) // 2], min=min(times))
+    return res
+
+
+def run_benchmark(fixed_img_path: str=_default_fixed, moving_img_path: str=_default_moving,
+                  truth_path: Optional[str]=_default_truth, search_mm=(1.5, ), fine_mm=(1.0, ), repeats: int=1,
+                  binary=False, icp_tol: Optional[float]=None, downsampling=('pcu', ), dtype=('float64', ),
+                  memory=False, cache_dir: Optional[str]=None, **kwargs) -> dict:
+    """
+    benchmarks the registration for each combination of search and fine resolution, downsampling method and
+    floating point type, each run is executed in a fresh process so that the peak RSS is measured per run
+    :param search_mm: resolutions for the global RANSAC registration to test
+    :param fine_mm: resolutions for the fine ICP registration to test
+    :param downsampling: downsampling methods to test, see points.downsample_indices
+    :param dtype: floating point types of the point clouds to test, e.g., ('float64', 'float32')
+    :param memory: whether to trace the peak memory of each run, see run_config
+    :param repeats: number of runs per combination
+    :param cache_dir: folder of the cache to use, see run_config
+    :param kwargs: further parameters of main.run, e.g., icp_levels or ransac_seeds
+    :return: dictionary with the environment ('meta') and a list of 'runs'
+    """
+    meta = dict(commit=_git_commit(), timestamp=datetime.now().isoformat(timespec='seconds'),
+                python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count(),
+                fixed=fixed_img_path, moving=moving_img_path, truth=truth_path, binary=binary, icp_tol=icp_tol,
+                memory=memory, cache=cache_dir, **kwargs)
+    runs = list()
+    ctx = mp.get_context('spawn')
+    for search, fine, method, point_type in itertools.product(search_mm, fine_mm, downsampling, dtype):
+        for rep in range(repeats):
+            print("Benchmarking search: {} mm, fine: {} mm, downsampling: {}, dtype: {} (run {}/{})...".format(
+                search, fine, method, point_type, rep + 1, repeats))
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as ex:
+                res = ex.submit(run_config, fixed_img_path, moving_img_path, truth_path, search_mm=search,
+                                fine_mm=fine, binary=binary, icp_tol=icp_tol, downsampling=method,
+                                dtype=point_type, memory=memory, cache_dir=cache_dir, **kwargs).result()
+            runs.append(dict(search_mm=search, fine_mm=fine, downsampling=method, dtype=point_type, repeat=rep, **res))
+    return dict(meta=meta, runs=runs)
+
+
+def entry_point():
+    parser = argparse.ArgumentParser(description='Benchmark of the registration method for cerebral vasculature.')
+    parser.add_argument('--output', dest='output', type=str, required=True, help="Output path for the .json results")
+    parser.add_argument('--fixed', dest='fixed', type=str, default=_default_fixed, help="Segmentation of vessels in the fixed image, defaults to the bundled IXI002 PD segmentation")
+    parser.add_argument('--moving', dest='moving', type=str, default=_default_moving, help="Segmentation of vessels in the moving image, defaults to the bundled IXI002 TOF segmentation")
+    parser.add_argument('--truth', dest='truth', type=str, default=_default_truth, help="Truth transform to evaluate against, defaults to the bundled IXI002 transform")
+    parser.add_argument('--search', dest='search', type=float, nargs='+', default=[1.5], help="Resolutions for the global RANSAC registration to test (in mm for the poison disk radius)")
+    parser.add_argument('--fine', dest='fine', type=float, nargs='+', default=[1.0], help="Resolutions for the fine ICP registration to test (in mm for the poison disk radius)")
+    parser.add_argument('--repeats', dest='repeats', type=int, default=1, help="Number of runs per combination of resolutions")
+    parser.add_argument('--binary', dest='binary', action='store_true', help="Whether to mask all lables instead of extracting the left and right labels predicted by model theta m")
+    parser.add_argument('--icp-tol', dest='icp_tol', type=float, default=None, help="Tolerance (in mm) for the adaptive ICP schedule, by default all steps are run")
+    parser.add_argument('--downsampling', dest='downsampling', type=str, nargs='+', default=['pcu'], choices=['pcu', 'poisson', 'voxel'], help="Downsampling methods to test, e.g., pcu poisson to compare the grid-based sampling against the point_cloud_utils implementation")
+    parser.add_argument('--dtype', dest='dtype', type=str, nargs='+', default=['float64'], choices=['float32', 'float64'], help="Floating point types of the point clouds to test, e.g., float64 float32 to compare their memory")
+    parser.add_argument('--icp-pyramid', dest='icp_pyramid', type=float, nargs='*', default=None, help="Coarser resolutions (in mm for the poison disk radius) to run ICP on before the fine resolution")
+    parser.add_argument('--ransac-seeds', dest='ransac_seeds', type=int, default=None, help="Number of seeds for multiple global registration hypotheses")
+    parser.add_argument('--cache', dest='cache', type=str, default=None, help="Folder of the cache to use, by default the cache is disabled so that each run starts cold")
+    parser.add_argument('--memory', dest='memory', action='store_true', help="Whether to trace the peak memory of the python and numpy allocations of each run, which slows it down")
+    parser.add_argument('--startup', dest='startup', action='store_true', help="Whether to also measure the startup time of the command line tools")
+    args, _ = parser.parse_known_args(args=sys.argv)
+
+    res = run_benchmark(fixed_img_path=args.fixed, moving_img_path=args.moving, truth_path=args.truth or None,
+                        search_mm=args.search, fine_mm=args.fine, repeats=args.repeats,
+                        binary=args.binary, icp_tol=args.icp_tol, downsampling=args.downsampling,
+                        dtype=args.dtype, memory=args.memory, cache_dir=args.cache, icp_levels=args.icp_pyramid,
+                        ransac_seeds=None if args.ransac_seeds is None else list(range(args.ransac_seeds)))
+    for r in res['runs']:
+        downsampling = r['stages'].get('downsample_points', dict(wall=0.0))['wall']
+        print("search: {} mm, fine: {} mm, downsampling: {} ({:.2f} s), dtype: {}: {:.2f} s, peak RSS: {} MB{}, translation error: {} mm, rotation error: {}°".format(
+            r['search_mm'], r['fine_mm'], r['downsampling'], downsampling, r['dtype'], r['total']['wall'],
+            None if r['peak_rss'] is None else r['peak_rss'] // 2**20,
+            '' if 'memory' not in r['total'] else ', traced peak: {:.1f} MB'.format(r['total']['memory'] / 2**20),
+            '-' if 'trans_err' not in r else '{:.2f}'.format(r['trans_err']),
+            '-' if 'rot_err' not in r else '{:.1f}'.format(r['rot_err'])))
+    if args.startup:
+        res['startup'] = measure_startup(repeats=max(args.repeats, 5))
+        for name, t in res['startup'].items():
+            print("startup {}: {:.3f} s (min: {:.3f} s)".format(name, t['median'], t['min']))
+    with open(args.output, 'w') as f:
+        json.dump(res, f, indent=2)
+    print(f"Finished writing results to: {args.output}")
+
+
+if __name__ == '__main__':
+    entry_point()
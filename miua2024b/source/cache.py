@@ -0,0 +1,134 @@
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+from typing import Optional, Callable
+
+import numpy as np
+
+from miua2024b.source.util import default
+
+_cache_env = 'MIUA2024B_CACHE'
+
+
+def file_hash(path: str, chunk_size: int=2**20) -> str:
+    """
+    returns the sha1 hash of a file's content, the hash is memoized per path, size and modification time,
+    so that the keys of several cache entries of a file only read it once
+    """
+    st = os.stat(path)
+    return _file_hash(os.path.abspath(path), st.st_size, st.st_mtime_ns, chunk_size)
+
+
+@lru_cache(maxsize=256)
+def _file_hash(path: str, size: int, mtime_ns: int, chunk_size: int) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_key(*parts) -> str:
+    """
+    returns a cache key for a list of parts, e.g., a content hash, label selection and spacing
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+class PointCache:
+    """
+    content-addressed on-disk cache for point clouds and features
+    each entry is stored as an uncompressed .npy file, which is memory-mapped (copy-on-write) when loaded.
+    when the total size exceeds max_size, the least recently used entries are evicted.
+    a disabled cache never stores anything and computes all values.
+    """
+
+    def __init__(self, folder: Optional[str]=None, max_size: int=2**32, enabled: bool=True):
+        """
+        :param folder: cache folder, defaults to the MIUA2024B_CACHE environment variable, the cache is disabled if neither is set
+        :param max_size: maximum total size of the cache entries in bytes
+        :param enabled: whether to use the cache
+        """
+        self.folder = default(folder, os.environ.get(_cache_env))
+        self.max_size = max_size
+        self.enabled = enabled and bool(self.folder)
+        if self.enabled:
+            os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        returns the memory-mapped array stored for the key or None
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            arr = np.load(path, mmap_mode='c')
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            # marks the entry as recently used for the eviction, not possible for read-only caches
+            os.utime(path)
+        except OSError:
+            pass
+        return arr
+
+    def put(self, key: str, arr: np.ndarray):
+        """
+        stores an array for the key, the file is replaced atomically so that concurrent processes may share the cache.
+        nothing is stored if the cache cannot be written, e.g., a read-only or full file system
+        """
+        if not self.enabled:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(arr))
+            os.replace(tmp, self._path(key))
+        except BaseException as e:
+            os.remove(tmp)
+            if isinstance(e, OSError):
+                return
+            raise
+        self.evict()
+
+    def cached(self, key: str, fn: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        returns the array stored for the key or computes and stores it using fn
+        """
+        arr = self.get(key)
+        if arr is None:
+            arr = fn()
+            self.put(key, arr)
+        return arr
+
+    def evict(self):
+        """
+        removes the least recently used entries until the cache size is within max_size
+        """
+        entries = list()
+        for name in os.listdir(self.folder):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(e[1] for e in entries)
+        for _, n, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+            size -= n
@@ -1,4 +1,5 @@
 import random
+from functools import lru_cache
 from typing import Optional, Union
 import numpy as np
 
@@ -6,6 +7,17 @@ from miua2024b.source.util import default, native, as_tuple
 
 _default_color_names = ['red', 'green', 'blue', 'yellow', 'cyan', 'magenta']
 
+# rgb values of the basic color names, which avoids importing matplotlib for the default palette
+_basic_colors = {
+    'black': (0, 0, 0), 'white': (255, 255, 255), 'gray': (128, 128, 128), 'grey': (128, 128, 128),
+    'red': (255, 0, 0), 'green': (0, 128, 0), 'blue': (0, 0, 255), 'yellow': (255, 255, 0),
+    'cyan': (0, 255, 255), 'magenta': (255, 0, 255), 'orange': (255, 165, 0),
+}
+
+# the random colors drawn so far for the indices after the default color names, see default_color
+_random_colors = list()
+_random_generator = None
+
 
 def random_colors(seed: int=0):
     """
@@ -17,25 +29,24 @@ def random_colors(seed: int=0):
 
 def default_color(index: int) -> tuple:
     """
-    returns a default color for the given index, after the last entry colors are generated randomly (with the same seed)
+    returns a default color for the given index, after the last entry colors are generated randomly (with the same seed),
+    the random colors are drawn once and kept, so that each index only draws the colors it adds
     """
-    global _default_color_names
+    global _default_color_names, _random_generator
     assert index >= 0
 
     if index < len(_default_color_names):
         return to_color(_default_color_names[index])
-    else:
-        draw = index + 1 - len(_default_color_names)
-        gen = random_colors()
-        while True:
-            c = next(gen)
-            draw -= 1
-            if draw <= 0:
-                break
-        return tuple(c)
+    if _random_generator is None:
+        _random_generator = random_colors()
+    while len(_random_colors) <= index - len(_default_color_names):
+        _random_colors.append(next(_random_generator))
+    return _random_colors[index - len(_default_color_names)]
 
 
 def _name_to_color(name: str):
+    if name.lower() in _basic_colors:
+        return tuple(c / 255 for c in _basic_colors[name.lower()])
     from matplotlib import colors
     return colors.to_rgb(name)
 
@@ -70,4 +81,19 @@ def default_palette(size: Optional[int]):
     """
     global _default_color_names
     size = default(size, len(_default_color_names))
-    return list(default_color(i) for i in range(size))
\ No newline at end of file
+    return list(default_color(i) for i in range(size))
+
+
+@lru_cache(maxsize=16)
+def _palette_array(size: int) -> np.ndarray:
+    arr = np.asarray(default_palette(size), dtype=np.uint8).reshape(size, 3)
+    arr.flags.writeable = False
+    return arr
+
+
+def palette_array(size: int) -> np.ndarray:
+    """
+    returns the default palette of the size as read-only (size, 3) uint8 array, which is computed once per size,
+    e.g. to color rendered images, see snapshot.render_projections and snapshot.write_snapshot
+    """
+    return _palette_array(int(size))
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import os
+import sys
+from functools import lru_cache
+from time import time
+from typing import Optional
+
+import numpy as np
+
+from miua2024b.source.lazy import lazy_import
+from miua2024b.source.points import transform_points
+from miua2024b.source.transform import evaluate_affines, evaluate_transforms
+from miua2024b.source.util import affine_from_transform, get_center
+
+sitk = lazy_import('SimpleITK')
+
+_transform_exts = ('.tfm', '.hdf', '.h5', '.txt', '.mat')
+_result_keys = ['id', 'pred', 'truth', 'fixed', 'status', 'trans_err', 'rot_err',
+                'tre_mean', 'tre_median', 'tre_p95', 'tre_max', 'error']
+_summary_metrics = ['trans_err', 'rot_err', 'tre_mean', 'tre_median', 'tre_p95', 'tre_max']
+
+
+def _stem(path: str) -> str:
+    name = os.path.basename(path)
+    for ext in ('.nii.gz', ) + _transform_exts + ('.nrrd', '.nii', '.mha'):
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def find_pairs(pred_dir: str, truth_dir: str, fixed: Optional[str]=None) -> list:
+    """
+    matches the predicted and truth transforms of two folders by their file name (without extension)
+    :param pred_dir: folder of the predicted transforms
+    :param truth_dir: folder of the truth transforms
+    :param fixed: optional fixed segmentation shared by all pairs or folder of fixed segmentations matched by name,
+    which define the reference point (image center) and the vessel points for the target registration error
+    :return: list of pairs with the entries 'id', 'pred', 'truth' and 'fixed'
+    """
+    truths = dict((_stem(f), os.path.join(truth_dir, f)) for f in sorted(os.listdir(truth_dir))
+                  if f.lower().endswith(_transform_exts))
+    fixed_imgs = dict()
+    if fixed and os.path.isdir(fixed):
+        fixed_imgs = dict((_stem(f), os.path.join(fixed, f)) for f in sorted(os.listdir(fixed)))
+    pairs = list()
+    for f in sorted(os.listdir(pred_dir)):
+        key = _stem(f)
+        if not f.lower().endswith(_transform_exts) or key not in truths:
+            continue
+        pairs.append(dict(id=key, pred=os.path.join(pred_dir, f), truth=truths[key],
+                          fixed=fixed_imgs.get(key) if fixed_imgs else fixed))
+    return pairs
+
+
+def read_pairs(manifest_path: str) -> list:
+    """
+    reads the pairs to evaluate from a manifest of the batch tool, see batch.read_manifest,
+    the output transforms are evaluated against the truth transforms, entries without truth are skipped
+    :return: list of pairs with the entries 'id', 'pred', 'truth' and 'fixed'
+    """
+    from miua2024b.source.batch import read_manifest
+    return list(dict(id=job['index'], pred=job['output'], truth=job['truth'], fixed=job['fixed'])
+                for job in read_manifest(manifest_path) if job.get('truth'))
+
+
+@lru_cache(maxsize=16)
+def _reference_points(fixed_path: Optional[str], n_points: int, binary: bool):
+    """
+    cached reference point (image center) and sampled vessel points of a fixed segmentation
+    """
+    if not fixed_path:
+        return np.zeros((1, 3)), np.empty((0, 3))
+    from miua2024b.source.main import read_segmentation
+    img, points = read_segmentation(fixed_path, binary=binary)
+    if len(points) > n_points:
+        points = points[np.sort(np.random.default_rng(0).choice(len(points), n_points, replace=False))]
+    return np.asarray([get_center(img)]), np.asarray(points, dtype=np.float64)
+
+
+def _read_transform(path: str):
+    """
+    reads a transform and returns it with its affine matrix, or None if the transform is not linear
+    """
+    tf = sitk.ReadTransform(path)
+    return tf, affine_from_transform(tf) if tf.IsLinear() else None
+
+
+def _errors(res: dict, trans_err: float, rot_err: float, tre: np.ndarray):
+    res.update(status='ok', trans_err=float(trans_err), rot_err=float(rot_err))
+    if len(tre):
+        res.update(tre_mean=float(np.mean(tre)), tre_median=float(np.median(tre)),
+                   tre_p95=float(np.percentile(tre, 95)), tre_max=float(np.max(tre)))
+
+
+def evaluate_pairs(pairs: list, n_points: int=1000, binary=False) -> list:
+    """
+    evaluates predicted against truth transforms: the translation and rotation errors at the center of the fixed
+    image (see evaluate_transforms) and the target registration error (TRE) over vessel points sampled from the fixed
+    segmentation. pairs of linear transforms sharing a fixed segmentation are evaluated batched, see evaluate_affines,
+    non-linear transforms point by point. pairs without fixed segmentation are evaluated at the origin without TRE,
+    which is reported once as a warning.
+    :param pairs: list of pairs with the entries 'id', 'pred', 'truth' and optionally 'fixed', see find_pairs
+    :param n_points: the number of vessel points to sample for the TRE
+    :param binary: whether to mask all labels of the fixed segmentation instead of the left and right labels
+    :return: list of results with the errors and a 'status' per pair
+    """
+    n_origin = sum(not pair.get('fixed') for pair in pairs)
+    if n_origin:
+        print("Warning: {}/{} pairs have no fixed segmentation, their errors are evaluated at the origin "
+              "and no TRE is computed".format(n_origin, len(pairs)))
+    results = list()
+    groups = dict()
+    for pair in pairs:
+        res = dict(pair, status=None)
+        results.append(res)
+        try:
+            tf_pred, m_pred = _read_transform(pair['pred'])
+            tf_truth, m_truth = _read_transform(pair['truth'])
+        except RuntimeError as e:
+            res.update(status='missing' if not os.path.exists(pair['pred']) else 'error',
+                       error=str(e).strip().splitlines()[-1])
+            continue
+
+        try:
+            center, points = _reference_points(pair.get('fixed'), n_points, binary)
+        except Exception as e:
+            # e.g., a missing or corrupt fixed segmentation only fails the pairs using it
+            res.update(status='error', error=str(e).strip().splitlines()[-1])
+            continue
+        if m_pred is not None and m_truth is not None:
+            groups.setdefault(pair.get('fixed'), list()).append((res, m_pred, m_truth))
+            continue
+        t_pred, t_truth = transform_points(points, tf_pred), transform_points(points, tf_truth)
+        _errors(res, *evaluate_transforms(pred=tf_pred, truth=tf_truth, ref=tuple(center[0])),
+                np.linalg.norm(t_pred - t_truth, axis=-1))
+
+    for fixed, group in groups.items():
+        center, points = _reference_points(fixed, n_points, binary)
+        n_diff, r_diff = evaluate_affines(list(g[1] for g in group), list(g[2] for g in group),
+                                          np.concatenate([center, points]))
+        for (res, _, _), n, r in zip(group, n_diff, r_diff):
+            _errors(res, n[0], r, n[1:])
+    return results
+
+
+def summarize(results: list) -> list:
+    """
+    returns the cohort-level summary of the results, one row per metric with its count, mean, std, median, 95th
+    percentile and maximum over all successfully evaluated pairs
+    """
+    rows = list()
+    for metric in _summary_metrics:
+        v = np.asarray(list(r[metric] for r in results if r.get('status') == 'ok' and r.get(metric) is not None))
+        if len(v) == 0:
+            continue
+        rows.append(dict(metric=metric, n=len(v), mean=v.mean(), std=v.std(), median=np.median(v),
+                         p95=np.percentile(v, 95), max=v.max()))
+    return rows
+
+
+def write_table(rows: list, path: str, keys: Optional[list]=None):
+    """
+    writes a list of dictionaries as a .csv table
+    """
+    keys = keys if keys is not None else (list(rows[0]) if rows else list())
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=keys, extrasaction='ignore')
+        writer.writeheader()
+        for r in rows:
+            writer.writerow(r)
+
+
+def entry_point():
+    parser = argparse.ArgumentParser(description='Evaluation of predicted against truth transforms for a cohort.')
+    parser.add_argument('--pred', dest='pred', type=str, default="", help="Folder of the predicted transforms, matched to the truth transforms by file name")
+    parser.add_argument('--truth', dest='truth', type=str, default="", help="Folder of the truth transforms")
+    parser.add_argument('--fixed', dest='fixed', type=str, default="", help="Fixed segmentation shared by all pairs or folder of fixed segmentations matched by file name, defines the reference point and the vessel points for the TRE")
+    parser.add_argument('--manifest', dest='manifest', type=str, default="", help="Manifest of the batch tool (.csv or .json) instead of folders, the output transforms are evaluated against the truth transforms")
+    parser.add_argument('--results', dest='results', type=str, required=True, help="Output path for the .csv table of per-pair errors")
+    parser.add_argument('--summary', dest='summary', type=str, default="", help="Output path for the .csv table of the cohort-level summary")
+    parser.add_argument('--tre-points', dest='tre_points', type=int, default=1000, help="Number of vessel points to sample from the fixed segmentation for the TRE")
+    parser.add_argument('--binary', dest='binary', action='store_true', help="Whether to mask all lables instead of extracting the left and right labels predicted by model theta m")
+    args, _ = parser.parse_known_args(args=sys.argv)
+
+    if args.manifest:
+        pairs = read_pairs(args.manifest)
+    elif args.pred and args.truth:
+        pairs = find_pairs(args.pred, args.truth, fixed=args.fixed or None)
+    else:
+        raise RuntimeError("Either --manifest or --pred and --truth must be specified")
+
+    print(f"Evaluating {len(pairs)} pairs...")
+    t0 = time()
+    results = evaluate_pairs(pairs, n_points=args.tre_points, binary=args.binary)
+    n_ok = sum(r['status'] == 'ok' for r in results)
+    print("Finished evaluating {}/{} pairs in {:.2f} seconds!".format(n_ok, len(results), time() - t0))
+    write_table(results, args.results, keys=_result_keys)
+    print(f"Finished writing results to: {args.results}")
+
+    summary = summarize(results)
+    for row in summary:
+        print("* {}: mean: {:.2f}, median: {:.2f}, max: {:.2f} (n={})".format(
+            row['metric'], row['mean'], row['median'], row['max'], row['n']))
+    if args.summary:
+        write_table(summary, args.summary)
+        print(f"Finished writing summary to: {args.summary}")
+
+
+if __name__ == '__main__':
+    entry_point()
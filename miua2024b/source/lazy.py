@@ -0,0 +1,29 @@
+import importlib
+
+
+class LazyModule:
+    """
+    proxy of a module which is imported on the first attribute access,
+    e.g. sitk = LazyModule('SimpleITK') at module level defers the import of SimpleITK until sitk.ReadImage is used
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        # only called for attributes which are not set on the proxy itself
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return "<lazy module '{}'{}>".format(self._name, '' if self._module is None else ' (imported)')
+
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    returns a proxy of the module, which is imported on first use, see LazyModule
+    :param name: absolute name of the module, e.g., 'SimpleITK' or 'open3d.pipelines.registration'
+    """
+    return LazyModule(name)
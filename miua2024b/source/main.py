@@ -1,19 +1,89 @@
+from __future__ import annotations
+
 import argparse
+import json
+import os
 import sys
 from time import time
 from typing import Optional
 
-import SimpleITK as sitk
+import numpy as np
 
-from miua2024b.source.points import mask_to_points
-from miua2024b.source.registration import register_points_affine
+from miua2024b.source.cache import PointCache, file_hash, make_key
+from miua2024b.source.lazy import lazy_import
+from miua2024b.source.points import labels_to_points
+from miua2024b.source.profiling import profile, profiled, stage, write_outputs
+from miua2024b.source.registration import is_suspicious, register_points_affine, register_points_symmetric
+from miua2024b.source.resample import resample_image
+from miua2024b.source.roi import crop_to_labels, label_extent
+from miua2024b.source.snapshot import write_snapshot
 from miua2024b.source.transform import evaluate_transforms
 from miua2024b.source.util import transform_from_affine, get_center, format_array
+from miua2024b.source.volume import as_volume, read_volume
+
+sitk = lazy_import('SimpleITK')
+
+
+@profiled('read_segmentation', points=lambda res: len(res[1]))
+def read_segmentation(img_path: str, binary=False, cache: Optional[PointCache]=None, dtype=np.float64,
+                      grid: Optional[float]=None):
+    """
+    reads a vessel segmentation and converts the target labels to a point cloud
+    :param img_path: path to the segmentation image, e.g., .nrrd, .nii.gz or a volume in the working format (.npy)
+    :param binary: whether to mask all labels instead of extracting the left and right labels predicted by model theta m
+    :param cache: optional cache, in which the image is converted to a memory-mapped volume once (see volume.read_volume)
+    and its label projections are stored (see roi.label_projections)
+    :param dtype: floating point type of the point coordinates, e.g., float32 to halve the memory of the point clouds
+    :param grid: optional grid spacing (in mm) to subsample the point cloud with while it is extracted, one point
+    (the centroid) per occupied cell, see points.labels_to_points, which bounds the memory of dense segmentations
+    :return: tuple of the segmentation volume and its point cloud
+    """
+    with stage('read_image', path=img_path):
+        img = as_volume(read_volume(img_path, cache))
+    labels = (lambda v: v != 1) if binary else (4, 5)
+    # the points are extracted from the bounding box of the labels only, see roi.LabelProjections
+    key = file_hash(img_path) if cache is not None and cache.enabled else None
+    roi = crop_to_labels(img, labels, cache=cache, key=key)
+    if roi is None:
+        return img, np.empty((0, 3), dtype=dtype)
+    return img, labels_to_points(roi, {'target': labels}, dtype=dtype, grid=grid)['target']
+
+
+def segmentation_key(img_path: str, binary=False, dtype=np.float64, grid: Optional[float]=None):
+    """
+    returns the cache key for the point cloud of a segmentation, see read_segmentation
+    """
+    parts = (file_hash(img_path), 'binary' if binary else (4, 5), np.dtype(dtype).name)
+    return make_key(*parts) if grid is None else make_key(*parts, 'grid', grid)
+
+
+def symmetric_paths(dest_path: str, inverse_path: Optional[str]=None, quality_path: Optional[str]=None):
+    """
+    returns the paths of the inverse transform and the quality record of a symmetric registration,
+    which default to siblings of the forward transform, e.g., forward.inverse.hdf and forward.quality.json
+    """
+    stem, ext = os.path.splitext(dest_path)
+    return inverse_path or stem + '.inverse' + ext, quality_path or stem + '.quality.json'
+
+
+def snapshot_path(dest_path: str) -> str:
+    """
+    returns the default path of the QC image of a registration, a sibling of the transform, e.g., forward.qc.png
+    """
+    return os.path.splitext(dest_path)[0] + '.qc.png'
 
 
 def run(fixed_img_path: str, moving_img_path: str, dest_path: str,
         truth_path: Optional[str]=None, warped_path: Optional[str]=None,
-        show=False, binary=False, search_mm:float=1.0, fine_mm=1.5):
+        show=False, binary=False, search_mm:float=1.0, fine_mm=1.5,
+        cache_dir: Optional[str]=None, cache_size: float=4.0, use_cache=True,
+        icp_steps: int=1000, icp_tol: Optional[float]=None, icp_levels: Optional[list]=None,
+        ransac_seeds: Optional[list]=None, ransac_scales: Optional[list]=None, ransac_fpfh: Optional[list]=None,
+        ransac_workers: Optional[int]=None, ransac_budget: Optional[float]=None, downsampling='pcu',
+        warped_interpolator: Optional[str]=None, dtype='float64', symmetric=False,
+        inverse_path: Optional[str]=None, quality_path: Optional[str]=None,
+        max_consistency: float=1.0, min_fitness: float=0.1, snapshot: Optional[str]=None,
+        point_grid: Optional[float]=None):
     """
     Runs the registration method for vessels using segmentation images of target structures
     :param fixed_img_path: segmentation of the fixed image
@@ -25,35 +95,84 @@ def run(fixed_img_path: str, moving_img_path: str, dest_path: str,
     :param binary: whether to mask all labels instead of extracting the left and right labels predicted by model theta m
     :param search_mm: resolution for the global RANSAC registration (in mm for the poison disk radius)
     :param fine_mm: resolution for the fine ICP registration (in mm for the poison disk radius)
+    :param cache_dir: folder to cache converted volumes, downsampled point clouds and features in, defaults to the MIUA2024B_CACHE environment variable
+    :param cache_size: maximum size of the cache in GB
+    :param use_cache: whether to use the cache
+    :param icp_steps: the number of ICP runs per resolution level
+    :param icp_tol: tolerance (in mm) for the adaptive ICP schedule which skips ahead once the transform converged,
+    None runs all steps
+    :param icp_levels: optional coarser resolutions (in mm for the poison disk radius) to run ICP on before fine_mm
+    :param ransac_seeds: seeds for multiple global registration hypotheses run concurrently, the best one is selected
+    :param ransac_scales: voxel sizes of the global registration hypotheses relative to search_mm
+    :param ransac_fpfh: FPFH radii of the global registration hypotheses relative to the voxel size
+    :param ransac_workers: number of worker processes for the global registration hypotheses
+    :param ransac_budget: optional wall-clock limit in seconds for the global registration hypotheses
+    :param downsampling: method to downsample the point clouds with, 'pcu', 'poisson' or 'voxel'
+    :param warped_interpolator: interpolator for the warped image, see resample.get_interpolator, defaults to nearest neighbour
+    :param dtype: floating point type of the point clouds, 'float64' or 'float32', open3d converts them to float64
+    once per resolution
+    :param symmetric: whether to also register the moving to the fixed image (concurrently) and check the inverse
+    consistency of both transforms, see registration.register_points_symmetric
+    :param inverse_path: output path for the inverse transform of a symmetric registration, see symmetric_paths
+    :param quality_path: output path for the quality record (.json) of a symmetric registration, see symmetric_paths
+    :param max_consistency: the maximum consistency error (in mm) of a symmetric registration before it is flagged
+    :param min_fitness: the minimum fitness of a symmetric registration before it is flagged
+    :param snapshot: optional output path for a QC image (.png) of the point clouds before and after the registration,
+    which is rendered without a display, see snapshot.write_snapshot
+    :param point_grid: optional grid spacing (in mm) to subsample the point clouds with while they are extracted,
+    before the downsampling, see read_segmentation
     :return: affine transformation resulting aligning the fixed and moving image.
     """
 
-    # read the segmentation images
+    cache = PointCache(cache_dir, max_size=int(cache_size * 2**30), enabled=use_cache)
+
+    # read the segmentation images and convert the masks to point-clouds
     print(f"Reading fixed image: {fixed_img_path}")
-    fixed_img = sitk.ReadImage(fixed_img_path)
-    fixed_mask = fixed_img != 1 if binary else sitk.Or(fixed_img == 4, fixed_img == 5)
-    fixed_mask.CopyInformation(fixed_img)
+    fixed_img, fixed = read_segmentation(fixed_img_path, binary=binary, cache=cache, dtype=dtype, grid=point_grid)
 
     print(f"Reading moving image: {moving_img_path}")
-    moving_img = sitk.ReadImage(moving_img_path)
-    moving_mask = moving_img != 1 if binary else sitk.Or(moving_img == 4, moving_img == 5)
-    moving_mask.CopyInformation(moving_img)
+    moving_img, moving = read_segmentation(moving_img_path, binary=binary, cache=cache, dtype=dtype, grid=point_grid)
 
-    # convert the masks to point-clouds
-    fixed = mask_to_points(fixed_mask)
-    moving = mask_to_points(moving_mask)
+    cache_keys = None
+    if cache.enabled:
+        cache_keys = (segmentation_key(fixed_img_path, binary, dtype, point_grid),
+                      segmentation_key(moving_img_path, binary, dtype, point_grid))
 
     # perform the registration
     print("Running registration...", end='')
     t0 = time()
-    tf = register_points_affine(fixed, moving, show=show, spacing_search=search_mm, spacing_refine=fine_mm)
+    kwargs = dict(spacing_search=search_mm, spacing_refine=fine_mm, cache=cache,
+                  icp_steps=icp_steps, icp_tol=icp_tol, icp_levels=icp_levels,
+                  ransac_seeds=ransac_seeds, ransac_scales=ransac_scales, ransac_fpfh=ransac_fpfh,
+                  ransac_workers=ransac_workers, ransac_budget=ransac_budget, downsampling=downsampling)
+    if symmetric:
+        tf, tf_inv, info = register_points_symmetric(fixed, moving, cache_keys=cache_keys, **kwargs)
+    else:
+        tf, info = register_points_affine(fixed, moving, show=show, cache_keys=cache_keys, return_info=True, **kwargs)
     print("\rFinished registration in {:.2f} seconds!".format(time()-t0))
+    print("ICP used {} steps (fitness: {:.3f}, inlier RMSE: {:.3f} mm)".format(info['icp_steps'], info['fitness'], info['inlier_rmse']))
 
     # write the result
     tf = transform_from_affine(tf)
     sitk.WriteTransform(tf, dest_path)
     print(f"Finished writing results to: {dest_path}")
 
+    if snapshot:
+        # the transform maps the fixed to the moving points
+        write_snapshot(snapshot, source=fixed, target=moving, tf=tf)
+        print(f"Finished writing results to: {snapshot}")
+
+    if symmetric:
+        inverse_path, quality_path = symmetric_paths(dest_path, inverse_path, quality_path)
+        info['suspicious'] = is_suspicious(info, max_consistency=max_consistency, min_fitness=min_fitness)
+        print("Inverse consistency error: {:.3f} mm (max: {:.3f} mm){}".format(
+            info['consistency_error'], info['consistency_max'], ", the registration is suspicious!" if info['suspicious'] else ""))
+        sitk.WriteTransform(transform_from_affine(tf_inv), inverse_path)
+        print(f"Finished writing results to: {inverse_path}")
+        with open(quality_path, 'w') as f:
+            json.dump(info, f, indent=2)
+        print(f"Finished writing results to: {quality_path}")
+
     if truth_path:
         # evaluate result
         print(f"Reading truth transform: {truth_path}")
@@ -67,8 +186,10 @@ def run(fixed_img_path: str, moving_img_path: str, dest_path: str,
 
     if warped_path:
         # write warped image
-        warped = sitk.Resample(moving_img, fixed_img, tf)
-        sitk.WriteImage(warped, warped_path)
+        with stage('warp'):
+            resample_image(moving_img, fixed_img, tf, output_path=warped_path, interpolator=warped_interpolator,
+                           labels=True, extent=label_extent(moving_img))
+        print(f"Finished writing warped image to: {warped_path}")
 
 def entry_point():
     parser = argparse.ArgumentParser(description='Registration method for cerebral vasculature.')
@@ -77,21 +198,69 @@ def entry_point():
     parser.add_argument('--output', dest='output', type=str, required=True, help="Output path for the resulting transform, must have an extension supported by SimpleITK, e.g., .tfm or .hdf")
     parser.add_argument('--truth', dest='truth', type=str, default="", help="Truth transform to evaluate against, must have an extension supported by SimpleITK, e.g., .tfm or .hdf")
     parser.add_argument('--warped', dest='warped', type=str, default="", help="Warped image to write, must have an extension supported by SimpleITK, e.g., .nrrd")
+    parser.add_argument('--warped-interpolator', dest='warped_interpolator', type=str, default=None, choices=['nearest', 'label_gaussian', 'linear', 'bspline'], help="Interpolator for the warped image, defaults to nearest neighbour")
     parser.add_argument('--show', dest='show', action='store_true', help="Whether to visualize the registered point-clouds")
     parser.add_argument('--binary', dest='binary', action='store_true', help="Whether to mask all lables instead of extracting the left and right labels predicted by model theta m")
     parser.add_argument('--search', dest='search', type=float, default='1.5', help="Resolution for the global RANSAC registration (in mm for the poison disk radius)")
     parser.add_argument('--fine', dest='fine', type=float, default='1.0', help="Resolution for the fine ICP registration (in mm for the poison disk radius)")
+    parser.add_argument('--cache', dest='cache', type=str, default=None, help="Folder to cache converted volumes, downsampled point clouds and features in, defaults to the MIUA2024B_CACHE environment variable")
+    parser.add_argument('--cache-size', dest='cache_size', type=float, default=4.0, help="Maximum size of the cache in GB, the least recently used entries are evicted")
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', help="Whether to disable the cache")
+    parser.add_argument('--icp-steps', dest='icp_steps', type=int, default=1000, help="Number of ICP runs per resolution level")
+    parser.add_argument('--icp-tol', dest='icp_tol', type=float, default=None, help="Tolerance (in mm) for the adaptive ICP schedule, which skips ahead once the transform converged, by default all steps are run")
+    parser.add_argument('--icp-pyramid', dest='icp_pyramid', type=float, nargs='*', default=None, help="Coarser resolutions (in mm for the poison disk radius) to run ICP on before the fine resolution")
+    parser.add_argument('--ransac-seeds', dest='ransac_seeds', type=int, default=None, help="Number of seeds for multiple global registration hypotheses run concurrently, the best one is selected after a short ICP refinement")
+    parser.add_argument('--ransac-scales', dest='ransac_scales', type=float, nargs='*', default=None, help="Voxel sizes of the global registration hypotheses relative to the search resolution, e.g., 1.0 1.5")
+    parser.add_argument('--ransac-fpfh', dest='ransac_fpfh', type=float, nargs='*', default=None, help="FPFH feature radii of the global registration hypotheses relative to the voxel size, e.g., 5 7.5")
+    parser.add_argument('--ransac-workers', dest='ransac_workers', type=int, default=None, help="Number of worker processes for the global registration hypotheses")
+    parser.add_argument('--ransac-budget', dest='ransac_budget', type=float, default=None, help="Wall-clock limit in seconds for the global registration hypotheses")
+    parser.add_argument('--downsampling', dest='downsampling', type=str, default='pcu', choices=['pcu', 'poisson', 'voxel'], help="Method to downsample the point clouds with, the point_cloud_utils Poisson-disk sampling (default), the grid-based Poisson-disk sampling or voxel sampling")
+    parser.add_argument('--dtype', dest='dtype', type=str, default='float64', choices=['float32', 'float64'], help="Floating point type of the point clouds, float32 halves their memory")
+    parser.add_argument('--point-grid', dest='point_grid', type=float, default=None, help="Grid spacing (in mm) to subsample the point clouds with while they are extracted, one point per occupied cell, by default all voxels are kept")
+    parser.add_argument('--symmetric', dest='symmetric', action='store_true', help="Whether to register in both directions concurrently and check the inverse consistency of the transforms")
+    parser.add_argument('--inverse', dest='inverse', type=str, default="", help="Output path for the inverse transform of a symmetric registration, defaults to <output>.inverse with the extension of --output")
+    parser.add_argument('--quality', dest='quality', type=str, default="", help="Output path for the .json quality record (fitness, inlier RMSE, consistency error) of a symmetric registration, defaults to <output>.quality.json")
+    parser.add_argument('--max-consistency', dest='max_consistency', type=float, default=1.0, help="Consistency error (in mm) above which a symmetric registration is flagged as suspicious")
+    parser.add_argument('--min-fitness', dest='min_fitness', type=float, default=0.1, help="Fitness below which a symmetric registration is flagged as suspicious")
+    parser.add_argument('--snapshot', dest='snapshot', type=str, default="", help="Output path for a QC image (.png) of the point clouds before and after the registration, rendered without a display")
+    parser.add_argument('--profile', dest='profile', type=str, default="", help="Output path for the timings and values of each stage, a .json or .csv file")
+    parser.add_argument('--trace', dest='trace', type=str, default="", help="Output path for a Chrome trace file of the stages, e.g., .trace.json")
     args, _ = parser.parse_known_args(args=sys.argv)
 
-    run(fixed_img_path=args.fixed,
-        moving_img_path=args.moving,
-        dest_path=args.output,
-        truth_path=args.truth,
-        warped_path=args.warped,
-        show=args.show,
-        binary=args.binary,
-        search_mm=args.search,
-        fine_mm=args.fine)
+    with profile(enabled=bool(args.profile or args.trace)) as prof:
+        run(fixed_img_path=args.fixed,
+            moving_img_path=args.moving,
+            dest_path=args.output,
+            truth_path=args.truth,
+            warped_path=args.warped,
+            show=args.show,
+            binary=args.binary,
+            search_mm=args.search,
+            fine_mm=args.fine,
+            cache_dir=args.cache,
+            cache_size=args.cache_size,
+            use_cache=not args.no_cache,
+            icp_steps=args.icp_steps,
+            icp_tol=args.icp_tol,
+            icp_levels=args.icp_pyramid,
+            ransac_seeds=None if args.ransac_seeds is None else list(range(args.ransac_seeds)),
+            ransac_scales=args.ransac_scales,
+            ransac_fpfh=args.ransac_fpfh,
+            ransac_workers=args.ransac_workers,
+            ransac_budget=args.ransac_budget,
+            downsampling=args.downsampling,
+            warped_interpolator=args.warped_interpolator,
+            dtype=args.dtype,
+            symmetric=args.symmetric,
+            inverse_path=args.inverse or None,
+            quality_path=args.quality or None,
+            max_consistency=args.max_consistency,
+            min_fitness=args.min_fitness,
+            snapshot=args.snapshot or None,
+            point_grid=args.point_grid)
+
+    if prof is not None:
+        write_outputs(prof.events, profile_path=args.profile, trace_path=args.trace)
 
 
 if __name__ == '__main__':
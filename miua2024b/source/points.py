@@ -1,24 +1,63 @@
-import sys
+from __future__ import annotations
+
+import itertools
+from typing import Optional
 
 import numpy as np
-import SimpleITK as sitk
 
 from miua2024b.source.colors import default_palette
-from miua2024b.source.util import as_list, native
+from miua2024b.source.lazy import lazy_import
+from miua2024b.source.profiling import stage, profiled
+from miua2024b.source.sampling import PointSampler
+from miua2024b.source.util import as_list, native, affine_from_transform
+from miua2024b.source.volume import get_array, get_label_array
+
+sitk = lazy_import('SimpleITK')
+o3d = lazy_import('open3d')
+pcu = lazy_import('point_cloud_utils')
+
+# maximum number of label values (from the minimum to the maximum label) to build a lookup table for, see labels_to_points
+_lut_limit = 2**24
 
 
-def downsample_points(points, radius: float=1):
+def downsample_points(points, radius: float=1, method='pcu', sampler: Optional[PointSampler]=None):
     """
-    resamples the point clouds to the specified radius using the method in "Parallel Poisson Disk Sampling with Spectrum Analysis on Surface"
-    (http://graphics.cs.umass.edu/pubs/sa_2010.pdf)
+    resamples the point clouds to the specified radius, see downsample_indices
     :param points: ndarray
     :param radius: radius to downsample to
+    :param method: sampling method, 'pcu', 'poisson' or 'voxel'
+    :param sampler: optional sampler of the points to reuse its spatial hashes
     :return: resampled point cloud
     """
-    import point_cloud_utils as pcu
     points = np.asarray(points)
-    mask = pcu.downsample_point_cloud_poisson_disk(points, target_num_samples=-1, radius=radius)
-    return points[mask]
+    return points[downsample_indices(points, radius, method=method, sampler=sampler)]
+
+
+def downsample_indices(points, radius: float=1, method='pcu', sampler: Optional[PointSampler]=None) -> np.ndarray:
+    """
+    returns the indices of the points resampled to the specified radius.
+    The pcu method (default) is the implementation of point_cloud_utils using the method in "Parallel Poisson Disk
+    Sampling with Spectrum Analysis on Surface" (http://graphics.cs.umass.edu/pubs/sa_2010.pdf).
+    The poisson method selects a maximal Poisson-disk sample using the grid hashing of sampling.PointSampler,
+    the voxel method the point closest to the centroid of each occupied voxel of size radius.
+    The grid-based methods are faster for large point clouds, but their samples differ from the pcu method and so do
+    the registration results
+    :param points: ndarray
+    :param radius: radius to downsample to
+    :param method: sampling method, 'pcu', 'poisson' or 'voxel'
+    :param sampler: optional sampler of the points to reuse its spatial hashes, which are kept per cell size
+    :return: sorted indices of the selected points
+    """
+    with stage('downsample_points', radius=radius, method=method, points_in=len(points)) as st:
+        if method == 'pcu':
+            idx = pcu.downsample_point_cloud_poisson_disk(np.asarray(points), target_num_samples=-1, radius=radius)
+        elif method in ('poisson', 'voxel'):
+            sampler = PointSampler(points) if sampler is None else sampler
+            idx = sampler.poisson(radius) if method == 'poisson' else sampler.voxel(radius)
+        else:
+            raise RuntimeError("Unsupported downsampling method: {}".format(method))
+        st['points_out'] = len(idx)
+    return idx
 
 
 def show_pointclouds(pcls: list, palette=None):
@@ -31,57 +70,143 @@ def show_pointclouds(pcls: list, palette=None):
     if palette is None:
         palette = default_palette(len(pcls))
 
-    import open3d as o3d
     geos = list()
     for rgb, pcl in zip(palette, pcls):
         if not isinstance(pcl, o3d.geometry.PointCloud):
             if not isinstance(pcl, o3d.utility.Vector3dVector):
-                pcl = o3d.utility.Vector3dVector(pcl)
-            pcl = o3d.geometry.PointCloud(pcl)
+                pcl = as_pointcloud(pcl)
+            else:
+                pcl = o3d.geometry.PointCloud(pcl)
             pcl.paint_uniform_color(np.divide(rgb, 255))
         geos.append(pcl)
     o3d.visualization.draw_geometries(geos)
 
 
-def transform_points(points, tf):
+def as_pointcloud(points) -> o3d.geometry.PointCloud:
+    """
+    returns an open3d point cloud of the points, point clouds are passed through.
+    open3d stores the coordinates as float64, other types are converted explicitly beforehand, since the implicit
+    conversion of open3d.utility.Vector3dVector is ~50x slower, e.g., for float32 points
+    """
+    if isinstance(points, o3d.geometry.PointCloud):
+        return points
+    return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.ascontiguousarray(points, dtype=np.float64)))
+
+
+def transform_points(points, tf, method='numpy', chunk_size: int=100000):
     """
     generic method to transform a list/array of points, support different transform types
+    The numpy method (default) applies affine matrices and linear SimpleITK transforms (e.g., affine, euler, versor and
+    composites of these) as a single matrix product. Non-linear transforms, e.g., displacement fields, are applied point
+    by point in chunks of chunk_size, linear parts of composite transforms are still applied as matrix products.
+    The SimpleITK method is the reference implementation to check when in doubt concerning the results
+    The maximum difference between the methods is checked to be below 1e-9 for each transform type,
+    see tests/test_points.py
+    :param points: points to transform
+    :param tf: transform, either a (4x4) affine matrix or SimpleITK transform
+    :param method: which method to use for transformation, 'numpy' or 'sitk'
+    :param chunk_size: number of points to transform at a time for non-linear transforms
     :returns transformed points
     """
 
     if all(hasattr(tf, attr) for attr in ['dtype', 'shape', 'ndim']):
         tf = np.asarray(tf)
         if tf.ndim != 2:
-            RuntimeError("Invalid transform matrix dimension: {}".format(tf.ndim))
+            raise RuntimeError("Invalid transform matrix dimension: {}".format(tf.ndim))
         if tf.shape[0] != tf.shape[1]:
-            RuntimeError("Invalid transform matrix shape: {}".format(tf.shape))
-        mat = tf[:-1, :-1].flatten().tolist()
-        trans = tf[:-1, -1].tolist()
-
-        import SimpleITK as sitk
-        tf = sitk.AffineTransform(mat, trans)
+            raise RuntimeError("Invalid transform matrix shape: {}".format(tf.shape))
 
-    if 'SimpleITK' in sys.modules:
-        import SimpleITK as sitk
+    method = method.lower()
+    if method in ('np', 'numpy'):
+        if isinstance(tf, np.ndarray):
+            return _transform_points_affine(points, tf)
+        if isinstance(tf, sitk.Transform):
+            return _transform_points_sitk(points, tf, chunk_size)
+    elif method in ('itk', 'sitk', 'simpleitk'):
+        if isinstance(tf, np.ndarray):
+            tf = sitk.AffineTransform(tf[:-1, :-1].flatten().tolist(), tf[:-1, -1].tolist())
         if isinstance(tf, sitk.Transform):
-            return np.asarray(list(tf.TransformPoint(p) for p in points))
+            points = _as_points(points)
+            return np.asarray(list(tf.TransformPoint(p) for p in points.tolist()), dtype=points.dtype)
+    else:
+        raise RuntimeError("Unknown method for point transformation: {}".format(method))
 
     raise RuntimeError("Invalid transform type: {}".format(type(tf).__name__))
 
 
-def mask_to_points(mask: sitk.Image, method='numpy'):
+def _as_points(points) -> np.ndarray:
+    """
+    returns the points as floating point array, float32 points are kept, other types are converted to float64
+    """
+    points = np.asarray(points)
+    return points if points.dtype in (np.float32, np.float64) else points.astype(np.float64)
+
+
+def _transform_points_affine(points, m: np.ndarray):
+    """
+    applies an affine matrix to points as a single matrix product in the floating point type of the points
+    """
+    points = _as_points(points)
+    m = np.asarray(m, dtype=points.dtype)
+    return points @ m[:-1, :-1].T + m[:-1, -1]
+
+
+def _transform_points_sitk(points, tf: sitk.Transform, chunk_size: int):
+    """
+    applies a SimpleITK transform to points, linear (parts of) transforms are applied as matrix products,
+    the others point by point in chunks
+    """
+    if tf.IsLinear():
+        return _transform_points_affine(points, affine_from_transform(tf))
+
+    if isinstance(tf, sitk.CompositeTransform):
+        # the last transform of the composite is applied first
+        for idx in reversed(range(tf.GetNumberOfTransforms())):
+            points = _transform_points_sitk(points, tf.GetNthTransform(idx).Downcast(), chunk_size)
+        return points
+
+    points = _as_points(points)
+    res = np.empty_like(points)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size].tolist()
+        # the transformed coordinates are written directly into the result instead of a list of tuples
+        res[start:start + len(chunk)] = np.fromiter(itertools.chain.from_iterable(map(tf.TransformPoint, chunk)),
+                                                    dtype=res.dtype, count=res[start:start + len(chunk)].size
+                                                    ).reshape(len(chunk), -1)
+    return res
+
+
+@profiled('mask_to_points', points=len)
+def mask_to_points(mask: sitk.Image, method='numpy', dtype=np.float64, slab_size: int=16, grid: Optional[float]=None):
     """
     Converts a binary mask image to a point cloud
     The numpy method (default) should >10x faster than the simpleitk method (the actual calculation by >100x)
+    The slab method bounds the peak memory by converting the mask in slabs (see iter_mask_points) and filling a
+    preallocated buffer, the points are ordered by slab, which differs from the other methods
     The SimpleITK method is the reference implementation to check when in doubt concerning the results
     The maximum difference between methods for tested images was below 1e-9
-    :param mask: mask image to convert
-    :param method: which method to use for conversion, 'numpy' or 'sitk'
+    :param mask: mask image to convert, a SimpleITK image or memory-mapped volume, see volume.Volume
+    :param method: which method to use for conversion, 'numpy', 'slab' or 'sitk'
+    :param dtype: floating point type of the resulting coordinates
+    :param slab_size: number of slices per slab, applies to the slab method
+    :param grid: optional grid spacing (in mm) to subsample the points with, applies to the slab method
     :return: point coordinates
     """
-    coords = np.asarray(sitk.GetArrayViewFromImage(mask).T.nonzero()).T
-
     method = method.lower()
+    if method == 'slab':
+        slabs = iter_mask_points(mask, slab_size=slab_size, dtype=dtype, grid=grid)
+        if grid is not None:
+            # the number of grid cells is unknown in advance, however, the result is small
+            return np.concatenate(list(slabs) or [np.empty((0, mask.GetDimension()), dtype=dtype)])
+        points = np.empty((np.count_nonzero(get_array(mask)), mask.GetDimension()), dtype=dtype)
+        offset = 0
+        for slab in slabs:
+            points[offset:offset + len(slab)] = slab
+            offset += len(slab)
+        return points
+
+    coords = np.asarray(get_array(mask).T.nonzero()).T
+
     if method in ('itk', 'sitk', 'simpleitk'):
         points = list(mask.TransformIndexToPhysicalPoint(native(c)) for c in coords)
     elif method in ('np', 'numpy'):
@@ -90,13 +215,151 @@ def mask_to_points(mask: sitk.Image, method='numpy'):
         spacing = mask.GetSpacing()
         m_dir = np.asarray(mask.GetDirection()).reshape([dims] * 2)
         m_scl = np.multiply(spacing, np.eye(dims))
-        points = np.add(origin, (m_dir @ m_scl @ coords.T).T)
+        # the coordinates are computed in the requested type instead of converting float64 points afterwards
+        points = coords.astype(dtype) @ (m_dir @ m_scl).T.astype(dtype)
+        points += np.asarray(origin, dtype=dtype)
     else:
         raise RuntimeError("Unknown method for mask to points conversion: {}".format(method))
-    return np.asarray(points)
+    # an empty list of points keeps the shape of a point cloud
+    return np.asarray(points, dtype=dtype).reshape(-1, mask.GetDimension())
+
+
+def iter_mask_points(mask: sitk.Image, slab_size: int=16, dtype=np.float64, grid: Optional[float]=None):
+    """
+    generator converting a binary mask image to a point cloud slab by slab along the slowest axis,
+    only the indices and coordinates of a single slab are held in memory at a time
+    :param mask: 3d mask image to convert, a SimpleITK image or memory-mapped volume, see volume.Volume
+    :param slab_size: number of slices per slab
+    :param dtype: floating point type of the resulting coordinates
+    :param grid: optional grid spacing (in mm) to subsample the points with, the grid is aligned with the voxel axes
+    and each occupied cell is represented by the centroid of its voxels
+    :return: yields the point coordinates of each slab
+    """
+    arr = get_array(mask)
+    m_idx, origin = _index_to_physical(mask, dtype)
+
+    if grid is not None:
+        cell, slab_size = _grid_cell(mask, grid, slab_size)
+
+    for z0 in range(0, arr.shape[0], slab_size):
+        kz, ky, kx = arr[z0:z0 + slab_size].nonzero()
+        if len(kx) == 0:
+            continue
+        coords = np.stack([kx, ky, kz + z0], axis=-1).astype(dtype)
+        del kx, ky, kz
+
+        if grid is not None:
+            coords = _cell_centroids(coords, cell).astype(dtype)
+
+        coords = coords @ m_idx
+        coords += origin
+        yield coords
+
+
+@profiled('labels_to_points', points=lambda res: sum(map(len, res.values())))
+def labels_to_points(img: sitk.Image, groups: dict, dtype=np.float64, slab_size: int=16,
+                     grid: Optional[float]=None) -> dict:
+    """
+    converts groups of labels of a label image to point clouds in a single pass over the image,
+    without creating a mask image per group
+    each group is selected by a collection of labels or a function of the label values returning whether to select them,
+    e.g. {'left': (4, ), 'right': (5, ), 'tree': lambda v: v != 1}
+    :param img: 3d label image with an integer pixel type (or integer values, see volume.get_label_array),
+    a SimpleITK image or memory-mapped volume, see volume.Volume
+    :param groups: dictionary of group names and the labels to select for them, groups may overlap
+    :param dtype: floating point type of the resulting coordinates
+    :param slab_size: number of slices per slab, see iter_mask_points
+    :param grid: optional grid spacing (in mm) to subsample the points of each group with while streaming,
+    see iter_mask_points, the grid is aligned with the first voxel of the image
+    :return: dictionary of group names and their point coordinates
+    """
+    arr = get_label_array(img, slab_size)
+    if len(groups) > 64:
+        raise RuntimeError("Too many label groups: {}".format(len(groups)))
+
+    # group membership of the labels, with one bit per group
+    lut_type = np.min_scalar_type(2 ** len(groups) - 1)
+
+    def _flags(vals):
+        flags = np.zeros(vals.shape, dtype=lut_type)
+        for bit, labels in enumerate(groups.values()):
+            selected = labels(vals) if callable(labels) else np.isin(vals, as_list(labels))
+            flags[np.asarray(selected, dtype=bool)] |= lut_type.type(1 << bit)
+        return flags
+
+    if arr.dtype.itemsize <= 2:
+        lo, hi = np.iinfo(arr.dtype).min, np.iinfo(arr.dtype).max
+    else:
+        lo, hi = (int(arr.min()), int(arr.max())) if arr.size else (0, 0)
+    # a lookup table of all values in the range of the labels, unless the range is too large, e.g., for int32 labels
+    # with large values, then the groups are tested per slab
+    lut = _flags(np.arange(lo, hi + 1)) if hi - lo < _lut_limit else None
+
+    m_idx, origin = _index_to_physical(img, dtype)
+    if grid is not None:
+        cell, slab_size = _grid_cell(img, grid, slab_size)
+    slabs = list([] for _ in groups)
+    for z0 in range(0, arr.shape[0], slab_size):
+        vals = arr[z0:z0 + slab_size]
+        if lut is None:
+            flags = _flags(vals)
+        else:
+            flags = lut[vals] if lo == 0 else lut[vals.astype(np.int64) - lo]
+        kz, ky, kx = flags.nonzero()
+        if len(kx) == 0:
+            continue
+        flags = flags[kz, ky, kx]
+        coords = np.stack([kx, ky, kz + z0], axis=-1).astype(dtype)
+        if grid is None:
+            coords = coords @ m_idx
+            coords += origin
+        for bit, group in enumerate(slabs):
+            selected = (flags & lut_type.type(1 << bit)) != 0
+            if not np.any(selected):
+                continue
+            if grid is None:
+                group.append(coords[selected])
+            else:
+                # the cells are reduced per group, as groups may overlap
+                group.append(_cell_centroids(coords[selected], cell).astype(dtype) @ m_idx + origin)
+
+    dims = img.GetDimension()
+    return dict((name, np.concatenate(group) if group else np.empty((0, dims), dtype=dtype))
+                for name, group in zip(groups, slabs))
+
+
+def _grid_cell(img: sitk.Image, grid: float, slab_size: int):
+    """
+    returns the cell size in voxels (x, y, z) of a grid spacing (in mm) and the slab size rounded up to whole cells,
+    so that no cell spans two slabs
+    """
+    cell = np.maximum(np.floor(np.divide(grid, img.GetSpacing())), 1).astype(np.int64)
+    return cell, int(np.ceil(slab_size / cell[2]) * cell[2])
+
+
+def _cell_centroids(coords: np.ndarray, cell: np.ndarray) -> np.ndarray:
+    """
+    returns the centroids (in float64) of the (x, y, z) index coordinates in each occupied cell of the grid
+    """
+    keys = np.floor_divide(coords, cell).astype(np.int64)
+    _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    sums = np.stack(list(np.bincount(inverse, weights=coords[:, d], minlength=len(counts))
+                         for d in range(coords.shape[1])), axis=-1)
+    return sums / counts[:, None]
+
+
+def _index_to_physical(img: sitk.Image, dtype=np.float64):
+    """
+    returns the matrix and offset to convert (x, y, z) index rows of a 3d image to physical points: idx @ m + offset
+    """
+    dims = img.GetDimension()
+    if dims != 3:
+        raise RuntimeError("Invalid image dimension: {}".format(dims))
+    m_dir = np.asarray(img.GetDirection()).reshape([dims] * 2)
+    m_idx = (m_dir @ np.multiply(img.GetSpacing(), np.eye(dims))).T.astype(dtype)
+    return m_idx, np.asarray(img.GetOrigin(), dtype=dtype)
 
 
 def downsample(points, radius=1):
-    import point_cloud_utils as pcu
-    mask = pcu.downsample_point_cloud_poisson_disk(points, -1, radius=radius)
-    return points[mask]
+    return downsample_points(points, radius)
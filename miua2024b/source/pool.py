@@ -0,0 +1,138 @@
+import multiprocessing as mp
+import signal
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from time import time
+from typing import Optional
+
+
+def _worker_processes(known: set) -> dict:
+    """
+    returns the worker processes of a pool by pid, as the executor has no public access to its processes: the children
+    of this process which are not known, i.e., which were not running before the pool was started. the processes are
+    kept by the caller, as their exit codes are needed after the pool forgot the workers which died
+    :param known: the pids of the children of this process before the pool was started
+    """
+    return dict((p.pid, p) for p in mp.active_children() if p.pid not in known)
+
+
+def _terminate(pool: ProcessPoolExecutor, processes: dict, grace: float=0.0) -> list:
+    """
+    stops the worker processes of a pool, including those running a task, which a shutdown would wait for
+    :param processes: the worker processes by pid, see _worker_processes
+    :param grace: time in seconds to wait for each worker to exit by itself, e.g., the workers of a broken pool,
+    which are stopped by the pool
+    :return: the exit codes of workers which died before, i.e., which were not terminated here or by the pool
+    """
+    processes = list(processes.values())
+    for p in processes:
+        p.join(timeout=grace)
+    exit_codes = list(p.exitcode for p in processes if p.exitcode not in (None, 0, -signal.SIGTERM))
+    for p in processes:
+        if p.exitcode is None:
+            p.terminate()
+    pool.shutdown(wait=True, cancel_futures=True)
+    return exit_codes
+
+
+class IsolatingPool:
+    """
+    pool of worker processes which finds the task that crashed a worker: a worker which dies, e.g., by a segfault or
+    the OOM killer, breaks the pool and fails all tasks in flight. a single task fails with the exit code, if several
+    tasks were in flight they are returned to be rerun, and are run one at a time afterwards. the pool is (re)started
+    when a task is submitted
+    used by the batch registration (see batch.run_batch) and the dataset build of midl2024
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # tasks in flight by future: (key, task, start time)
+        self.running = dict()
+        # keys of the tasks in flight when a worker died, which are run alone
+        self.isolated = set()
+        self._pool = None
+        self._processes = dict()
+        self._known = set()
+
+    def can_submit(self, key) -> bool:
+        """
+        whether a task can be started now, i.e., a worker is idle and neither the task nor a running task is isolated
+        """
+        if len(self.running) >= self.workers:
+            return False
+        return not self.running or (key not in self.isolated
+                                    and not any(k in self.isolated for k, _, _ in self.running.values()))
+
+    def submit(self, key, task, fn, *args):
+        """
+        runs fn(*args) in a worker, the task is returned with its result, see wait
+        :param key: the key of the task, e.g., its index, to isolate it after a crash
+        :param task: the task, e.g., the job or node, which is returned with its result
+        """
+        if self._pool is None:
+            self._known = set(p.pid for p in mp.active_children())
+            self._pool, self._processes = ProcessPoolExecutor(self.workers), dict()
+        try:
+            # the executor starts the workers when the tasks are submitted
+            future = self._pool.submit(fn, *args)
+        except BrokenProcessPool as e:
+            if not self.running:
+                # a worker died without a task, the pool is restarted
+                _terminate(self._pool, self._processes)
+                self._pool = None
+                return self.submit(key, task, fn, *args)
+            # a worker died since the last wait, the task is returned to be rerun with those in flight, see wait
+            future = Future()
+            future.set_exception(e)
+        self.running[future] = (key, task, time())
+        self._processes.update(_worker_processes(self._known))
+
+    def wait(self, timeout: Optional[float]=None):
+        """
+        waits until a task finished or the timeout expired, nothing is returned if the timeout expired
+        :return: tuple of the finished tasks, a list of (task, start time, result, error), where the error is the
+        message of a task which crashed its worker and the result is None, and the tasks to rerun alone, a list of
+        (task, start time), as a worker died while they were in flight
+        """
+        finished, _ = wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+        done, crashed = list(), list()
+        for future in finished:
+            key, task, t0 = self.running.pop(future)
+            try:
+                done.append((task, t0, future.result(), None))
+            except BrokenProcessPool:
+                crashed.append((key, task, t0))
+        if not crashed:
+            return done, list()
+
+        # the pool is broken, which fails all tasks in flight
+        wait(self.running)
+        crashed.extend(self.running.values())
+        self.running.clear()
+        exit_codes = _terminate(self._pool, self._processes, grace=5.0)
+        self._pool = None
+        if len(crashed) > 1:
+            self.isolated.update(key for key, _, _ in crashed)
+            return done, list((task, t0) for _, task, t0 in crashed)
+        _, task, t0 = crashed[0]
+        err = "BrokenProcessPool: the worker process died{}".format(
+            " with exit code {}".format(", ".join(str(c) for c in exit_codes)) if exit_codes else "")
+        done.append((task, t0, None, err))
+        return done, list()
+
+    def stop(self) -> list:
+        """
+        stops the pool and its workers, e.g., to stop tasks which exceeded a timeout
+        :return: the tasks which were in flight, a list of (task, start time)
+        """
+        stopped = list((task, t0) for _, task, t0 in self.running.values())
+        if self._pool is not None:
+            _terminate(self._pool, self._processes)
+            self._pool = None
+        self.running.clear()
+        return stopped
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
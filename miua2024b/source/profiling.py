@@ -0,0 +1,182 @@
+import csv
+import functools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter, process_time
+from typing import Optional
+
+_profiler = None
+
+
+class _NullStage:
+    """
+    stage returned while profiling is disabled, ignores all values
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setitem__(self, key, value):
+        pass
+
+    def update(self, *args, **kwargs):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class _Stage(dict):
+    """
+    stage of an active profiler, values can be added as items while the stage is running
+    """
+
+    def __init__(self, profiler, name: str, **values):
+        super().__init__(values)
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.depth = len(self.profiler._stack())
+        self.profiler._stack().append(self)
+        self.t0, self.c0 = perf_counter(), process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall, cpu = perf_counter() - self.t0, process_time() - self.c0
+        self.profiler._stack().pop()
+        self.profiler.events.append(dict(name=self.name, start=self.t0 - self.profiler.t0, wall=wall, cpu=cpu,
+                                         depth=self.depth, pid=os.getpid(), tid=threading.get_ident(),
+                                         values=dict(self)))
+        return False
+
+
+class Profiler:
+    """
+    records the wall time, cpu time and values, e.g. point counts, of nested stages
+    """
+
+    def __init__(self):
+        self.events = list()
+        self.t0 = perf_counter()
+        self._local = threading.local()
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+        return self._local.stack
+
+    def stage(self, name: str, **values):
+        return _Stage(self, name, **values)
+
+
+def stage(name: str, **values):
+    """
+    returns a context measuring a stage of the active profiler, values can be added as items within the context:
+    with stage('downsample', points_in=len(points)) as s:
+        ...
+        s['points_out'] = len(res)
+    while profiling is disabled, a shared no-op context is returned
+    """
+    if _profiler is None:
+        return _null_stage
+    return _profiler.stage(name, **values)
+
+
+def record(**values):
+    """
+    adds values to the innermost running stage of the active profiler, does nothing while profiling is disabled
+    """
+    if _profiler is None:
+        return
+    stack = _profiler._stack()
+    if stack:
+        stack[-1].update(values)
+
+
+def profiled(name: str, **values):
+    """
+    decorator measuring each call of a function as a stage
+    :param name: name of the stage
+    :param values: functions of the result to add as values of the stage, e.g., points=len
+    """
+    def _decorator(fn):
+        @functools.wraps(fn)
+        def _wrapped(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _profiler.stage(name) as st:
+                res = fn(*args, **kwargs)
+                st.update((k, f(res)) for k, f in values.items())
+            return res
+        return _wrapped
+    return _decorator
+
+
+@contextmanager
+def profile(enabled=True):
+    """
+    context enabling a profiler for this process, yields the profiler or None if disabled
+    """
+    global _profiler
+    if not enabled:
+        yield None
+        return
+    prev = _profiler
+    _profiler = Profiler()
+    try:
+        yield _profiler
+    finally:
+        _profiler = prev
+
+
+def write_profile(events: list, path: str):
+    """
+    writes profiling events as .json or .csv, the values of the stages are flattened to columns for .csv
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.json':
+        with open(path, 'w') as f:
+            json.dump(events, f, indent=2, default=str)
+    elif ext == '.csv':
+        keys = list()
+        for e in events:
+            keys.extend(k for k in e['values'] if k not in keys)
+        fields = list(k for k in events[0] if k != 'values') if events else list()
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields + keys)
+            writer.writeheader()
+            for e in events:
+                row = dict((k, v) for k, v in e.items() if k != 'values')
+                row.update(e['values'])
+                writer.writerow(row)
+    else:
+        raise RuntimeError("Unsupported profile format: {}".format(ext))
+
+
+def write_trace(events: list, path: str):
+    """
+    writes profiling events as a Chrome trace file, which can be viewed with chrome://tracing or Perfetto
+    """
+    trace = list(dict(name=e['name'], ph='X', ts=e['start'] * 1e6, dur=e['wall'] * 1e6,
+                      pid=e.get('job', e['pid']), tid=e['tid'], args=dict(e['values'], cpu=e['cpu']))
+                 for e in events)
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents=trace, displayTimeUnit='ms'), f, default=str)
+
+
+def write_outputs(events: list, profile_path: Optional[str]=None, trace_path: Optional[str]=None):
+    """
+    writes the profiling events to the specified outputs, see write_profile and write_trace
+    """
+    if profile_path:
+        write_profile(events, profile_path)
+        print(f"Finished writing profile to: {profile_path}")
+    if trace_path:
+        write_trace(events, trace_path)
+        print(f"Finished writing trace to: {trace_path}")
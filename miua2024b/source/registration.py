@@ -1,97 +1,430 @@
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from time import time
+from typing import Optional
+
 import numpy as np
 
-from miua2024b.source.points import downsample_points, show_pointclouds, transform_points
+from miua2024b.source.cache import PointCache, make_key
+from miua2024b.source.lazy import lazy_import
+from miua2024b.source.points import as_pointcloud, downsample_points, show_pointclouds, transform_points
+from miua2024b.source.profiling import profiled, record, stage
+from miua2024b.source.sampling import PointSampler
 from miua2024b.source.util import default
 
+o3d = lazy_import('open3d')
+o3r = lazy_import('open3d.pipelines.registration')
+
+_random_lock = threading.Lock()
 
 
-def register_points_affine(moving, fixed, spacing_search: float = 1.0, spacing_refine: float = 0.5, show=False):
+@profiled('register_points_affine')
+def register_points_affine(moving, fixed, spacing_search: float = 1.0, spacing_refine: float = 0.5, show=False,
+                           cache: Optional[PointCache]=None, cache_keys: Optional[tuple]=None,
+                           icp_steps: int=1000, icp_tol: Optional[float]=None, icp_levels: Optional[list]=None,
+                           ransac_seeds: Optional[list]=None, ransac_scales: Optional[list]=None,
+                           ransac_fpfh: Optional[list]=None, ransac_workers: Optional[int]=None,
+                           ransac_budget: Optional[float]=None, downsampling='pcu', return_info=False):
     """
     uses a two-step global (ransac) and local (ICP) method to register two point clouds
-    :param moving: moving point cloud
+    :param moving: moving point cloud, the downsampled point clouds keep its floating point type, e.g. float32
     :param fixed: fixed point cloud
     :param spacing: fixed spacing to use during registration
+    :param cache: optional cache for the downsampled point clouds and features
+    :param cache_keys: keys identifying the content of the moving and fixed point cloud in the cache, see cache.make_key
+    :param icp_steps: the number of ICP runs per resolution level
+    :param icp_tol: tolerance (in mm) for the adaptive ICP schedule, see register_points_icp, None runs all steps
+    :param icp_levels: optional coarser resolutions (in mm for the poison disk radius) to run ICP on before spacing_refine,
+    the threshold schedule of each level continues from the lower bound of the previous level
+    :param ransac_seeds: seeds for multiple global registration hypotheses, see register_points_ransac_multi,
+    if neither ransac_seeds, ransac_scales nor ransac_fpfh are set, a single RANSAC registration is run
+    :param ransac_scales: voxel sizes of the hypotheses relative to spacing_search
+    :param ransac_fpfh: FPFH radii of the hypotheses relative to the voxel size
+    :param ransac_workers: number of worker processes for the hypotheses
+    :param ransac_budget: optional wall-clock limit in seconds for the hypotheses
+    :param downsampling: method to downsample the point clouds with, see points.downsample_indices, for the grid-based
+    methods the FPFH features of the global registration are computed on grid samples as well
+    :param return_info: whether to also return a dictionary with the number of ICP runs ('icp_steps'),
+    the final 'fitness' and 'inlier_rmse'
     :return: affine registration matrix
     """
-    moving_down = downsample_points(moving, spacing_search)
-    fixed_down = downsample_points(fixed, spacing_search)
-    tm1 = register_points_ransac_open3d(moving_down, fixed_down, spacing=spacing_search)
+    moving_key, fixed_key = default(cache_keys, (None, None))
+    fpfh_sampling = 'open3d' if downsampling == 'pcu' else 'grid'
+    clouds = dict(moving=moving, fixed=fixed)
+    # the open3d point clouds are built once per resolution and shared by the RANSAC and ICP stages
+    levels = dict()
+
+    def _downsample(name, radius, key):
+        if (name, radius) in levels:
+            return levels[name, radius]
+        points = clouds[name]
+
+        def _fn():
+            # the spatial hashes of the grid-based methods depend on the radius, so no sampler is shared
+            return downsample_points(points, radius, method=downsampling)
+
+        if cache is None or key is None:
+            levels[name, radius] = as_pointcloud(_fn()), None
+        else:
+            key = make_key(key, downsampling, radius)
+            levels[name, radius] = as_pointcloud(cache.cached(key, _fn)), key
+        return levels[name, radius]
+
+    moving_down, moving_down_key = _downsample('moving', spacing_search, moving_key)
+    fixed_down, fixed_down_key = _downsample('fixed', spacing_search, fixed_key)
+    if ransac_seeds is None and ransac_scales is None and ransac_fpfh is None:
+        tm1 = register_points_ransac_open3d(moving_down, fixed_down, spacing=spacing_search,
+                                            cache=cache, cache_keys=(moving_down_key, fixed_down_key),
+                                            fpfh_sampling=fpfh_sampling)
+    else:
+        tm1 = register_points_ransac_multi(moving_down, fixed_down, spacing=spacing_search,
+                                           seeds=default(ransac_seeds, (0, )), scales=default(ransac_scales, (1.0, )),
+                                           fpfh_factors=default(ransac_fpfh, (5.0, )),
+                                           workers=ransac_workers, budget=ransac_budget, fpfh_sampling=fpfh_sampling)
 
-    moving_down = downsample_points(moving, spacing_refine)
-    fixed_down = downsample_points(fixed, spacing_refine)
-    tm2 = register_points_icp(moving_down, fixed_down, tm1, t_bounds=(5 * spacing_refine, 0.5 * spacing_refine), t_steps=1000)
+    tm2 = tm1
+    steps = 0
+    t_upper = None
+    for spacing in sorted(default(icp_levels, []), reverse=True) + [spacing_refine]:
+        moving_down, _ = _downsample('moving', spacing, moving_key)
+        fixed_down, _ = _downsample('fixed', spacing, fixed_key)
+        t_bounds = (default(t_upper, 5 * spacing), 0.5 * spacing)
+        tm2, info = register_points_icp(moving_down, fixed_down, tm2, t_bounds=t_bounds, t_steps=icp_steps,
+                                        tol_transform=icp_tol, return_info=True)
+        steps += info['steps']
+        t_upper = t_bounds[1]
 
+    record(icp_steps=steps)
     if show:
-        show_pointclouds([moving_down, transform_points(moving_down, tm2), fixed_down])
+        # the points are passed as arrays, as show_pointclouds only paints those
+        moving_points, fixed_points = np.asarray(moving_down.points), np.asarray(fixed_down.points)
+        show_pointclouds([moving_points, transform_points(moving_points, tm2), fixed_points])
+    if return_info:
+        return tm2, dict(icp_steps=steps, fitness=info['fitness'], inlier_rmse=info['inlier_rmse'])
     return tm2
 
 
-def register_points_icp(moving, fixed, t_init=None, t_bounds=None, t_steps=None, max_its=100):
+@profiled('register_points_symmetric')
+def register_points_symmetric(moving, fixed, cache_keys: Optional[tuple]=None, parallel=True, **kwargs):
+    """
+    registers two point clouds in both directions and measures the inverse consistency of the results:
+    the round trip through the forward and the backward transform should return each point to its position,
+    a large consistency error indicates that (at least) one of the registrations failed, e.g., a wrong RANSAC result
+    :param moving: moving point cloud
+    :param fixed: fixed point cloud
+    :param cache_keys: keys identifying the content of the moving and fixed point cloud in the cache
+    :param parallel: whether to run the directions concurrently, in threads as open3d releases the GIL, only seeded
+    RANSAC stages are serialized, see register_points_ransac_open3d
+    :param kwargs: parameters of both registrations, see register_points_affine
+    :return: tuple of the forward (moving to fixed) and backward (fixed to moving) affine registration matrices and
+    a quality dictionary with the 'fitness' and 'inlier_rmse' of both directions (the backward ones as
+    'fitness_inverse' and 'inlier_rmse_inverse'), the total 'icp_steps' and the root mean square and maximum
+    round trip distance ('consistency_error' and 'consistency_max', in mm) of the points of both clouds
+    """
+    moving_key, fixed_key = default(cache_keys, (None, None))
+    kwargs = dict(kwargs, show=False, return_info=True)
+    args = [(moving, fixed, (moving_key, fixed_key)), (fixed, moving, (fixed_key, moving_key))]
+    if parallel:
+        with ThreadPoolExecutor(2) as ex:
+            futures = list(ex.submit(register_points_affine, a, b, cache_keys=keys, **kwargs) for a, b, keys in args)
+            (tm_fwd, info_fwd), (tm_bwd, info_bwd) = (f.result() for f in futures)
+    else:
+        (tm_fwd, info_fwd), (tm_bwd, info_bwd) = (register_points_affine(a, b, cache_keys=keys, **kwargs)
+                                                  for a, b, keys in args)
+
+    tm_fwd, tm_bwd = np.asarray(tm_fwd), np.asarray(tm_bwd)
+    errors = list()
+    for points, tm in ((moving, tm_bwd @ tm_fwd), (fixed, tm_fwd @ tm_bwd)):
+        # in float64, so that the error is not bounded by the precision of float32 points
+        points = np.asarray(points.points) if isinstance(points, o3d.geometry.PointCloud) else np.asarray(points, dtype=np.float64)
+        errors.append(np.linalg.norm(transform_points(points, tm) - points, axis=-1))
+    errors = np.concatenate(errors)
+
+    quality = dict(fitness=info_fwd['fitness'], inlier_rmse=info_fwd['inlier_rmse'],
+                   fitness_inverse=info_bwd['fitness'], inlier_rmse_inverse=info_bwd['inlier_rmse'],
+                   icp_steps=info_fwd['icp_steps'] + info_bwd['icp_steps'],
+                   consistency_error=float(np.sqrt(np.mean(np.square(errors)))) if len(errors) else 0.0,
+                   consistency_max=float(errors.max(initial=0.0)))
+    record(consistency_error=quality['consistency_error'], consistency_max=quality['consistency_max'])
+    return tm_fwd, tm_bwd, quality
+
+
+def is_suspicious(quality: dict, max_consistency: float=1.0, min_fitness: float=0.1) -> bool:
+    """
+    returns whether the quality of a symmetric registration indicates a failure, see register_points_symmetric
+    :param quality: quality dictionary of the registration
+    :param max_consistency: the maximum root mean square round trip distance in mm
+    :param min_fitness: the minimum fitness (overlap ratio) of either direction
+    """
+    return bool(quality['consistency_error'] > max_consistency
+                or min(quality['fitness'], quality['fitness_inverse']) < min_fitness)
+
+
+@profiled('register_points_icp')
+def register_points_icp(moving, fixed, t_init=None, t_bounds=None, t_steps=None, max_its=100,
+                        tol_transform: Optional[float]=None, tol_fitness: float=1e-2, tol_rmse: float=1e-2,
+                        patience: int=3, return_info=False):
     """
     uses the open3d implementation of ICP to register two point clouds
+    the ICP threshold follows a cubic schedule from the upper to the lower bound. if a tolerance is set, the schedule
+    is adaptive: once the transform, fitness and inlier RMSE changed less than their tolerances for patience
+    consecutive runs, the schedule is traversed with doubling strides until a run does not converge, the last run is
+    always at the lower bound.
     :param moving: moving point cloud
     :param fixed: destination point cloud
     :param t_init: initial transformation
     :param t_bounds: the upper and lower bound for the ICP threshold
     :param t_steps: the number of ICP runs to execute
     :param max_its: the maximum number of iterations per ICP run
+    :param tol_transform: tolerance for the transform change (in mm, as the maximum displacement of the moving point
+    cloud's bounding box corners), None disables the early stopping
+    :param tol_fitness: tolerance for the change of the fitness (overlap ratio)
+    :param tol_rmse: tolerance for the change of the inlier RMSE (in mm)
+    :param patience: number of consecutive converged runs before stopping
+    :param return_info: whether to also return a dictionary with the number of runs ('steps'),
+    the final 'fitness' and 'inlier_rmse'
     :return: affine registration matrix
     """
-    import open3d as o3d
-    import open3d.pipelines.registration as o3r
-
     t_bounds = default(t_bounds, (1, 1))
     t_steps = default(t_steps, 1)
     t_init = default(t_init, np.eye(4))
 
-    moving = moving if isinstance(moving, o3d.geometry.PointCloud) else o3d.geometry.PointCloud(o3d.utility.Vector3dVector(moving))
-    fixed = fixed if isinstance(fixed, o3d.geometry.PointCloud) else o3d.geometry.PointCloud(o3d.utility.Vector3dVector(fixed))
+    moving, fixed = as_pointcloud(moving), as_pointcloud(fixed)
 
-    t_curr = t_init
-    for i in range(t_steps):
-        t_fac = np.power((t_steps - i) / t_steps, 3)
-        threshold = t_bounds[0] * t_fac + t_bounds[1] * (1 - t_fac)
+    corners = np.asarray(moving.get_axis_aligned_bounding_box().get_box_points())
 
+    def _run(threshold, t_curr):
         est = o3r.TransformationEstimationPointToPoint()
         crit = o3r.ICPConvergenceCriteria()
         crit.max_iteration = max_its
-        res = o3r.registration_icp(moving, fixed, threshold, t_curr, est, crit)
+        return o3r.registration_icp(moving, fixed, threshold, t_curr, est, crit)
+
+    t_curr = t_init
+    res = None
+    converged = 0
+    steps = 0
+    stride = 1
+    i = 0
+    while i < t_steps:
+        t_fac = np.power((t_steps - i) / t_steps, 3)
+        threshold = t_bounds[0] * t_fac + t_bounds[1] * (1 - t_fac)
+
+        prev = res
+        res = _run(threshold, t_curr)
+        steps += 1
+        if tol_transform is not None and prev is not None:
+            delta = np.max(np.linalg.norm(transform_points(corners, res.transformation) - transform_points(corners, t_curr), axis=-1))
+            if (delta < tol_transform and abs(res.fitness - prev.fitness) < tol_fitness
+                    and abs(res.inlier_rmse - prev.inlier_rmse) < tol_rmse):
+                converged += 1
+            else:
+                converged = 0
+            # skip ahead in the schedule while converged, fall back to single steps otherwise
+            stride = stride * 2 if converged >= patience else max(1, stride // 2)
         t_curr = res.transformation
+        i = min(i + stride, t_steps - 1) if i + 1 < t_steps else t_steps
 
+    record(steps=steps, fitness=res.fitness, inlier_rmse=res.inlier_rmse,
+           points_moving=len(moving.points), points_fixed=len(fixed.points))
+    if return_info:
+        return res.transformation, dict(steps=steps, fitness=res.fitness, inlier_rmse=res.inlier_rmse)
     return res.transformation
 
 
-def register_points_ransac_open3d(moving, fixed, maxit=1000000, spacing:float =3, max_nn=30):
+@profiled('register_points_ransac_open3d')
+def register_points_ransac_open3d(moving, fixed, maxit=1000000, spacing:float =3, max_nn=30,
+                                  cache: Optional[PointCache]=None, cache_keys: Optional[tuple]=None,
+                                  fpfh_factor: float=5, seed: Optional[int]=None, fpfh_sampling='open3d',
+                                  return_info=False):
     """
     uses the open3d implementation of RANSAC to perform global registration of two point clouds
     :param moving: moving point cloud
     :param fixed: destination point cloud
-    :param t_init: initial transformation
-    :param t_bounds: the upper and lower bound for the ICP threshold
-    :param t_steps: the number of ICP runs to execute
-    :param max_its: the maximum number of iterations per ICP run
+    :param maxit: the maximum number of RANSAC iterations
+    :param spacing: voxel size to downsample the point clouds to before computing the FPFH features
+    :param max_nn: the maximum number of neighbours for the FPFH features (times 3)
+    :param cache: optional cache for the downsampled point clouds and features
+    :param cache_keys: keys identifying the content of the moving and fixed point cloud in the cache, see cache.make_key
+    :param fpfh_factor: radius of the FPFH features relative to the spacing
+    :param seed: optional seed for the open3d random generator
+    :param fpfh_sampling: how to downsample the point clouds to the voxel size, 'open3d' for the centroids of the
+    occupied voxels (default) or 'grid' for the point closest to each centroid, see sampling.PointSampler.voxel
+    :param return_info: whether to also return a dictionary with the 'fitness' and 'inlier_rmse' of the result
     :return: affine registration matrix
     """
-
-    import open3d as o3d
-    import open3d.pipelines.registration as o3r
     kdtype = o3d.geometry.KDTreeSearchParamHybrid
 
-    moving = moving if isinstance(moving, o3d.geometry.PointCloud) else o3d.geometry.PointCloud(o3d.utility.Vector3dVector(moving))
-    fixed = fixed if isinstance(fixed, o3d.geometry.PointCloud) else o3d.geometry.PointCloud(o3d.utility.Vector3dVector(fixed))
+    moving, fixed = as_pointcloud(moving), as_pointcloud(fixed)
+
+    def _preprocess(pcd, voxel_size, key=None):
+        if cache is not None and key is not None:
+            key = make_key(key, 'fpfh', fpfh_sampling, voxel_size, max_nn, fpfh_factor)
+            points, features = cache.get(key + '.points'), cache.get(key + '.features')
+            if points is not None and features is not None:
+                pcd_down = as_pointcloud(points)
+                pcd_fpfh = o3r.Feature()
+                pcd_fpfh.data = np.asarray(features)
+                return pcd_down, pcd_fpfh
 
-    def _preprocess(pcd, voxel_size):
-        pcd_down = pcd.voxel_down_sample(voxel_size)
-        pcd_down.normals = o3d.utility.Vector3dVector(np.repeat((0, 1, 0), len(pcd_down.points)).reshape((3, -1)).T)
-        pcd_fpfh = o3r.compute_fpfh_feature(pcd_down, kdtype(radius=voxel_size * 5, max_nn=3*max_nn))
+        with stage('fpfh', voxel_size=voxel_size, points_in=len(pcd.points)) as st:
+            if fpfh_sampling == 'open3d':
+                pcd_down = pcd.voxel_down_sample(voxel_size)
+            elif fpfh_sampling == 'grid':
+                pcd_down = pcd.select_by_index(PointSampler(np.asarray(pcd.points)).voxel(voxel_size))
+            else:
+                raise RuntimeError("Unsupported FPFH sampling method: {}".format(fpfh_sampling))
+            pcd_down.normals = o3d.utility.Vector3dVector(np.tile([0.0, 1.0, 0.0], (len(pcd_down.points), 1)))
+            pcd_fpfh = o3r.compute_fpfh_feature(pcd_down, kdtype(radius=voxel_size * fpfh_factor, max_nn=3*max_nn))
+            st['points_out'] = len(pcd_down.points)
+        if cache is not None and key is not None:
+            cache.put(key + '.points', np.asarray(pcd_down.points))
+            cache.put(key + '.features', pcd_fpfh.data)
         return pcd_down, pcd_fpfh
 
+    moving_key, fixed_key = default(cache_keys, (None, None))
     distance_threshold = spacing * 1.5
-    moving_down, moving_fpfh = _preprocess(moving, spacing)
-    fixed_down, fixed_fpfh = _preprocess(fixed, spacing)
-    res = o3r.registration_ransac_based_on_feature_matching(
-        moving_down, fixed_down, moving_fpfh, fixed_fpfh, True,
-        distance_threshold,
-        o3r.TransformationEstimationPointToPoint(False), 3,
-        [o3r.CorrespondenceCheckerBasedOnDistance(distance_threshold)], o3r.RANSACConvergenceCriteria(maxit, 0.999))
+    moving_down, moving_fpfh = _preprocess(moving, spacing, moving_key)
+    fixed_down, fixed_fpfh = _preprocess(fixed, spacing, fixed_key)
+    # the random generator of open3d is global to the process, so that seeding and running RANSAC are serialized
+    # for concurrent seeded registrations in threads to keep the result of each seed. unseeded registrations do not
+    # need a reproducible state and run concurrently, e.g., the two directions of register_points_symmetric
+    with _random_lock if seed is not None else nullcontext():
+        if seed is not None:
+            o3d.utility.random.seed(seed)
+        res = o3r.registration_ransac_based_on_feature_matching(
+            moving_down, fixed_down, moving_fpfh, fixed_fpfh, True,
+            distance_threshold,
+            o3r.TransformationEstimationPointToPoint(False), 3,
+            [o3r.CorrespondenceCheckerBasedOnDistance(distance_threshold)], o3r.RANSACConvergenceCriteria(maxit, 0.999))
+    record(fitness=res.fitness, inlier_rmse=res.inlier_rmse,
+           points_moving=len(moving_down.points), points_fixed=len(fixed_down.points))
+    if return_info:
+        return res.transformation, dict(fitness=res.fitness, inlier_rmse=res.inlier_rmse)
     return res.transformation
+
+
+def _pool_context():
+    """
+    returns the multiprocessing context of the RANSAC hypotheses. forking this process is not safe, as it may run
+    threads of open3d (OpenMP) or of a symmetric registration, see register_points_symmetric. the workers are forked
+    from a server process instead, which preloads open3d once, or spawned where a server is not supported
+    """
+    if 'forkserver' not in mp.get_all_start_methods():
+        return mp.get_context('spawn')
+    ctx = mp.get_context('forkserver')
+    ctx.set_forkserver_preload(['open3d', __name__])
+    return ctx
+
+
+@profiled('register_points_ransac_multi')
+def register_points_ransac_multi(moving, fixed, spacing: float=3, seeds=(0, ), scales=(1.0, ), fpfh_factors=(5.0, ),
+                                 top: int=3, refine_steps: int=20, workers: Optional[int]=None,
+                                 budget: Optional[float]=None, maxit=1000000, max_nn=30, fpfh_sampling='open3d',
+                                 return_info=False):
+    """
+    runs multiple global RANSAC registrations (hypotheses) concurrently and selects the best one:
+    one hypothesis is run for each combination of seed, voxel size (spacing times scale) and FPFH radius factor.
+    the top hypotheses by RANSAC fitness are refined using a short ICP, the best refined result by fitness and
+    inlier RMSE (evaluated at the RANSAC distance threshold of the spacing) is returned.
+    the result is deterministic for fixed parameters, unless the budget is exhausted.
+    :param moving: moving point cloud
+    :param fixed: destination point cloud
+    :param spacing: base voxel size for the RANSAC registration
+    :param seeds: seeds for the open3d random generator
+    :param scales: factors for the voxel size relative to the spacing
+    :param fpfh_factors: radii of the FPFH features relative to the voxel size
+    :param top: the number of hypotheses to refine
+    :param refine_steps: the number of ICP runs to refine each hypothesis with
+    :param workers: number of worker processes, defaults to the number of hypotheses (up to the number of cpus),
+    for 0 the hypotheses are run sequentially in this process
+    :param budget: optional wall-clock limit in seconds for the RANSAC hypotheses, unfinished hypotheses are dropped,
+    as are failed hypotheses, the error of the first failed hypothesis is raised if none succeeded
+    :param maxit: the maximum number of RANSAC iterations per hypothesis
+    :param max_nn: the maximum number of neighbours for the FPFH features (times 3)
+    :param fpfh_sampling: how to downsample the point clouds for the FPFH features, see register_points_ransac_open3d
+    :param return_info: whether to also return a dictionary with the number of finished hypotheses ('hypotheses'),
+    the selected hypothesis parameters ('seed', 'scale', 'fpfh_factor'), the 'fitness' and 'inlier_rmse'
+    :return: affine registration matrix
+    """
+    # the point clouds are refined with open3d, the hypotheses are passed the points as arrays
+    moving_pcl, fixed_pcl = as_pointcloud(moving), as_pointcloud(fixed)
+    moving, fixed = np.asarray(moving_pcl.points), np.asarray(fixed_pcl.points)
+
+    hypotheses = list(itertools.product(seeds, scales, fpfh_factors))
+    args = list((moving, fixed, spacing * scale, seed, factor, maxit, max_nn, fpfh_sampling)
+                for seed, scale, factor in hypotheses)
+    workers = default(workers, min(len(hypotheses), os.cpu_count()))
+    if mp.current_process().daemon:
+        # e.g. within a worker of the batch registration, which may not have children
+        workers = 0
+
+    t0 = time()
+    results = dict()
+    # a failed hypothesis is dropped like an unfinished one, its error is raised if no hypothesis succeeded
+    errors = dict()
+    if workers <= 0:
+        for idx, a in enumerate(args):
+            if budget is not None and time() - t0 > budget:
+                break
+            try:
+                results[idx] = _ransac_hypothesis(*a)
+            except Exception as e:
+                errors[idx] = e
+    else:
+        done = queue.Queue()
+        pool = _pool_context().Pool(min(workers, len(args)))
+        try:
+            for idx, a in enumerate(args):
+                pool.apply_async(_ransac_hypothesis, a, callback=lambda r, i=idx: done.put((i, r, None)),
+                                 error_callback=lambda e, i=idx: done.put((i, None, e)))
+            for _ in range(len(args)):
+                wait = None if budget is None else max(0.0, t0 + budget - time())
+                try:
+                    idx, res, err = done.get(timeout=wait)
+                except queue.Empty:
+                    break
+                if err is None:
+                    results[idx] = res
+                else:
+                    errors[idx] = err
+        finally:
+            pool.terminate()
+            pool.join()
+    if not results and errors:
+        raise errors[min(errors)]
+    if not results:
+        raise RuntimeError("No global registration hypothesis finished within the budget")
+
+    # refine the best hypotheses, ties are resolved by the hypothesis order
+    threshold = spacing * 1.5
+    ranked = sorted(results, key=lambda i: (-results[i][1], results[i][2], i))[:top]
+    best = None
+    for idx in ranked:
+        tm = register_points_icp(moving_pcl, fixed_pcl, results[idx][0], t_bounds=(threshold, 0.5 * spacing), t_steps=refine_steps)
+        ev = o3r.evaluate_registration(moving_pcl, fixed_pcl, threshold, tm)
+        if best is None or (ev.fitness, -ev.inlier_rmse) > (best[2], -best[3]):
+            best = (idx, tm, ev.fitness, ev.inlier_rmse)
+
+    idx, tm, fitness, rmse = best
+    record(hypotheses=len(results), selected=idx, fitness=fitness, inlier_rmse=rmse)
+    if return_info:
+        seed, scale, factor = hypotheses[idx]
+        return tm, dict(hypotheses=len(results), seed=seed, scale=scale, fpfh_factor=factor,
+                        fitness=fitness, inlier_rmse=rmse)
+    return tm
+
+
+def _ransac_hypothesis(moving, fixed, spacing, seed, fpfh_factor, maxit, max_nn, fpfh_sampling):
+    """
+    runs a single global registration hypothesis, see register_points_ransac_multi
+    :return: tuple of the registration matrix, fitness and inlier rmse
+    """
+    tm, info = register_points_ransac_open3d(moving, fixed, maxit=maxit, spacing=spacing, max_nn=max_nn,
+                                             fpfh_factor=fpfh_factor, seed=seed, fpfh_sampling=fpfh_sampling,
+                                             return_info=True)
+    return np.asarray(tm), info['fitness'], info['inlier_rmse']
@@ -0,0 +1,352 @@
+from __future__ import annotations
+
+import argparse
+import itertools
+import sys
+from typing import Optional
+
+import numpy as np
+
+from miua2024b.source.lazy import lazy_import
+from miua2024b.source.profiling import profiled, stage
+from miua2024b.source.volume import Volume, get_array, is_volume_path, load_volume, read_volume
+
+sitk = lazy_import('SimpleITK')
+
+# names of the SimpleITK interpolators, which are resolved on use so that SimpleITK is imported lazily
+_interpolators = {
+    'nearest': 'sitkNearestNeighbor',
+    'label_gaussian': 'sitkLabelGaussian',
+    'linear': 'sitkLinear',
+    'bspline': 'sitkBSpline',
+}
+
+_nrrd_types = {
+    'int8': 'signed char', 'uint8': 'unsigned char', 'int16': 'short', 'uint16': 'unsigned short',
+    'int32': 'int', 'uint32': 'unsigned int', 'int64': 'long long int', 'uint64': 'unsigned long long int',
+    'float32': 'float', 'float64': 'double',
+}
+
+
+def is_label_image(img: sitk.Image) -> bool:
+    """
+    returns whether an image is a label map, i.e., has a scalar integer pixel type
+    """
+    return img.GetNumberOfComponentsPerPixel() == 1 and np.issubdtype(get_array(img).dtype, np.integer)
+
+
+def get_interpolator(img: sitk.Image, interpolator=None, labels: Optional[bool]=None):
+    """
+    returns the SimpleITK interpolator to resample an image with
+    :param img: image to resample
+    :param interpolator: name ('nearest', 'label_gaussian', 'linear' or 'bspline') or SimpleITK interpolator,
+    by default nearest neighbour for label maps and linear for intensity images
+    :param labels: whether the image is a label map, by default derived from the pixel type, see is_label_image
+    """
+    if interpolator is None:
+        labels = is_label_image(img) if labels is None else labels
+        return sitk.sitkNearestNeighbor if labels else sitk.sitkLinear
+    if isinstance(interpolator, str):
+        if interpolator not in _interpolators:
+            raise RuntimeError("Unsupported interpolator: {}".format(interpolator))
+        return getattr(sitk, _interpolators[interpolator])
+    return interpolator
+
+
+def _margin(moving: sitk.Image, interpolator) -> int:
+    """
+    returns the margin (in voxels of the moving image) around the region mapped to a slab,
+    which covers the support of the interpolator
+    """
+    if interpolator == sitk.sitkLabelGaussian:
+        # the default sigma of 1 mm is cut off at 4 sigma
+        return int(np.ceil(4.0 / min(moving.GetSpacing()))) + 1
+    if interpolator in (sitk.sitkNearestNeighbor, sitk.sitkLinear):
+        return 1
+    # the B-spline prefilter has a global support but decays quickly
+    return 8
+
+
+def _region_reference(reference: sitk.Image, index, size) -> sitk.Image:
+    """
+    returns an empty image with the geometry of a region (index and size) of the reference
+    """
+    region = sitk.Image([int(s) for s in size], sitk.sitkUInt8)
+    region.SetSpacing(reference.GetSpacing())
+    region.SetDirection(reference.GetDirection())
+    region.SetOrigin(reference.TransformIndexToPhysicalPoint([int(i) for i in index]))
+    return region
+
+
+def _slab_reference(reference: sitk.Image, z0: int, z1: int) -> sitk.Image:
+    """
+    returns an empty image with the geometry of the slices z0 to z1 of the reference
+    """
+    return _region_reference(reference, (0, 0, z0), (reference.GetWidth(), reference.GetHeight(), z1 - z0))
+
+
+def _crop(moving, index, size) -> sitk.Image:
+    """
+    returns a region of the moving image, volumes are converted to an image of the region only
+    """
+    if isinstance(moving, Volume):
+        return moving.to_image(index, size)
+    return sitk.RegionOfInterest(moving, size, index)
+
+
+def _moving_source(moving, slab: sitk.Image, tf: sitk.Transform, interpolator) -> sitk.Image:
+    """
+    returns the region of the moving image mapped to the slab by a linear transform as image
+    """
+    region = _moving_region(moving, slab, tf, _margin(moving, interpolator))
+    if region is None:
+        # the slab does not overlap the moving image
+        return _crop(moving, [0, 0, 0], [1, 1, 1])
+    return _crop(moving, *region)
+
+
+def _resample_bounded(resampler: sitk.ResampleImageFilter, moving, slab: sitk.Image, tf: sitk.Transform,
+                      interpolator, bounds, z0: int, default_value: float) -> sitk.Image:
+    """
+    resamples the part of a slab within the bounds (index and size of the reference grid),
+    the remaining voxels of the slab are set to the default value
+    """
+    dtype = get_array(moving).dtype
+    components = moving.GetNumberOfComponentsPerPixel()
+    size = slab.GetSize()
+    arr = np.full(size[::-1] + ((components, ) if components > 1 else ()), default_value, dtype=dtype)
+    (x0, y0, b0), (sx, sy, sz) = bounds
+    lower, upper = max(b0 - z0, 0), min(b0 + sz - z0, size[2])
+    if sx > 0 and sy > 0 and upper > lower:
+        region = _region_reference(slab, (x0, y0, lower), (sx, sy, upper - lower))
+        resampler.SetReferenceImage(region)
+        res = resampler.Execute(_moving_source(moving, region, tf, interpolator))
+        arr[lower:upper, y0:y0 + sy, x0:x0 + sx] = sitk.GetArrayViewFromImage(res)
+    res = sitk.GetImageFromArray(arr, isVector=components > 1)
+    res.CopyInformation(slab)
+    return res
+
+
+def _moving_region(moving: sitk.Image, slab: sitk.Image, tf: sitk.Transform, margin: int):
+    """
+    returns the index and size of the region of the moving image mapped to the slab by a linear transform,
+    or None if the slab is outside of the moving image
+    """
+    size = np.asarray(slab.GetSize())
+    corners = list(slab.TransformContinuousIndexToPhysicalPoint(np.subtract(c, 0.5).tolist())
+                   for c in itertools.product(*zip(np.zeros(3), size.astype(np.float64))))
+    idx = np.asarray(list(moving.TransformPhysicalPointToContinuousIndex(tf.TransformPoint(c)) for c in corners))
+    lower = np.maximum(np.floor(idx.min(axis=0)).astype(int) - margin, 0)
+    upper = np.minimum(np.ceil(idx.max(axis=0)).astype(int) + margin + 1, moving.GetSize())
+    if np.any(upper <= lower):
+        return None
+    return lower.tolist(), (upper - lower).tolist()
+
+
+def reference_region(moving: sitk.Image, reference: sitk.Image, tf: sitk.Transform, index=None, size=None,
+                     margin: int=1):
+    """
+    returns the region of the reference grid, which a region of the moving image is mapped to by a linear transform
+    :param moving: moving image or volume
+    :param reference: image or volume defining the output grid
+    :param tf: transform mapping points of the reference to the moving image, see sitk.Resample
+    :param index: first voxel (x, y, z) of the region of the moving image, defaults to the whole image
+    :param size: size (x, y, z) of the region of the moving image
+    :param margin: margin in voxels of the reference added on each side
+    :return: index and size (x, y, z) of the region, the size is zero if the region is mapped outside of the grid
+    """
+    index = np.zeros(3) if index is None else np.asarray(index, dtype=np.float64)
+    size = np.asarray(moving.GetSize() if size is None else size, dtype=np.float64)
+    inverse = tf.GetInverse()
+    corners = list(moving.TransformContinuousIndexToPhysicalPoint(np.add(index, c).tolist())
+                   for c in itertools.product(*zip(np.full(3, -0.5), size - 0.5)))
+    idx = np.asarray(list(reference.TransformPhysicalPointToContinuousIndex(inverse.TransformPoint(c))
+                          for c in corners))
+    lower = np.maximum(np.floor(idx.min(axis=0)).astype(int) - margin, 0)
+    upper = np.minimum(np.ceil(idx.max(axis=0)).astype(int) + margin + 1, reference.GetSize())
+    return lower.tolist(), np.maximum(upper - lower, 0).tolist()
+
+
+def iter_resampled_slabs(moving: sitk.Image, reference: sitk.Image, tf: Optional[sitk.Transform]=None,
+                         interpolator=None, labels: Optional[bool]=None, slab_size: int=32,
+                         threads: Optional[int]=None, default_value: float=0.0, extent=None):
+    """
+    resamples the moving image onto the grid of the reference image slab by slab (along the last axis),
+    so that only a slab of the output is held in memory at a time.
+    for linear transforms, each slab is resampled from the region of the moving image it maps to,
+    which bounds the work of interpolators with a global prefilter (B-spline) to the slab.
+    given the extent of the moving image, only the region of the grid it maps to is resampled
+    :param moving: image or memory-mapped volume to resample, see volume.Volume,
+    volumes are only converted to images region by region for linear transforms
+    :param reference: image or volume defining the output grid
+    :param tf: transform mapping points of the reference to the moving image, see sitk.Resample, defaults to identity
+    :param interpolator: interpolator, see get_interpolator
+    :param labels: whether the moving image is a label map, see get_interpolator
+    :param slab_size: the number of slices per slab
+    :param threads: number of threads to resample each slab with, defaults to the SimpleITK default
+    :param default_value: value of voxels mapped outside of the moving image
+    :param extent: optional region (index and size) of the moving image outside of which all voxels have the
+    default value, e.g. the bounding box of the labels (see roi.LabelProjections), applies to linear transforms
+    :return: generator of the first slice index and the resampled slab
+    """
+    tf = sitk.Transform(3, sitk.sitkIdentity) if tf is None else tf
+    interpolator = get_interpolator(moving, interpolator, labels=labels)
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetTransform(tf)
+    resampler.SetInterpolator(interpolator)
+    resampler.SetDefaultPixelValue(default_value)
+    resampler.SetOutputPixelType(moving.GetPixelID())
+    if threads is not None:
+        resampler.SetNumberOfThreads(threads)
+
+    n_slices = reference.GetDepth()
+    bounds = None
+    if extent is not None and tf.IsLinear():
+        margin = _margin(moving, interpolator)
+        index = np.maximum(np.subtract(extent[0], margin), 0)
+        size = np.minimum(np.add(extent[0], extent[1]) + margin, moving.GetSize()) - index
+        bounds = reference_region(moving, reference, tf, index, size) if np.all(np.greater(extent[1], 0)) \
+            else ([0, 0, 0], [0, 0, 0])
+    full = None
+    for z0 in range(0, n_slices, slab_size):
+        slab = _slab_reference(reference, z0, min(z0 + slab_size, n_slices))
+        if bounds is not None:
+            yield z0, _resample_bounded(resampler, moving, slab, tf, interpolator, bounds, z0, default_value)
+            continue
+        resampler.SetReferenceImage(slab)
+        if tf.IsLinear():
+            src = _moving_source(moving, slab, tf, interpolator)
+        else:
+            if full is None:
+                # non-linear transforms may map a slab anywhere, the whole moving image is needed
+                full = moving.to_image() if isinstance(moving, Volume) else moving
+            src = full
+        yield z0, resampler.Execute(src)
+
+
+class _NrrdWriter:
+    """
+    writes a raw NRRD file progressively, slab by slab along the last axis
+    """
+
+    def __init__(self, path: str, reference: sitk.Image, dtype, components: int=1):
+        self.path = path
+        self.reference = reference
+        self.dtype = np.dtype(dtype)
+        self.components = components
+        if self.dtype.name not in _nrrd_types:
+            raise RuntimeError("Unsupported pixel type for streaming: {}".format(self.dtype))
+
+    def __enter__(self):
+        spacing = np.asarray(self.reference.GetSpacing())
+        direction = np.asarray(self.reference.GetDirection()).reshape(3, 3)
+        axes = ' '.join('({})'.format(','.join(repr(float(v)) for v in d)) for d in (direction * spacing).T)
+        header = ['NRRD0004',
+                  'type: {}'.format(_nrrd_types[self.dtype.name]),
+                  'dimension: {}'.format(3 if self.components == 1 else 4),
+                  'space: left-posterior-superior',
+                  'sizes: {}'.format(' '.join(str(s) for s in ([] if self.components == 1 else [self.components])
+                                               + list(self.reference.GetSize()))),
+                  'space directions: {}{}'.format('' if self.components == 1 else 'none ', axes),
+                  'kinds: {}domain domain domain'.format('' if self.components == 1 else 'vector '),
+                  'endian: {}'.format(sys.byteorder),
+                  'encoding: raw',
+                  'space origin: ({})'.format(','.join(repr(float(v)) for v in self.reference.GetOrigin()))]
+        self.file = open(self.path, 'wb')
+        self.file.write(('\n'.join(header) + '\n\n').encode('ascii'))
+        return self
+
+    def write(self, slab: sitk.Image):
+        self.file.write(np.ascontiguousarray(sitk.GetArrayViewFromImage(slab), dtype=self.dtype).tobytes())
+
+    def __exit__(self, *exc):
+        self.file.close()
+        return False
+
+
+def _image_from_information(reader: sitk.ImageFileReader) -> sitk.Image:
+    """
+    returns an empty image with the geometry read by the reader
+    """
+    img = sitk.Image(reader.GetSize(), sitk.sitkUInt8)
+    img.SetSpacing(reader.GetSpacing())
+    img.SetOrigin(reader.GetOrigin())
+    img.SetDirection(reader.GetDirection())
+    return img
+
+
+@profiled('resample_image')
+def resample_image(moving, reference, tf: Optional[sitk.Transform]=None, output_path: Optional[str]=None,
+                   interpolator=None, labels: Optional[bool]=None, slab_size: int=32, threads: Optional[int]=None,
+                   default_value: float=0.0, extent=None) -> Optional[sitk.Image]:
+    """
+    resamples the moving image onto the grid of the reference image slab by slab, see iter_resampled_slabs.
+    uncompressed .nrrd outputs are written progressively, so that the output is never held in memory as a whole,
+    other formats are assembled in memory and written at once
+    :param moving: image, memory-mapped volume or path of the image to resample, see volume.read_volume
+    :param reference: image, volume or path of the image defining the output grid, only the image information is read
+    :param tf: transform mapping points of the reference to the moving image, see sitk.Resample, defaults to identity
+    :param output_path: optional path to write the result to
+    :param interpolator: interpolator, see get_interpolator
+    :param labels: whether the moving image is a label map, see get_interpolator
+    :param slab_size: the number of slices per slab
+    :param threads: number of threads to resample each slab with, defaults to the SimpleITK default
+    :param default_value: value of voxels mapped outside of the moving image
+    :param extent: optional region of the moving image outside of which all voxels have the default value,
+    see iter_resampled_slabs
+    :return: the resampled image, or None if it was written progressively
+    """
+    if isinstance(reference, str) and is_volume_path(reference):
+        reference = load_volume(reference)
+    elif isinstance(reference, str):
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(reference)
+        reader.ReadImageInformation()
+        reference = _image_from_information(reader)
+    if isinstance(moving, str):
+        with stage('read_image', path=moving):
+            moving = read_volume(moving)
+
+    slabs = iter_resampled_slabs(moving, reference, tf, interpolator=interpolator, labels=labels,
+                                 slab_size=slab_size, threads=threads, default_value=default_value, extent=extent)
+    dtype = get_array(moving).dtype
+    components = moving.GetNumberOfComponentsPerPixel()
+    if output_path is not None and output_path.lower().endswith('.nrrd'):
+        with _NrrdWriter(output_path, reference, dtype, components) as writer:
+            for _, slab in slabs:
+                writer.write(slab)
+        return None
+
+    shape = reference.GetSize()[::-1] + ((components, ) if components > 1 else ())
+    res = np.empty(shape, dtype=dtype)
+    for z0, slab in slabs:
+        res[z0:z0 + slab.GetDepth()] = sitk.GetArrayViewFromImage(slab)
+    res = sitk.GetImageFromArray(res, isVector=components > 1)
+    res.SetSpacing(reference.GetSpacing())
+    res.SetOrigin(reference.GetOrigin())
+    res.SetDirection(reference.GetDirection())
+    if output_path is not None:
+        sitk.WriteImage(res, output_path)
+    return res
+
+
+def entry_point():
+    parser = argparse.ArgumentParser(description='Resamples an image onto the grid of a reference image slab by slab.')
+    parser.add_argument('--moving', dest='moving', type=str, required=True, help="Image to resample")
+    parser.add_argument('--reference', dest='reference', type=str, required=True, help="Image defining the output grid, only its header is read")
+    parser.add_argument('--output', dest='output', type=str, required=True, help="Output path for the resampled image, uncompressed .nrrd files are written progressively")
+    parser.add_argument('--transform', dest='transform', type=str, default="", help="Transform mapping points of the reference to the moving image, e.g., the result of the registration, defaults to identity")
+    parser.add_argument('--interpolator', dest='interpolator', type=str, default=None, choices=list(_interpolators), help="Interpolator, by default nearest neighbour for label maps (integer pixel types) and linear for intensity images")
+    parser.add_argument('--labels', dest='labels', action='store_true', help="Whether to treat the moving image as label map regardless of its pixel type")
+    parser.add_argument('--slab-size', dest='slab_size', type=int, default=32, help="Number of slices to resample at once")
+    parser.add_argument('--threads', dest='threads', type=int, default=None, help="Number of threads to resample each slab with")
+    args, _ = parser.parse_known_args(args=sys.argv)
+
+    tf = sitk.ReadTransform(args.transform) if args.transform else None
+    resample_image(args.moving, args.reference, tf, output_path=args.output, interpolator=args.interpolator,
+                   labels=True if args.labels else None, slab_size=args.slab_size, threads=args.threads)
+    print(f"Finished writing results to: {args.output}")
+
+
+if __name__ == '__main__':
+    entry_point()
@@ -0,0 +1,153 @@
+from typing import Optional
+
+import numpy as np
+
+from miua2024b.source.cache import PointCache, make_key
+from miua2024b.source.profiling import profiled
+from miua2024b.source.util import as_list
+from miua2024b.source.volume import Volume, get_array, get_label_array
+
+# version of the cached projections
+_projections_version = 1
+
+
+class LabelProjections:
+    """
+    per-axis projections of a label image: for each label and axis, whether the label occurs in each slice.
+    the bounding box of any selection of labels follows from the projections without another pass over the image
+    """
+
+    def __init__(self, values: np.ndarray, table: np.ndarray, shape):
+        """
+        :param values: the sorted labels of the image
+        :param table: (n_labels, depth + height + width) array whether each label occurs in the slices of each axis
+        :param shape: shape of the image in (z, y, x) order
+        """
+        self.values = np.asarray(values)
+        self.table = np.asarray(table, dtype=bool)
+        self.shape = tuple(int(s) for s in shape)
+
+    @classmethod
+    def compute(cls, arr: np.ndarray, slab_size: int=16) -> 'LabelProjections':
+        """
+        computes the projections of a label array in (z, y, x) order slab by slab along the first axis.
+        each voxel is mapped to a bit of its label (for up to 64 labels at a time) and the bits are combined by a
+        bitwise or along the axes, which avoids a pass over the image per label
+        """
+        arr = get_label_array(arr, slab_size)
+        depth, height, width = arr.shape
+        slabs = range(0, depth, slab_size)
+
+        # labels of the image, small integer types are counted instead of sorted
+        small = arr.dtype.itemsize <= 2
+        lo = int(np.iinfo(arr.dtype).min) if small else 0
+        if small:
+            counts = np.zeros(int(np.iinfo(arr.dtype).max) - lo + 1, dtype=np.int64)
+            for z0 in slabs:
+                vals = arr[z0:z0 + slab_size]
+                counts += np.bincount((vals if lo == 0 else vals.astype(np.int64) - lo).ravel(),
+                                      minlength=len(counts))
+            values = np.flatnonzero(counts) + lo
+        else:
+            values = np.unique(np.concatenate(list(np.unique(arr[z0:z0 + slab_size]) for z0 in slabs) or [[]]))
+
+        table = np.zeros((len(values), depth + height + width), dtype=bool)
+        for g0 in range(0, len(values), 64):
+            group = values[g0:g0 + 64]
+            bit_type = np.min_scalar_type(2 ** len(group) - 1)
+            bits = np.left_shift(np.ones(len(group), dtype=np.uint64), np.arange(len(group), dtype=np.uint64))
+            bits = bits.astype(bit_type)
+            if small:
+                lut = np.zeros(len(counts), dtype=bit_type)
+                lut[group - lo] = bits
+            proj = np.zeros(depth + height + width, dtype=bit_type)
+            pz, py, px = proj[:depth], proj[depth:depth + height], proj[depth + height:]
+            for z0 in slabs:
+                vals = arr[z0:z0 + slab_size]
+                if small:
+                    b = lut[vals if lo == 0 else vals.astype(np.int64) - lo]
+                else:
+                    idx = np.minimum(np.searchsorted(group, vals), len(group) - 1)
+                    b = np.where(group[idx] == vals, bits[idx], bit_type.type(0))
+                pz[z0:z0 + len(vals)] = np.bitwise_or.reduce(b, axis=(1, 2))
+                py |= np.bitwise_or.reduce(b, axis=(0, 2))
+                px |= np.bitwise_or.reduce(b, axis=(0, 1))
+            table[g0:g0 + len(group)] = (proj[None] & bits[:, None]) != 0
+        return cls(values, table, arr.shape)
+
+    def to_array(self) -> np.ndarray:
+        """
+        returns the projections as a single array to cache: the labels in the first column and the table
+        """
+        return np.concatenate([self.values.astype(np.int64)[:, None], self.table], axis=1)
+
+    @classmethod
+    def from_array(cls, arr: np.ndarray, shape) -> 'LabelProjections':
+        """
+        returns the projections of an array created by to_array for an image of the shape in (z, y, x) order
+        """
+        return cls(arr[:, 0], arr[:, 1:] != 0, shape)
+
+    def bounds(self, labels, margin: int=0):
+        """
+        returns the bounding box of the selected labels
+        :param labels: collection of labels or a function of the label values returning whether to select them,
+        see points.labels_to_points
+        :param margin: margin in voxels added on each side, the box is clipped to the image
+        :return: index and size (x, y, z) of the box, or None if none of the labels occur
+        """
+        selected = labels(self.values) if callable(labels) else np.isin(self.values, as_list(labels))
+        selected = np.asarray(selected, dtype=bool)
+        if not np.any(selected):
+            return None
+        occupied = np.any(self.table[selected], axis=0)
+        index, size = list(), list()
+        offset = 0
+        for n in self.shape:
+            idx = np.flatnonzero(occupied[offset:offset + n])
+            offset += n
+            lower, upper = max(int(idx[0]) - margin, 0), min(int(idx[-1]) + margin + 1, n)
+            index.append(lower)
+            size.append(upper - lower)
+        return index[::-1], size[::-1]
+
+
+@profiled('label_projections')
+def label_projections(img: Volume, cache: Optional[PointCache]=None, key: Optional[str]=None) -> LabelProjections:
+    """
+    returns the per-axis label projections of a volume, which are kept with the volume and,
+    given a cache and the content key of the image, e.g. its file hash, cached across runs
+    """
+    if img.projections is not None:
+        return img.projections
+    cached = cache is not None and key is not None
+    if cached:
+        key = make_key(key, 'projections', _projections_version)
+    arr = cache.get(key) if cached else None
+    if arr is None:
+        img.projections = LabelProjections.compute(get_array(img))
+        if cached:
+            cache.put(key, img.projections.to_array())
+    else:
+        img.projections = LabelProjections.from_array(arr, get_array(img).shape)
+    return img.projections
+
+
+def crop_to_labels(img: Volume, labels, margin: int=0, cache: Optional[PointCache]=None,
+                   key: Optional[str]=None) -> Optional[Volume]:
+    """
+    crops a volume to the bounding box of the selected labels, see LabelProjections.bounds,
+    the crop is a view with the geometry of the region, so that points extracted from it are in the same space
+    :return: the cropped volume or None if none of the labels occur
+    """
+    bounds = label_projections(img, cache=cache, key=key).bounds(labels, margin=margin)
+    return None if bounds is None else img.crop(*bounds)
+
+
+def label_extent(img: Volume, background: int=0, cache: Optional[PointCache]=None, key: Optional[str]=None):
+    """
+    returns the bounding box (index and size) of all labels except the background, e.g. the extent to resample
+    a label map within (see resample.iter_resampled_slabs), the size is zero if there are no labels
+    """
+    bounds = label_projections(img, cache=cache, key=key).bounds(lambda v: v != background)
+    return ([0, 0, 0], [0, 0, 0]) if bounds is None else bounds
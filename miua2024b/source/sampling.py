@@ -0,0 +1,148 @@
+import itertools
+
+import numpy as np
+
+# offsets of the neighbouring cells within two cells, which covers the radius for a cell size of radius / sqrt(3)
+_neighbour_offsets = np.asarray(list(o for o in itertools.product(range(-2, 3), repeat=3) if any(o)), dtype=np.int64)
+
+
+class _Grid:
+    """
+    spatial hash of a point cloud for a fixed cell size, the points are sorted by cell.
+    the cells are padded by two on each side, so that the linear keys of neighbouring cells can be computed by addition
+    """
+
+    # maximum number of cells for which dense lookup tables are used instead of a binary search
+    dense_limit = 2**24
+
+    def __init__(self, coords: np.ndarray, cell: float):
+        scaled = coords / cell
+        idx = np.floor(scaled).astype(np.int64)
+        # within each cell, the points are ordered by their distance to the centre of the cell
+        d2 = np.sum(np.square(scaled - idx - 0.5), axis=-1)
+        idx -= idx.min(axis=0) - 2
+        self.shape = idx.max(axis=0) + 3
+        self.size = int(np.prod(self.shape))
+        self.strides = np.asarray([self.shape[1] * self.shape[2], self.shape[2], 1], dtype=np.int64)
+        keys = idx @ self.strides
+        self.order = np.lexsort((d2, keys))
+        self.keys, self.starts, self.counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+        self.cells = idx[self.order[self.starts]]
+        self.cell = cell
+
+    @property
+    def dense(self) -> bool:
+        return self.size <= self.dense_limit
+
+    def find(self, keys: np.ndarray) -> np.ndarray:
+        """
+        returns the indices of the occupied cells with the linear keys, -1 where empty
+        """
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        return np.where(self.keys[pos] == keys, pos, -1)
+
+
+class PointSampler:
+    """
+    downsampling engine for a point cloud based on grid hashing in vectorized numpy,
+    supports Poisson-disk and voxel sampling and returns the indices of the selected points.
+    the spatial hashes are kept per cell size, so that only sampling the same cloud at the same cell size again
+    reuses them, e.g., a Poisson-disk sampling with radius r and a voxel sampling with size r / sqrt(3).
+    each resolution of a registration has its own cell size and builds its own hash.
+    """
+
+    # maximum number of cells sampled at once
+    chunk_size = 2**16
+
+    def __init__(self, points):
+        """
+        :param points: point cloud as (n, 3) array, float32 points are processed without conversion
+        """
+        self.points = np.asarray(points)
+        if self.points.dtype not in (np.float32, np.float64):
+            self.points = self.points.astype(np.float64)
+        self.origin = self.points.min(axis=0) if len(self.points) else np.zeros(3, dtype=self.points.dtype)
+        self._grids = dict()
+
+    def grid(self, cell: float) -> _Grid:
+        """
+        returns the spatial hash for the cell size
+        """
+        cell = float(cell)
+        if cell not in self._grids:
+            self._grids[cell] = _Grid(self.points - self.origin, cell)
+        return self._grids[cell]
+
+    def poisson(self, radius: float) -> np.ndarray:
+        """
+        maximal Poisson-disk sampling: no two selected points are closer than radius and no further point can be added.
+        the cells (of size radius / sqrt(3), containing at most one sample) are processed in 27 interleaved phases,
+        where the cells of a phase are at least three cells apart and can be sampled in parallel.
+        candidates are tried in the order of the points within each cell, which makes the result deterministic.
+        :param radius: minimum distance between samples
+        :return: sorted indices of the selected points
+        """
+        if len(self.points) == 0:
+            return np.empty(0, dtype=np.int64)
+        grid = self.grid(radius / np.sqrt(3))
+        offsets = _neighbour_offsets @ grid.strides
+        samples = np.full(len(grid.keys), -1, dtype=np.int64)
+        if grid.dense:
+            # samples by linear cell key, so that the samples of the neighbours are a single lookup
+            dense = np.full(grid.size, -1, dtype=np.int64)
+        phases = (grid.cells % 3) @ np.asarray([9, 3, 1])
+        r2 = np.square(radius)
+
+        for phase in range(27):
+            cells = np.flatnonzero(phases == phase)
+            for t in range(grid.counts[cells].max(initial=0)):
+                cells = cells[(grid.counts[cells] > t) & (samples[cells] < 0)]
+                # the cells of a phase are independent, chunks bound the size of the neighbourhood arrays
+                for chunk in np.array_split(cells, np.arange(self.chunk_size, len(cells), self.chunk_size)):
+                    cand = grid.order[grid.starts[chunk] + t]
+                    nb = grid.keys[chunk, None] + offsets
+                    if grid.dense:
+                        nb = dense[nb]
+                    else:
+                        nb = grid.find(nb)
+                        nb = np.where(nb >= 0, samples[nb], -1)
+                    rows, cols = np.nonzero(nb >= 0)
+                    d2 = np.sum(np.square(self.points[nb[rows, cols]] - self.points[cand[rows]]), axis=-1)
+                    ok = np.ones(len(chunk), dtype=bool)
+                    ok[rows[d2 < r2]] = False
+                    samples[chunk[ok]] = cand[ok]
+                    if grid.dense:
+                        dense[grid.keys[chunk[ok]]] = cand[ok]
+
+        return np.sort(samples[samples >= 0])
+
+    def voxel(self, size: float) -> np.ndarray:
+        """
+        voxel sampling: selects the point closest to the centroid of the points in each occupied voxel
+        :param size: voxel size
+        :return: sorted indices of the selected points
+        """
+        if len(self.points) == 0:
+            return np.empty(0, dtype=np.int64)
+        grid = self.grid(size)
+        pts = self.points[grid.order]
+        cell_idx = np.repeat(np.arange(len(grid.keys)), grid.counts)
+        centroids = np.add.reduceat(pts, grid.starts, axis=0, dtype=np.float64) / grid.counts[:, None]
+        d2 = np.sum(np.square(pts - centroids[cell_idx]), axis=-1)
+        best = np.lexsort((d2, cell_idx))[grid.starts]
+        return np.sort(grid.order[best])
+
+
+def poisson_disk_indices(points, radius: float) -> np.ndarray:
+    """
+    returns the indices of a maximal Poisson-disk sampling of the points, see PointSampler.poisson
+    """
+    return PointSampler(points).poisson(radius)
+
+
+def voxel_indices(points, size: float) -> np.ndarray:
+    """
+    returns the indices of the points closest to the centroid of each occupied voxel, see PointSampler.voxel
+    """
+    return PointSampler(points).voxel(size)
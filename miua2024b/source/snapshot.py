@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import argparse
+import sys
+from typing import Optional
+
+import numpy as np
+
+from miua2024b.source.colors import palette_array
+from miua2024b.source.lazy import lazy_import
+from miua2024b.source.profiling import profiled
+from miua2024b.source.points import transform_points
+
+sitk = lazy_import('SimpleITK')
+
+# the projection axis and the (row, column) axes of each view, rows along z are flipped so that superior is up
+_views = {
+    'axial': (2, (1, 0)),
+    'coronal': (1, (2, 0)),
+    'sagittal': (0, (2, 1)),
+}
+
+
+def project_points(points: np.ndarray, view: str, lower: np.ndarray, pixel: float, size: int) -> np.ndarray:
+    """
+    returns the density projection of the points for a view, i.e., the number of points along each ray
+    :param points: (n, 3) point coordinates
+    :param view: 'axial', 'coronal' or 'sagittal'
+    :param lower: lower corner of the rendered (cubic) region
+    :param pixel: pixel size in mm
+    :param size: image size in pixels
+    :return: (size, size) array of point counts
+    """
+    _, (row_axis, col_axis) = _views[view]
+    idx = np.floor((np.asarray(points)[:, [row_axis, col_axis]] - lower[[row_axis, col_axis]]) / pixel).astype(np.int64)
+    np.clip(idx, 0, size - 1, out=idx)
+    if row_axis == 2:
+        idx[:, 0] = size - 1 - idx[:, 0]
+    return np.bincount(idx[:, 0] * size + idx[:, 1], minlength=size * size).reshape(size, size)
+
+
+def cubic_bounds(clouds: list, margin: float=5.0):
+    """
+    returns the lower corner and edge length of the cube centred on the bounding box of all clouds,
+    which contains the box with a margin in mm
+    """
+    occupied = list(np.asarray(c) for c in clouds if len(c))
+    if not occupied:
+        return np.zeros(3), 1.0
+    lower = np.min(list(c.min(axis=0) for c in occupied), axis=0) - margin
+    upper = np.max(list(c.max(axis=0) for c in occupied), axis=0) + margin
+    extent = float(np.max(upper - lower))
+    return (lower + upper - extent) / 2, extent
+
+
+def render_projections(clouds: list, palette: Optional[np.ndarray]=None, size: int=256, margin: float=5.0,
+                       lower: Optional[np.ndarray]=None, extent: Optional[float]=None,
+                       views=('axial', 'coronal', 'sagittal'), gap: int=2) -> np.ndarray:
+    """
+    renders MIP-style overlays of point clouds: for each view, the density of each cloud along the rays is mapped to
+    the brightness of its color (log-scaled) and the clouds are combined by their maximum per channel, so that
+    overlapping clouds mix, e.g., red and green to yellow. the views are placed side by side
+    :param clouds: list of (n, 3) point clouds
+    :param palette: (len(clouds), 3) uint8 colors, defaults to the default palette, see colors.palette_array
+    :param size: size of each view in pixels
+    :param margin: margin in mm around the bounding box of all clouds
+    :param lower: optional lower corner of the rendered region, see cubic_bounds
+    :param extent: optional edge length in mm of the rendered (cubic) region, both default to the bounds of all clouds
+    :param views: views to render, see project_points
+    :param gap: number of pixels between the views
+    :return: (size, n_views * (size + gap) - gap, 3) uint8 rgb image
+    """
+    clouds = list(np.asarray(c) for c in clouds)
+    palette = palette_array(len(clouds)) if palette is None else np.asarray(palette, dtype=np.uint8)
+    if lower is None or extent is None:
+        lower, extent = cubic_bounds(clouds, margin=margin)
+    lower = np.asarray(lower, dtype=np.float64)
+    pixel = extent / size
+
+    img = np.zeros((size, len(views) * (size + gap) - gap, 3), dtype=np.uint8)
+    for v, view in enumerate(views):
+        panel = img[:, v * (size + gap):v * (size + gap) + size]
+        for points, rgb in zip(clouds, palette):
+            if not len(points):
+                continue
+            density = np.log1p(project_points(points, view, lower, pixel, size))
+            brightness = density / max(density.max(), 1e-6)
+            np.maximum(panel, (brightness[..., None] * rgb).astype(np.uint8), out=panel)
+    return img
+
+
+def write_png(img: np.ndarray, path: str):
+    """
+    writes an (h, w, 3) uint8 rgb image as png
+    """
+    sitk.WriteImage(sitk.GetImageFromArray(np.ascontiguousarray(img), isVector=True), path)
+
+
+@profiled('write_snapshot')
+def write_snapshot(path: str, source, target, tf, size: int=256, max_points: int=200000):
+    """
+    writes a QC image of a registration without a display: the top row shows the source (red) and target (cyan) point
+    clouds before, the bottom row the transformed source and the target point clouds after the registration, each as
+    axial, coronal and sagittal density projections, see render_projections. aligned vessels appear white.
+    both rows share the rendered region, so that the misalignment before the registration is visible
+    :param path: output path of the .png image
+    :param source: point cloud transformed by tf, e.g., of the fixed segmentation, as main.run maps the fixed to the
+    moving points
+    :param target: point cloud which tf maps the source onto, e.g., of the moving segmentation
+    :param tf: affine matrix or SimpleITK transform mapping the source to the target points, see points.transform_points
+    :param size: size of each view in pixels
+    :param max_points: the maximum number of points per cloud, larger clouds are subsampled with a fixed stride
+    """
+    source, target = (np.asarray(c)[::max(1, -(-len(c) // max_points))] for c in (source, target))
+    registered = transform_points(source, tf)
+    lower, extent = cubic_bounds([source, target, registered])
+    # red and cyan of the default palette, which add up to white
+    palette = palette_array(5)[[0, 4]]
+    before = render_projections([source, target], palette=palette, size=size, lower=lower, extent=extent)
+    after = render_projections([registered, target], palette=palette, size=size, lower=lower, extent=extent)
+    write_png(np.concatenate([before, np.zeros((2, ) + before.shape[1:], dtype=np.uint8), after]), path)
+
+
+def entry_point():
+    parser = argparse.ArgumentParser(description='Renders QC images of registrations without a display.')
+    parser.add_argument('--fixed', dest='fixed', type=str, required=True, help="Segmentation of vessels in the fixed image")
+    parser.add_argument('--moving', dest='moving', type=str, required=True, help="Segmentation of vessels in the moving image")
+    parser.add_argument('--transform', dest='transform', type=str, required=True, help="Resulting transform of the registration, e.g., written by main.py")
+    parser.add_argument('--output', dest='output', type=str, required=True, help="Output path for the .png image")
+    parser.add_argument('--binary', dest='binary', action='store_true', help="Whether to mask all lables instead of extracting the left and right labels predicted by model theta m")
+    parser.add_argument('--size', dest='size', type=int, default=256, help="Size of each view in pixels")
+    args, _ = parser.parse_known_args(args=sys.argv)
+
+    from miua2024b.source.main import read_segmentation
+    _, fixed = read_segmentation(args.fixed, binary=args.binary, dtype=np.float32)
+    _, moving = read_segmentation(args.moving, binary=args.binary, dtype=np.float32)
+    # the transform maps the points of the fixed to the moving image, see main.run
+    write_snapshot(args.output, source=fixed, target=moving, tf=sitk.ReadTransform(args.transform), size=args.size)
+    print(f"Finished writing results to: {args.output}")
+
+
+if __name__ == '__main__':
+    entry_point()
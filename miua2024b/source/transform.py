@@ -1,9 +1,15 @@
-import SimpleITK as sitk
+from __future__ import annotations
+
 import numpy as np
 
+from miua2024b.source.lazy import lazy_import
+from miua2024b.source.profiling import profiled
 from miua2024b.source.util import unit_vector
 
+sitk = lazy_import('SimpleITK')
+
 
+@profiled('evaluate_transforms')
 def evaluate_transforms(pred: sitk.Transform, truth: sitk.Transform, ref: tuple):
     """
     returns a dictionary of metrics comparing two transforms, pred and truth
@@ -29,4 +35,27 @@ def evaluate_transforms(pred: sitk.Transform, truth: sitk.Transform, ref: tuple)
         r_diff = np.arccos(np.clip(np.dot(v_pred, v_truth), a_min=0.0, a_max=1.0))
         r_diffs.append(r_diff)
     r_diff = np.mean(r_diffs)
-    return n_diff, np.rad2deg(r_diff)
\ No newline at end of file
+    return n_diff, np.rad2deg(r_diff)
+
+
+def evaluate_affines(pred, truth, refs):
+    """
+    batched version of evaluate_transforms for affine matrices, e.g., of many registrations at many reference points
+    :param pred: predicted affine matrices (n, 4, 4)
+    :param truth: expected affine matrices (n, 4, 4)
+    :param refs: reference coordinates (n, m, 3), or (m, 3) shared by all pairs
+    :return: tuple of the translation errors (n, m) and the rotation errors in degrees (n, ),
+    the rotation error of an affine transform does not depend on the reference coordinate
+    """
+    pred = np.asarray(pred, dtype=np.float64)
+    truth = np.asarray(truth, dtype=np.float64)
+    refs = np.broadcast_to(np.asarray(refs, dtype=np.float64), (len(pred), ) + np.shape(refs)[-2:])
+    diff = pred - truth
+    t_diff = np.einsum('nij,nmj->nmi', diff[:, :3, :3], refs) + diff[:, None, :3, 3]
+    n_diff = np.linalg.norm(t_diff, axis=-1)
+
+    # the columns of the linear part are the transformed unit vectors of the axes
+    v_pred = unit_vector(pred[:, :3, :3], axis=1)
+    v_truth = unit_vector(truth[:, :3, :3], axis=1)
+    r_diff = np.arccos(np.clip(np.sum(v_pred * v_truth, axis=1), a_min=0.0, a_max=1.0)).mean(axis=-1)
+    return n_diff, np.rad2deg(r_diff)
@@ -1,6 +1,11 @@
+from __future__ import annotations
+
 from typing import Optional, Any
 import numpy as np
-import SimpleITK as sitk
+
+from miua2024b.source.lazy import lazy_import
+
+sitk = lazy_import('SimpleITK')
 
 
 def native(val, dtype=None, force=False):
@@ -59,6 +64,24 @@ def transform_from_affine(m):
     return t
 
 
+def affine_from_transform(tf: sitk.Transform):
+    """
+    converts a linear simpleITK transformation to an affine matrix, the inverse of transform_from_affine
+    the matrix is derived from the transformed origin and unit vectors, which supports any linear transform type,
+    e.g., affine, euler, versor or composite transforms of these
+    :param tf: linear 3d transformation
+    :return: corresponding 4x4 affine matrix
+    """
+    if not tf.IsLinear():
+        raise RuntimeError("Transform is not linear: {}".format(tf.GetName()))
+    dims = tf.GetDimension()
+    t = np.asarray(tf.TransformPoint((0.0,) * dims))
+    m = np.eye(dims + 1)
+    m[:dims, :dims] = np.transpose(list(np.subtract(tf.TransformPoint(tuple(v)), t) for v in np.eye(dims)))
+    m[:dims, dims] = t
+    return m
+
+
 def get_center(img: sitk.Image):
     """
     returns the center of an image as an absolute position
@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+
+from miua2024b.source.cache import PointCache, file_hash, make_key
+from miua2024b.source.lazy import lazy_import
+from miua2024b.source.profiling import stage
+
+sitk = lazy_import('SimpleITK')
+
+# version of the geometry sidecar and the cached geometry entries
+_geometry_version = 1
+
+
+class Volume:
+    """
+    3d image held as a (memory-mapped) numpy array in (z, y, x) order with the geometry of a SimpleITK image.
+    provides the part of the SimpleITK image interface used by the point extraction and resampling,
+    so that the array is processed zero-copy instead of being converted to a SimpleITK image
+    """
+
+    def __init__(self, array: np.ndarray, origin, spacing, direction, base=None):
+        """
+        :param array: voxels in (z, y, x) or (z, y, x, components) order, e.g., a memory-mapped .npy file
+        :param origin: physical position of the first voxel
+        :param spacing: voxel size along (x, y, z)
+        :param direction: direction cosines as flattened 3x3 matrix
+        :param base: optional object owning the voxels, e.g., the SimpleITK image of an array view, which is kept alive
+        """
+        if array.ndim not in (3, 4):
+            raise RuntimeError("Invalid volume dimension: {}".format(array.ndim))
+        self.array = array
+        self.origin = tuple(float(v) for v in origin)
+        self.spacing = tuple(float(v) for v in spacing)
+        self.direction = tuple(float(v) for v in direction)
+        self.base = base
+        # per-axis label projections, see roi.label_projections
+        self.projections = None
+        m_dir = np.reshape(self.direction, (3, 3))
+        self._m_idx = m_dir * np.asarray(self.spacing)
+        self._m_inv = np.linalg.inv(self._m_idx)
+
+    @classmethod
+    def from_image(cls, img: sitk.Image) -> 'Volume':
+        """
+        returns a volume of a SimpleITK image, the array is a copy
+        """
+        return cls(sitk.GetArrayFromImage(img), img.GetOrigin(), img.GetSpacing(), img.GetDirection())
+
+    def crop(self, index, size) -> 'Volume':
+        """
+        returns a region of the volume as volume with the same geometry, the array is a view
+        :param index: first voxel (x, y, z) of the region
+        :param size: size (x, y, z) of the region
+        """
+        (x0, y0, z0), (sx, sy, sz) = index, size
+        return Volume(self.array[z0:z0 + sz, y0:y0 + sy, x0:x0 + sx], self.TransformIndexToPhysicalPoint(index),
+                      self.spacing, self.direction, base=self.base)
+
+    def geometry(self) -> np.ndarray:
+        """
+        returns the geometry as flat array: origin, spacing and direction
+        """
+        return np.concatenate([self.origin, self.spacing, self.direction])
+
+    def GetOrigin(self):
+        return self.origin
+
+    def GetSpacing(self):
+        return self.spacing
+
+    def GetDirection(self):
+        return self.direction
+
+    def GetDimension(self):
+        return 3
+
+    def GetSize(self):
+        return tuple(int(s) for s in self.array.shape[2::-1])
+
+    def GetWidth(self):
+        return int(self.array.shape[2])
+
+    def GetHeight(self):
+        return int(self.array.shape[1])
+
+    def GetDepth(self):
+        return int(self.array.shape[0])
+
+    def GetNumberOfComponentsPerPixel(self):
+        return 1 if self.array.ndim == 3 else int(self.array.shape[3])
+
+    def GetPixelID(self):
+        return _pixel_id(self.array.dtype.str, self.GetNumberOfComponentsPerPixel())
+
+    def TransformContinuousIndexToPhysicalPoint(self, idx):
+        return tuple((self._m_idx @ np.asarray(idx, dtype=np.float64) + self.origin).tolist())
+
+    def TransformIndexToPhysicalPoint(self, idx):
+        return self.TransformContinuousIndexToPhysicalPoint(idx)
+
+    def TransformPhysicalPointToContinuousIndex(self, point):
+        return tuple((self._m_inv @ np.subtract(point, self.origin)).tolist())
+
+    def to_image(self, index=None, size=None) -> sitk.Image:
+        """
+        returns a region of the volume as SimpleITK image, only the voxels of the region are copied
+        :param index: first voxel (x, y, z) of the region, defaults to the first voxel of the volume
+        :param size: size (x, y, z) of the region, defaults to the remaining volume
+        """
+        index = (0, 0, 0) if index is None else tuple(int(i) for i in index)
+        size = tuple(s - i for s, i in zip(self.GetSize(), index)) if size is None else tuple(int(s) for s in size)
+        arr = self.array[index[2]:index[2] + size[2], index[1]:index[1] + size[1], index[0]:index[0] + size[0]]
+        img = sitk.GetImageFromArray(np.ascontiguousarray(arr), isVector=self.array.ndim == 4)
+        img.SetSpacing(self.spacing)
+        img.SetDirection(self.direction)
+        img.SetOrigin(self.TransformIndexToPhysicalPoint(index))
+        return img
+
+
+@lru_cache(maxsize=None)
+def _pixel_id(dtype: str, components: int):
+    shape = (1, 1, 1) + ((components, ) if components > 1 else ())
+    return sitk.GetImageFromArray(np.zeros(shape, dtype=np.dtype(dtype)), isVector=components > 1).GetPixelID()
+
+
+def get_array(img) -> np.ndarray:
+    """
+    returns the voxels of a SimpleITK image or volume as array in (z, y, x) order without copying
+    """
+    if isinstance(img, Volume):
+        return img.array
+    return sitk.GetArrayViewFromImage(img)
+
+
+def get_label_array(img, slab_size: int=16) -> np.ndarray:
+    """
+    returns the voxels of a label image (or array) as integer array in (z, y, x) order, see get_array. integer arrays
+    are returned without copying, floating point (or boolean) arrays are cast to the smallest integer type of their
+    range if all values are integers, e.g., for segmentations stored as float. the values and their range are checked
+    slab by slab, the cast then copies the whole array in the smaller type, e.g., a quarter of a float32 array for
+    labels below 256
+    :param slab_size: number of slices per slab to check the values of floating point arrays in
+    """
+    arr = img if isinstance(img, np.ndarray) else get_array(img)
+    if np.issubdtype(arr.dtype, np.integer):
+        return arr
+    if arr.dtype != bool and not np.issubdtype(arr.dtype, np.floating):
+        raise RuntimeError("Invalid label image type: {}".format(arr.dtype))
+    lo, hi = 0, 0
+    for z0 in range(0, arr.shape[0], slab_size):
+        vals = arr[z0:z0 + slab_size]
+        if vals.size == 0:
+            continue
+        if not np.all(np.isfinite(vals) & (np.floor(vals) == vals)):
+            raise RuntimeError("Invalid label image, the {} values are not integers".format(arr.dtype))
+        lo, hi = min(lo, int(vals.min())), max(hi, int(vals.max()))
+    return arr.astype(np.result_type(np.min_scalar_type(lo), np.min_scalar_type(hi)))
+
+
+def as_volume(img) -> Volume:
+    """
+    returns a volume of a SimpleITK image without copying its voxels, volumes are passed through
+    """
+    if isinstance(img, Volume):
+        return img
+    return Volume(sitk.GetArrayViewFromImage(img), img.GetOrigin(), img.GetSpacing(), img.GetDirection(), base=img)
+
+
+def sidecar_path(path: str) -> str:
+    """
+    returns the path of the geometry sidecar of a volume file, e.g. image.json for image.npy
+    """
+    return os.path.splitext(path)[0] + '.json'
+
+
+def is_volume_path(path: str) -> bool:
+    """
+    returns whether a path refers to a volume in the working format, i.e., a .npy file with a geometry sidecar
+    """
+    return path.lower().endswith('.npy') and os.path.exists(sidecar_path(path))
+
+
+def save_volume(img, path: str):
+    """
+    writes an image or volume in the working format: the voxels as uncompressed .npy file and the geometry
+    as .json sidecar next to it
+    :param img: SimpleITK image or volume
+    :param path: output path of the .npy file
+    """
+    if not path.lower().endswith('.npy'):
+        raise RuntimeError("Invalid volume path, expected a .npy file: {}".format(path))
+    np.save(path, np.ascontiguousarray(get_array(img)))
+    with open(sidecar_path(path), 'w') as f:
+        json.dump(dict(version=_geometry_version, origin=list(img.GetOrigin()), spacing=list(img.GetSpacing()),
+                       direction=list(img.GetDirection())), f)
+
+
+def load_volume(path: str) -> Volume:
+    """
+    memory-maps a volume in the working format, see save_volume, the voxels are read on access
+    """
+    with open(sidecar_path(path)) as f:
+        geometry = json.load(f)
+    return Volume(np.load(path, mmap_mode='r'), geometry['origin'], geometry['spacing'], geometry['direction'])
+
+
+def read_volume(path: str, cache: Optional[PointCache]=None):
+    """
+    reads an image for processing: volumes in the working format are memory-mapped, other images are read by
+    SimpleITK. with an enabled cache, images are converted to the working format once (keyed by their content)
+    and memory-mapped from the cache afterwards, which avoids decompressing them on each run
+    :param path: path of the image, e.g., .nrrd, .nii.gz or .npy with a geometry sidecar
+    :param cache: optional cache to store the converted volumes in
+    :return: volume or SimpleITK image
+    """
+    if is_volume_path(path):
+        return load_volume(path)
+    if cache is None or not cache.enabled:
+        return sitk.ReadImage(path)
+
+    key = make_key(file_hash(path), 'volume', _geometry_version)
+    geometry_key = make_key(key, 'geometry')
+    arr, geometry = cache.get(key), cache.get(geometry_key)
+    if arr is None or geometry is None:
+        with stage('convert_volume', path=path):
+            volume = Volume.from_image(sitk.ReadImage(path))
+            cache.put(key, volume.array)
+            cache.put(geometry_key, volume.geometry())
+        return volume
+    return Volume(arr, geometry[:3], geometry[3:6], geometry[6:])
+
+
+def entry_point():
+    parser = argparse.ArgumentParser(description='Converts images to the memory-mapped working format (.npy with a .json geometry sidecar).')
+    parser.add_argument('--input', dest='input', type=str, nargs='+', required=True, help="Images to convert, e.g., .nrrd or .nii.gz")
+    parser.add_argument('--output', dest='output', type=str, required=True, help="Output folder for the converted volumes")
+    args, _ = parser.parse_known_args(args=sys.argv)
+
+    os.makedirs(args.output, exist_ok=True)
+    for path in args.input:
+        name = os.path.basename(path)
+        for ext in ('.nii.gz', '.nrrd', '.nii', '.mha'):
+            if name.lower().endswith(ext):
+                name = name[:-len(ext)]
+                break
+        dest = os.path.join(args.output, name + '.npy')
+        save_volume(sitk.ReadImage(path), dest)
+        print(f"Finished writing results to: {dest}")
+
+
+if __name__ == '__main__':
+    entry_point()
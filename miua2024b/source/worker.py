@@ -0,0 +1,229 @@
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+from time import time
+
+# the worker only imports the standard library at module level, so that submitting a job is cheap,
+# the registration modules are imported (and kept) by the serving process, see warm_up
+_job_keys = ('fixed', 'moving', 'output', 'truth', 'warped')
+_param_keys = ('binary', 'search_mm', 'fine_mm', 'cache_dir', 'cache_size', 'use_cache', 'icp_steps', 'icp_tol',
+               'icp_levels', 'ransac_seeds', 'ransac_scales', 'ransac_fpfh', 'ransac_workers', 'ransac_budget',
+               'downsampling', 'warped_interpolator', 'dtype', 'symmetric', 'max_consistency', 'min_fitness',
+               'snapshot', 'point_grid')
+_warm_up_modules = ('open3d', 'SimpleITK', 'miua2024b.source.batch')
+
+
+def _json_default(o):
+    # numpy values of the results
+    return o.tolist() if hasattr(o, 'tolist') else str(o)
+
+
+def warm_up():
+    """
+    imports the registration modules and the libraries they use lazily, so that the first job is not slowed down
+    """
+    for name in _warm_up_modules:
+        importlib.import_module(name)
+
+
+def handle(request: dict, params: dict) -> dict:
+    """
+    executes a request of the worker protocol, a JSON object with a 'command':
+    * 'register': registers the pair of the entries 'fixed', 'moving' and 'output' (and optionally 'truth' and 'warped',
+      see batch.read_manifest) using the parameters of the worker updated by the entry 'params', see batch.run_job
+    * 'ping': returns the process id of the worker
+    * 'shutdown': stops the worker after the response
+    :param request: the request, an optional 'id' is passed back with the response
+    :param params: default parameters of the registration
+    :return: response with the 'status' ('ok' or 'error') and the result of the command
+    """
+    res = dict(id=request.get('id'), status='ok')
+    command = request.get('command', 'register')
+    if command == 'ping':
+        res['pid'] = os.getpid()
+        return res
+    if command == 'shutdown':
+        return res
+    if command != 'register':
+        return dict(res, status='error', error="Unknown command: {}".format(command))
+
+    t0 = time()
+    try:
+        from miua2024b.source.batch import run_job
+        missing = list(k for k in ('fixed', 'moving', 'output') if not request.get(k))
+        if missing:
+            raise RuntimeError("Request is missing: {}".format(", ".join(missing)))
+        job = dict((k, request.get(k)) for k in _job_keys)
+        job['index'] = request.get('id')
+        kwargs = dict(params, **request.get('params', dict()))
+        unknown = list(k for k in kwargs if k not in _param_keys)
+        if unknown:
+            raise RuntimeError("Unknown parameters: {}".format(", ".join(unknown)))
+        # the output stream may be the protocol channel, see serve_stream
+        with contextlib.redirect_stdout(sys.stderr):
+            res.update(run_job(job, **kwargs))
+    except Exception as e:
+        res.update(status='error', error=str(e).strip().splitlines()[-1] if str(e).strip() else repr(e),
+                   traceback=traceback.format_exc())
+    res['t_total'] = time() - t0
+    return res
+
+
+def _respond(line, params: dict):
+    """
+    parses a JSON line of the worker protocol and executes it, see handle,
+    lines which are not a JSON object are answered with an error
+    :return: the request (empty for invalid lines) and the response
+    """
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        return dict(), dict(id=None, status='error', error="Invalid request: {}".format(e))
+    if not isinstance(request, dict):
+        return dict(), dict(id=None, status='error',
+                            error="Invalid request: expected a JSON object, got {}".format(type(request).__name__))
+    return request, handle(request, params)
+
+
+def serve_stream(params: dict, stream_in=None, stream_out=None):
+    """
+    serves requests as JSON lines from a stream (stdin by default), the responses are written as JSON lines to the
+    output stream (stdout by default) in the same order, until the input ends or a 'shutdown' request
+    """
+    stream_in = sys.stdin if stream_in is None else stream_in
+    stream_out = sys.stdout if stream_out is None else stream_out
+    for line in stream_in:
+        if not line.strip():
+            continue
+        request, res = _respond(line, params)
+        stream_out.write(json.dumps(res, default=_json_default) + '\n')
+        stream_out.flush()
+        if request.get('command') == 'shutdown':
+            break
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            request, res = _respond(line, self.server.params)
+            self.wfile.write((json.dumps(res, default=_json_default) + '\n').encode('utf-8'))
+            self.wfile.flush()
+            if request.get('command') == 'shutdown':
+                self.server.stopped = True
+                break
+
+
+def serve_socket(path: str, params: dict):
+    """
+    serves requests on a UNIX socket, each connection sends JSON lines and receives a response per line,
+    the requests are processed one at a time (the registration itself is multi-threaded) until a 'shutdown' request
+    :param path: path of the socket, which is removed when the worker stops
+    :param params: default parameters of the registration, see handle
+    """
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(path)
+        except OSError:
+            # stale socket of a worker which did not stop properly
+            os.remove(path)
+        else:
+            raise RuntimeError("A worker is already listening on: {}".format(path))
+
+    with socketserver.UnixStreamServer(path, _Handler) as server:
+        server.params = params
+        server.stopped = False
+        try:
+            while not server.stopped:
+                server.handle_request()
+        finally:
+            os.remove(path)
+
+
+def submit(path: str, requests: list, timeout: float=None) -> list:
+    """
+    sends requests to a worker listening on a UNIX socket and returns the responses
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        with s.makefile('rwb') as f:
+            responses = list()
+            for request in requests:
+                f.write((json.dumps(request) + '\n').encode('utf-8'))
+                f.flush()
+                responses.append(json.loads(f.readline()))
+    return responses
+
+
+def entry_point():
+    parser = argparse.ArgumentParser(description='Long-lived registration worker, which keeps the libraries and fixed point clouds loaded between jobs.')
+    parser.add_argument('--socket', dest='socket', type=str, default="", help="UNIX socket to serve on or to submit to, without a socket the worker serves JSON lines on stdin and stdout")
+    parser.add_argument('--submit', dest='submit', action='store_true', help="Whether to submit a registration job (--fixed, --moving, --output) to the worker listening on --socket instead of serving")
+    parser.add_argument('--shutdown', dest='shutdown', action='store_true', help="Whether to stop the worker listening on --socket")
+    parser.add_argument('--fixed', dest='fixed', type=str, default="", help="Segmentation of vessels in the fixed image of the job to submit")
+    parser.add_argument('--moving', dest='moving', type=str, default="", help="Segmentation of vessels in the moving image of the job to submit")
+    parser.add_argument('--output', dest='output', type=str, default="", help="Output path for the resulting transform of the job to submit")
+    parser.add_argument('--truth', dest='truth', type=str, default="", help="Truth transform to evaluate the job against")
+    parser.add_argument('--warped', dest='warped', type=str, default="", help="Warped image to write for the job")
+    parser.add_argument('--binary', dest='binary', action='store_true', help="Whether to mask all lables instead of extracting the left and right labels predicted by model theta m")
+    parser.add_argument('--search', dest='search', type=float, default=None, help="Resolution for the global RANSAC registration (in mm for the poison disk radius)")
+    parser.add_argument('--fine', dest='fine', type=float, default=None, help="Resolution for the fine ICP registration (in mm for the poison disk radius)")
+    parser.add_argument('--cache', dest='cache', type=str, default=None, help="Folder to cache converted volumes, downsampled point clouds and features in, defaults to the MIUA2024B_CACHE environment variable")
+    parser.add_argument('--cache-size', dest='cache_size', type=float, default=None, help="Maximum size of the cache in GB")
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', help="Whether to disable the cache")
+    parser.add_argument('--icp-steps', dest='icp_steps', type=int, default=None, help="Number of ICP runs per resolution level")
+    parser.add_argument('--icp-tol', dest='icp_tol', type=float, default=None, help="Tolerance (in mm) for the adaptive ICP schedule")
+    parser.add_argument('--downsampling', dest='downsampling', type=str, default=None, choices=['pcu', 'poisson', 'voxel'], help="Method to downsample the point clouds with")
+    parser.add_argument('--warped-interpolator', dest='warped_interpolator', type=str, default=None, choices=['nearest', 'label_gaussian', 'linear', 'bspline'], help="Interpolator for the warped image")
+    parser.add_argument('--dtype', dest='dtype', type=str, default=None, choices=['float32', 'float64'], help="Floating point type of the point clouds")
+    parser.add_argument('--point-grid', dest='point_grid', type=float, default=None, help="Grid spacing (in mm) to subsample the point clouds with while they are extracted")
+    parser.add_argument('--symmetric', dest='symmetric', action='store_true', help="Whether to register in both directions and check the inverse consistency, see batch.run_job")
+    parser.add_argument('--snapshots', dest='snapshots', action='store_true', help="Whether to write a QC image next to the output of each job, see batch.run_job")
+    args, _ = parser.parse_known_args(args=sys.argv)
+
+    # parameters which are not set fall back to the defaults of the worker (or of batch.run_job when serving)
+    params = dict(binary=args.binary or None, search_mm=args.search, fine_mm=args.fine, cache_dir=args.cache,
+                  cache_size=args.cache_size, use_cache=False if args.no_cache else None, icp_steps=args.icp_steps,
+                  icp_tol=args.icp_tol, downsampling=args.downsampling, warped_interpolator=args.warped_interpolator,
+                  dtype=args.dtype, symmetric=args.symmetric or None,
+                  snapshot=args.snapshots or None, point_grid=args.point_grid)
+    params = dict((k, v) for k, v in params.items() if v is not None)
+
+    if args.submit or args.shutdown:
+        if not args.socket:
+            raise RuntimeError("--socket is required to submit to a worker")
+        if args.shutdown:
+            request = dict(command='shutdown')
+        else:
+            request = dict(command='register', fixed=os.path.abspath(args.fixed), moving=os.path.abspath(args.moving),
+                           output=os.path.abspath(args.output), params=params)
+            for key in ('truth', 'warped'):
+                if getattr(args, key):
+                    request[key] = os.path.abspath(getattr(args, key))
+        res = submit(args.socket, [request])[0]
+        print(json.dumps(res, default=_json_default))
+        if res['status'] != 'ok':
+            sys.exit(1)
+        return
+
+    t0 = time()
+    warm_up()
+    print("Worker ready after {:.2f} seconds".format(time() - t0), file=sys.stderr)
+    if args.socket:
+        serve_socket(args.socket, params)
+    else:
+        serve_stream(params)
+
+
+if __name__ == '__main__':
+    entry_point()
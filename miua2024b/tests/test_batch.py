@@ -0,0 +1,119 @@
+import csv
+import faulthandler
+import json
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from miua2024b.source import batch
+
+_resource = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource')
+
+
+def _crashing_job(job, **kwargs):
+    if job['moving'] == 'crash':
+        os._exit(3)
+    if job['moving'] == 'hang':
+        time.sleep(60)
+    return dict(t_read=0.0, t_register=0.0, t_write=0.0)
+
+
+@pytest.fixture
+def crashing_jobs(monkeypatch):
+    # the workers inherit the patched job, which needs them to be forked instead of the platform's default
+    if 'fork' not in mp.get_all_start_methods():
+        pytest.skip("the fork start method is not available")
+    method = mp.get_start_method(allow_none=True)
+    mp.set_start_method('fork', force=True)
+    monkeypatch.setattr(batch, 'run_job', _crashing_job)
+    faulthandler.dump_traceback_later(120, exit=True)
+    yield list(dict(index=i, fixed='fixed', moving='crash' if i == 1 else 'moving', output='out{}'.format(i))
+               for i in range(4))
+    faulthandler.cancel_dump_traceback_later()
+    mp.set_start_method(method, force=True)
+
+
+@pytest.mark.parametrize('timeout', [None, 60.0])
+def test_run_batch_worker_died(crashing_jobs, timeout):
+    results = batch.run_batch(crashing_jobs, workers=2, timeout=timeout)
+    assert list(r['status'] for r in results) == ['ok', 'failed', 'ok', 'ok']
+    assert results[1]['error'] == "BrokenProcessPool: the worker process died with exit code 3"
+    assert list(r['attempts'] for r in results) == [1, 1, 1, 1]
+
+
+def test_run_batch_worker_died_retries(crashing_jobs):
+    results = batch.run_batch(crashing_jobs, workers=2, retries=1)
+    assert results[1]['status'] == 'failed'
+    assert results[1]['attempts'] == 2
+    assert all(r['status'] == 'ok' for i, r in enumerate(results) if i != 1)
+
+
+def test_run_batch_timeout(crashing_jobs):
+    crashing_jobs[1]['moving'] = 'hang'
+    results = batch.run_batch(crashing_jobs, workers=2, timeout=1.0)
+    assert list(r['status'] for r in results) == ['ok', 'failed', 'ok', 'ok']
+    assert results[1]['error'] == "TimeoutError: job exceeded 1.0 seconds"
+
+
+def _write_manifest(path, entries):
+    if path.suffix == '.json':
+        path.write_text(json.dumps(entries))
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=batch._manifest_keys)
+        writer.writeheader()
+        writer.writerows(entries)
+
+
+@pytest.mark.parametrize('ext', ['.csv', '.json'])
+def test_read_manifest(tmp_path, ext):
+    entries = [dict(fixed='tof.nrrd', moving='pd.nrrd', output='out/a.tfm', truth='truth.tfm', warped=''),
+               dict(fixed='/data/tof.nrrd', moving='t2.nrrd', output='out/b.tfm', truth='', warped='out/b.nrrd')]
+    path = tmp_path / 'jobs' / ('manifest' + ext)
+    path.parent.mkdir()
+    _write_manifest(path, entries)
+    jobs = batch.read_manifest(str(path))
+    # relative paths are resolved against the folder of the manifest, missing optional entries are None
+    root = str(tmp_path / 'jobs')
+    assert jobs == [dict(index=0, fixed=os.path.join(root, 'tof.nrrd'), moving=os.path.join(root, 'pd.nrrd'),
+                         output=os.path.join(root, 'out/a.tfm'), truth=os.path.join(root, 'truth.tfm'), warped=None),
+                    dict(index=1, fixed='/data/tof.nrrd', moving=os.path.join(root, 't2.nrrd'),
+                         output=os.path.join(root, 'out/b.tfm'), truth=None, warped=os.path.join(root, 'out/b.nrrd'))]
+
+
+def test_read_manifest_errors(tmp_path):
+    path = tmp_path / 'manifest.json'
+    _write_manifest(path, [dict(fixed='tof.nrrd', moving='pd.nrrd', output='a.tfm'), dict(fixed='tof.nrrd', moving='')])
+    with pytest.raises(RuntimeError, match="Manifest entry 1 is missing: moving, output"):
+        batch.read_manifest(str(path))
+    (tmp_path / 'manifest.txt').write_text('fixed,moving,output')
+    with pytest.raises(RuntimeError, match="Unsupported manifest format"):
+        batch.read_manifest(str(tmp_path / 'manifest.txt'))
+
+
+def test_run_job(tmp_path):
+    pytest.importorskip('open3d')
+    job = dict(index=0, fixed=os.path.join(_resource, 'IXI002-TOF.seg.nrrd'),
+               moving=os.path.join(_resource, 'IXI002-PD.seg.nrrd'), output=str(tmp_path / 'result.tfm'),
+               truth=os.path.join(_resource, 'IXI002-truth.tfm'), warped=str(tmp_path / 'warped.nrrd'))
+    res = batch.run_job(job, icp_steps=50, downsampling='poisson', symmetric=True, snapshot=True, use_cache=False)
+    assert all(res[k] >= 0 for k in ('t_read', 't_register', 't_write'))
+    # the method averages 1.7 mm and 0.7 degrees, see README.md
+    assert res['trans_err'] < 5.0 and res['rot_err'] < 5.0
+    assert not res['suspicious']
+
+    # the transform, its inverse, the quality record, the QC image and the warped image are written
+    assert sorted(os.listdir(tmp_path)) == ['result.inverse.tfm', 'result.qc.png', 'result.quality.json',
+                                            'result.tfm', 'warped.nrrd']
+    tf = sitk.ReadTransform(job['output'])
+    tf_inv = sitk.ReadTransform(str(tmp_path / 'result.inverse.tfm'))
+    assert np.allclose(tf_inv.TransformPoint(tf.TransformPoint((10.0, 20.0, 30.0))), (10.0, 20.0, 30.0), atol=1.0)
+    with open(tmp_path / 'result.quality.json') as f:
+        assert json.load(f)['consistency_error'] == res['consistency_error']
+    fixed, warped = sitk.ReadImage(job['fixed']), sitk.ReadImage(job['warped'])
+    assert warped.GetSize() == fixed.GetSize()
+    assert np.allclose(warped.GetOrigin(), fixed.GetOrigin())
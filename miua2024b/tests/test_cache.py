@@ -0,0 +1,115 @@
+import errno
+import os
+import stat
+
+import numpy as np
+import pytest
+
+from miua2024b.source import cache as cache_module
+from miua2024b.source.cache import PointCache, file_hash, make_key
+
+
+def _entry(seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).normal(size=(100, 3))
+
+
+def _set_used(cache: PointCache, key: str, t: int):
+    # the access times of the entries are set explicitly, as the file system's resolution may be coarse
+    os.utime(cache._path(key), ns=(t * 10**9, t * 10**9))
+
+
+def test_put_get(tmp_path):
+    cache = PointCache(str(tmp_path))
+    arr = _entry(0)
+    key = make_key('points', 1.0)
+    assert cache.get(key) is None
+    cache.put(key, arr)
+    res = cache.get(key)
+    assert np.array_equal(res, arr)
+    assert res.dtype == arr.dtype
+    # the temporary files of the atomic writes are replaced
+    assert os.listdir(tmp_path) == ['{}.npy'.format(key)]
+
+    # entries are copy-on-write, changing a loaded entry does not change the cache
+    res[:] = 0
+    assert np.array_equal(cache.get(key), arr)
+
+    assert np.array_equal(cache.cached(key, lambda: pytest.fail("cached entry was recomputed")), arr)
+    assert np.array_equal(cache.cached(make_key('points', 2.0), lambda: arr[:10]), arr[:10])
+
+
+def test_disabled(tmp_path):
+    cache = PointCache(str(tmp_path), enabled=False)
+    cache.put('a', _entry(0))
+    assert cache.get('a') is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_evict_least_recently_used(tmp_path):
+    # the entries are stored with a header of 128 bytes
+    size = _entry(0).nbytes + 128
+    cache = PointCache(str(tmp_path), max_size=2 * size)
+    for t, key in enumerate(['a', 'b']):
+        cache.put(key, _entry(t))
+        _set_used(cache, key, 1000 + t)
+    # reading a marks it as recently used, b is the least recently used entry
+    assert cache.get('a') is not None
+
+    cache.put('c', _entry(2))
+    assert cache.get('b') is None
+    assert np.array_equal(cache.get('a'), _entry(0))
+    assert np.array_equal(cache.get('c'), _entry(2))
+    assert sum(os.path.getsize(os.path.join(tmp_path, n)) for n in os.listdir(tmp_path)) <= cache.max_size
+
+
+def _read_only(*args, **kwargs):
+    raise OSError(errno.EROFS, "Read-only file system")
+
+
+def test_read_only(tmp_path, monkeypatch):
+    cache = PointCache(str(tmp_path))
+    cache.put('a', _entry(0))
+    # a read-only mount, which raises for any write, also as root
+    monkeypatch.setattr(cache_module.os, 'utime', _read_only)
+    monkeypatch.setattr(cache_module.tempfile, 'mkstemp', _read_only)
+    assert np.array_equal(cache.get('a'), _entry(0))
+    assert cache.get('b') is None
+
+    # misses are computed without storing them
+    assert np.array_equal(cache.cached('b', lambda: _entry(1)), _entry(1))
+    assert cache.get('b') is None
+    assert os.listdir(tmp_path) == ['a.npy']
+
+
+def test_read_only_folder(tmp_path):
+    cache = PointCache(str(tmp_path))
+    cache.put('a', _entry(0))
+    os.chmod(tmp_path, stat.S_IRUSR | stat.S_IXUSR)
+    try:
+        # root ignores the permissions, the write then succeeds
+        writable = os.access(str(tmp_path), os.W_OK)
+        assert np.array_equal(cache.get('a'), _entry(0))
+        assert np.array_equal(cache.cached('b', lambda: _entry(1)), _entry(1))
+        assert (cache.get('b') is not None) == writable
+    finally:
+        os.chmod(tmp_path, stat.S_IRWXU)
+
+
+def test_file_hash_invalidation(tmp_path):
+    path = str(tmp_path / 'seg.nrrd')
+    with open(path, 'wb') as f:
+        f.write(b'a' * 100)
+    h = file_hash(path)
+    assert file_hash(path) == h
+
+    # the memoized hash is invalidated by a change of the size
+    with open(path, 'wb') as f:
+        f.write(b'b' * 101)
+    h_size = file_hash(path)
+    assert h_size != h
+
+    # and of the modification time, e.g., for content of the same size
+    with open(path, 'wb') as f:
+        f.write(b'c' * 101)
+    os.utime(path, ns=(10**9, 10**9))
+    assert file_hash(path) not in (h, h_size)
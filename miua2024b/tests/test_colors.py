@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from miua2024b.source.colors import default_color, default_palette, palette_array, random_colors, to_color
+
+# the colors of the default names as converted by matplotlib
+_named = [(255, 0, 0), (0, 128, 0), (0, 0, 255), (255, 255, 0), (0, 255, 255), (255, 0, 255)]
+
+
+def _baseline_color(index: int) -> tuple:
+    """ the color of an index as drawn before the random colors were kept, i.e., from a new generator per index """
+    if index < len(_named):
+        return _named[index]
+    gen = random_colors()
+    for _ in range(index - len(_named)):
+        next(gen)
+    return next(gen)
+
+
+def test_default_color():
+    # drawn out of order, so that the kept random colors are reused and extended
+    indices = [20, 0, 7, 6, 33, 5, 12, 1, 40, 2, 3, 4]
+    for i in indices:
+        # named colors are lists and random colors are tuples, as before
+        assert tuple(default_color(i)) == _baseline_color(i)
+        assert tuple(to_color(i)) == _baseline_color(i)
+    assert list(tuple(c) for c in default_palette(50)) == list(_baseline_color(i) for i in range(50))
+    assert list(tuple(c) for c in default_palette(None)) == _named
+
+
+@pytest.mark.parametrize('name, rgb', [('Red', (255, 0, 0)), ('grey', (128, 128, 128)), ('orange', (255, 165, 0))])
+def test_to_color(name, rgb):
+    assert tuple(to_color(name)) == rgb
+    assert tuple(to_color(0.5)) == (127, 127, 127)
+    assert tuple(to_color((0, 64, 300))) == (0, 64, 255)
+    with pytest.raises(RuntimeError):
+        to_color((1, 2))
+
+
+def test_palette_array():
+    arr = palette_array(9)
+    assert arr.dtype == np.uint8 and arr.shape == (9, 3)
+    assert np.array_equal(arr, np.asarray(list(_baseline_color(i) for i in range(9))))
+    # the array is shared per size, so it cannot be written
+    assert palette_array(9) is arr
+    assert not arr.flags.writeable
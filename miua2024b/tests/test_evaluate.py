@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from miua2024b.source.evaluate import evaluate_pairs, find_pairs, summarize
+from miua2024b.source.main import read_segmentation
+from miua2024b.source.points import transform_points
+from miua2024b.source.transform import evaluate_transforms
+from miua2024b.source.util import get_center
+
+
+def _segmentation() -> sitk.Image:
+    arr = np.zeros((10, 12, 14), dtype=np.uint8)
+    arr[2:8, 3:6, 2:5] = 4
+    arr[3:6, 7:10, 8:12] = 5
+    arr[0, 0, :] = 1
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([0.8, 0.9, 1.2])
+    img.SetOrigin([-30.0, 12.0, 40.0])
+    return img
+
+
+def _euler(rng) -> sitk.Transform:
+    return sitk.Euler3DTransform(rng.uniform(-20.0, 20.0, size=3).tolist(), *rng.uniform(-0.2, 0.2, size=3).tolist(),
+                                 rng.uniform(-5.0, 5.0, size=3).tolist())
+
+
+def _displacement() -> sitk.Transform:
+    field = sitk.GetImageFromArray(np.random.default_rng(0).normal(size=(8, 8, 8, 3)), isVector=True)
+    field.SetOrigin([-40.0, 0.0, 30.0])
+    field.SetSpacing([8.0, 8.0, 8.0])
+    return sitk.DisplacementFieldTransform(sitk.Cast(field, sitk.sitkVectorFloat64))
+
+
+def _write(folder, names, ext='.tfm', seed=0):
+    folder.mkdir(exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for name in names:
+        sitk.WriteTransform(_euler(rng), str(folder / (name + ext)))
+
+
+def test_find_pairs(tmp_path):
+    _write(tmp_path / 'pred', ['a', 'b', 'c'])
+    _write(tmp_path / 'truth', ['a', 'b', 'd'])
+    (tmp_path / 'pred' / 'a.log').write_text('not a transform')
+    (tmp_path / 'seg').mkdir()
+    sitk.WriteImage(_segmentation(), str(tmp_path / 'seg' / 'a.nii.gz'))
+
+    pairs = find_pairs(str(tmp_path / 'pred'), str(tmp_path / 'truth'), fixed=str(tmp_path / 'seg'))
+    assert list(p['id'] for p in pairs) == ['a', 'b']
+    assert pairs[0]['truth'] == str(tmp_path / 'truth' / 'a.tfm')
+    # fixed segmentations are matched by name without extension
+    assert list(p['fixed'] for p in pairs) == [str(tmp_path / 'seg' / 'a.nii.gz'), None]
+
+    shared = str(tmp_path / 'seg' / 'a.nii.gz')
+    assert all(p['fixed'] == shared for p in find_pairs(str(tmp_path / 'pred'), str(tmp_path / 'truth'), shared))
+    assert all(p['fixed'] is None for p in find_pairs(str(tmp_path / 'pred'), str(tmp_path / 'truth')))
+
+
+def test_evaluate_pairs(tmp_path):
+    rng = np.random.default_rng(1)
+    fixed = str(tmp_path / 'fixed.nrrd')
+    sitk.WriteImage(_segmentation(), fixed)
+    tfs = dict(linear=(_euler(rng), _euler(rng)), displacement=(_displacement(), _euler(rng)))
+    pairs = list()
+    for name, (pred, truth) in tfs.items():
+        for k, tf in (('pred', pred), ('truth', truth)):
+            sitk.WriteTransform(tf, str(tmp_path / '{}_{}.hdf'.format(name, k)))
+        pairs.append(dict(id=name, pred=str(tmp_path / (name + '_pred.hdf')),
+                          truth=str(tmp_path / (name + '_truth.hdf')), fixed=fixed))
+    pairs.append(dict(pairs[0], id='missing', pred=str(tmp_path / 'missing.hdf')))
+    pairs.append(dict(pairs[0], id='corrupt', fixed=str(tmp_path / 'pred.txt')))
+    (tmp_path / 'pred.txt').write_text('not an image')
+
+    results = evaluate_pairs(pairs, n_points=50)
+    assert list(r['id'] for r in results) == ['linear', 'displacement', 'missing', 'corrupt']
+    assert list(r['status'] for r in results) == ['ok', 'ok', 'missing', 'error']
+    # a fixed segmentation which cannot be read only fails its pairs
+    assert results[3]['error']
+
+    img, points = read_segmentation(fixed)
+    points = points[np.sort(np.random.default_rng(0).choice(len(points), 50, replace=False))]
+    for res, (pred, truth) in zip(results, tfs.values()):
+        trans_err, rot_err = evaluate_transforms(pred, truth, get_center(img))
+        tre = np.linalg.norm(transform_points(points, pred) - transform_points(points, truth), axis=-1)
+        assert res['trans_err'] == pytest.approx(trans_err, abs=1e-6)
+        assert res['rot_err'] == pytest.approx(rot_err, abs=1e-4)
+        assert res['tre_mean'] == pytest.approx(tre.mean(), abs=1e-6)
+        assert res['tre_max'] == pytest.approx(tre.max(), abs=1e-6)
+
+
+def test_evaluate_pairs_without_fixed(tmp_path, capsys):
+    _write(tmp_path / 'pred', ['a'], seed=2)
+    _write(tmp_path / 'truth', ['a'], seed=3)
+    res = evaluate_pairs(find_pairs(str(tmp_path / 'pred'), str(tmp_path / 'truth')))[0]
+    # the errors are evaluated at the origin, which is reported
+    assert "1/1 pairs have no fixed segmentation" in capsys.readouterr().out
+    pred, truth = (sitk.ReadTransform(str(tmp_path / k / 'a.tfm')) for k in ('pred', 'truth'))
+    assert res['status'] == 'ok'
+    assert res['trans_err'] == pytest.approx(evaluate_transforms(pred, truth, (0.0, 0.0, 0.0))[0], abs=1e-6)
+    assert 'tre_mean' not in res
+
+
+def test_summarize():
+    results = [dict(status='ok', trans_err=1.0, rot_err=0.5, tre_mean=2.0),
+               dict(status='ok', trans_err=3.0, rot_err=1.5),
+               dict(status='error', trans_err=100.0),
+               dict(status='missing')]
+    rows = dict((r['metric'], r) for r in summarize(results))
+    # failed pairs and missing metrics are not counted
+    assert list(rows) == ['trans_err', 'rot_err', 'tre_mean']
+    assert rows['trans_err']['n'] == 2
+    assert rows['trans_err']['mean'] == pytest.approx(2.0)
+    assert rows['trans_err']['std'] == pytest.approx(1.0)
+    assert rows['trans_err']['max'] == 3.0
+    assert rows['tre_mean']['n'] == 1
+    assert summarize([dict(status='error')]) == []
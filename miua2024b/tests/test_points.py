@@ -0,0 +1,212 @@
+import functools
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from miua2024b.source import points as points_module
+from miua2024b.source.points import labels_to_points, mask_to_points, transform_points
+from miua2024b.source.roi import LabelProjections
+
+# maximum difference of the vectorized transformation to the SimpleITK reference, see transform_points
+_tolerance = 1e-9
+# maximum difference of float32 points to the float64 results, i.e., a few float32 ulps of coordinates below 100 mm
+_tolerance_float32 = 1e-4
+
+
+def _affine():
+    tf = sitk.AffineTransform(3)
+    tf.SetMatrix([1.1, 0.2, -0.1, 0.05, 0.9, 0.3, -0.2, 0.1, 1.05])
+    tf.SetTranslation([3.0, -7.5, 12.0])
+    tf.SetCenter([10.0, 20.0, -5.0])
+    return tf
+
+
+def _euler():
+    return sitk.Euler3DTransform([10.0, 20.0, -5.0], 0.1, -0.3, 0.25, [1.0, 2.0, -3.0])
+
+
+def _versor():
+    return sitk.VersorRigid3DTransform([0.1, -0.2, 0.05, np.sqrt(1 - 0.1**2 - 0.2**2 - 0.05**2)],
+                                       [-4.0, 0.5, 2.0], [5.0, 5.0, 5.0])
+
+
+def _displacement():
+    rng = np.random.default_rng(0)
+    field = sitk.GetImageFromArray(rng.normal(scale=2.0, size=(12, 11, 10, 3)), isVector=True)
+    field.SetOrigin([-40.0, -40.0, -40.0])
+    field.SetSpacing([8.0, 8.0, 8.0])
+    return sitk.DisplacementFieldTransform(sitk.Cast(field, sitk.sitkVectorFloat64))
+
+
+def _composite():
+    tf = sitk.CompositeTransform(3)
+    tf.AddTransform(_affine())
+    tf.AddTransform(_displacement())
+    tf.AddTransform(_euler())
+    return tf
+
+
+def _matrix():
+    m = np.eye(4)
+    m[:3, :3] = [[0.9, -0.1, 0.2], [0.15, 1.1, 0.0], [-0.05, 0.2, 0.95]]
+    m[:3, 3] = [5.0, -2.0, 7.5]
+    return m
+
+
+_transforms = dict(matrix=_matrix, euler=_euler, versor=_versor, affine=_affine, displacement=_displacement,
+                   composite=_composite)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('name', list(_transforms))
+def test_transform_points_matches_sitk(name, dtype):
+    tf = _transforms[name]()
+    points = np.random.default_rng(1).uniform(-30.0, 30.0, size=(2000, 3))
+    # a small chunk size covers the chunking of non-linear transforms
+    res = transform_points(points.astype(dtype), tf, chunk_size=300)
+    ref = transform_points(points.astype(dtype), tf, method='sitk')
+    assert res.shape == points.shape
+    # float32 points are transformed in float32, which only differs from the reference by its rounding
+    assert res.dtype == ref.dtype == dtype
+    assert np.abs(res - ref).max() <= (_tolerance if dtype == np.float64 else _tolerance_float32)
+    if dtype == np.float32:
+        assert np.abs(res - transform_points(points, tf, chunk_size=300)).max() <= _tolerance_float32
+
+
+def test_transform_points_dtype():
+    points = np.random.default_rng(3).integers(-30, 30, size=(100, 3))
+    # other types are transformed in float64
+    assert transform_points(points, _matrix()).dtype == np.float64
+    assert transform_points(points.tolist(), _euler()).dtype == np.float64
+    assert transform_points(points.astype(np.float32), _matrix().astype(np.float32)).dtype == np.float32
+    # a float64 matrix does not promote float32 points
+    assert transform_points(points.astype(np.float32), _matrix()).dtype == np.float32
+
+
+def test_labels_to_points_float_labels():
+    arr = np.zeros((6, 7, 8), dtype=np.int16)
+    arr[1:3, 2:5, 3:6] = 4
+    arr[4, 1, 1] = 2
+    ref = labels_to_points(sitk.GetImageFromArray(arr), dict(a=(4, ), b=(2, )))
+    res = labels_to_points(sitk.GetImageFromArray(arr.astype(np.float32)), dict(a=(4, ), b=(2, )))
+    assert all(np.array_equal(res[k], ref[k]) for k in ref)
+    projections = LabelProjections.compute(arr.astype(np.float64))
+    assert np.array_equal(projections.to_array(), LabelProjections.compute(arr).to_array())
+
+    arr = arr.astype(np.float32)
+    arr[0, 0, 0] = 0.5
+    with pytest.raises(RuntimeError):
+        labels_to_points(sitk.GetImageFromArray(arr), dict(a=(4, )))
+
+
+def _labels() -> sitk.Image:
+    rng = np.random.default_rng(2)
+    arr = rng.choice([0, 1, 4, 5], p=[0.7, 0.1, 0.1, 0.1], size=(13, 11, 9)).astype(np.uint8)
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([0.6, 0.9, 1.3])
+    img.SetOrigin([-12.0, 4.0, 30.0])
+    img.SetDirection(sitk.Euler3DTransform([0.0, 0.0, 0.0], 0.3, -0.2, 0.1).GetMatrix())
+    return img
+
+
+def _mask(img: sitk.Image, labels) -> sitk.Image:
+    arr = sitk.GetArrayViewFromImage(img)
+    mask = sitk.GetImageFromArray(np.asarray(labels(arr) if callable(labels) else np.isin(arr, labels), dtype=np.uint8))
+    mask.CopyInformation(img)
+    return mask
+
+
+def _sorted(points: np.ndarray) -> np.ndarray:
+    # the methods order the points differently
+    return points[np.lexsort(np.round(points, 6).T)]
+
+
+def _grid_reference(mask: sitk.Image, grid: float) -> np.ndarray:
+    """ centroids of the occupied grid cells, computed cell by cell in index space """
+    idx = np.argwhere(sitk.GetArrayViewFromImage(mask))[:, ::-1]
+    cell = np.maximum(np.floor(np.divide(grid, mask.GetSpacing())), 1)
+    keys = np.floor_divide(idx, cell)
+    centroids = list(idx[np.all(keys == k, axis=1)].mean(axis=0) for k in np.unique(keys, axis=0))
+    return np.asarray(list(mask.TransformContinuousIndexToPhysicalPoint(c.tolist()) for c in centroids))
+
+
+@pytest.mark.parametrize('slab_size', [1, 3, 16, 100])
+def test_mask_to_points_slab_matches_numpy(slab_size):
+    mask = _mask(_labels(), (4, 5))
+    ref = mask_to_points(mask, method='numpy')
+    res = mask_to_points(mask, method='slab', slab_size=slab_size)
+    assert res.shape == ref.shape
+    assert np.abs(_sorted(res) - _sorted(ref)).max() <= _tolerance
+
+
+@pytest.mark.parametrize('slab_size', [1, 4, 16])
+@pytest.mark.parametrize('grid', [0.5, 1.0, 2.7])
+def test_mask_to_points_grid_centroids(slab_size, grid):
+    mask = _mask(_labels(), (4, 5))
+    ref = _grid_reference(mask, grid)
+    res = mask_to_points(mask, method='slab', slab_size=slab_size, grid=grid)
+    assert res.shape == ref.shape
+    assert np.abs(_sorted(res) - _sorted(ref)).max() <= _tolerance
+
+
+@pytest.mark.parametrize('method, grid', [('numpy', None), ('sitk', None), ('slab', None), ('slab', 2.7)])
+def test_mask_to_points_float32(method, grid):
+    img = _labels()
+    mask = _mask(img, (4, 5))
+    ref = mask_to_points(mask, method=method, slab_size=4, grid=grid)
+    res = mask_to_points(mask, method=method, dtype=np.float32, slab_size=4, grid=grid)
+    assert res.dtype == np.float32
+    assert res.shape == ref.shape
+    assert np.abs(_sorted(res) - _sorted(ref)).max() <= _tolerance_float32
+    # the points stay float32 through the label groups and the transformation
+    groups = labels_to_points(img, dict(target=(4, 5)), dtype=np.float32, slab_size=4, grid=grid)
+    assert groups['target'].dtype == np.float32
+    for name in ('matrix', 'euler', 'displacement', 'composite'):
+        tf = _transforms[name]()
+        moved = transform_points(res, tf, chunk_size=50)
+        assert moved.dtype == np.float32
+        assert np.abs(moved - transform_points(ref, tf)).max() <= _tolerance_float32
+
+
+@pytest.mark.parametrize('grid', [None, 1.0, 2.7])
+def test_labels_to_points_grid(grid):
+    img = _labels()
+    # overlapping groups are subsampled separately
+    groups = dict(target=(4, 5), left=(4, ), other=lambda v: v != 1)
+    res = labels_to_points(img, groups, slab_size=5, grid=grid)
+    for name, labels in groups.items():
+        ref = mask_to_points(_mask(img, labels), method='slab', slab_size=5, grid=grid)
+        assert res[name].shape == ref.shape
+        assert np.abs(_sorted(res[name]) - _sorted(ref)).max() <= _tolerance
+
+
+def _sitk_mask(img: sitk.Image, labels) -> sitk.Image:
+    """ mask of a label group with the SimpleITK operators, the baseline of labels_to_points """
+    if callable(labels):
+        return labels(img)
+    return functools.reduce(sitk.Or, (img == int(v) for v in labels))
+
+
+# labels of the image per pixel type, the int32 labels span a range too large for a lookup table
+_label_values = dict(uint8=(0, 1, 4, 5), int16=(-3, 0, 4, 5), int32=(0, 4, 5, 2**30 + 7), float32=(0, 1, 4, 5))
+
+
+@pytest.mark.parametrize('pixel_type', list(_label_values))
+@pytest.mark.parametrize('lut', [True, False])
+def test_labels_to_points_matches_sitk_masks(monkeypatch, pixel_type, lut):
+    if not lut:
+        monkeypatch.setattr(points_module, '_lut_limit', 0)
+    values = _label_values[pixel_type]
+    arr = np.random.default_rng(3).choice(values, size=(11, 9, 13)).astype(pixel_type)
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([0.6, 0.9, 1.3])
+    img.SetOrigin([-12.0, 4.0, 30.0])
+    img.SetDirection(sitk.Euler3DTransform([0.0, 0.0, 0.0], 0.3, -0.2, 0.1).GetMatrix())
+    groups = dict(left=(values[2], ), target=values[2:], high=(values[3], 123), none=(2, ),
+                  tree=lambda v: v != values[1], foreground=lambda v: v > 0)
+    res = labels_to_points(img, groups, slab_size=4)
+    for name, labels in groups.items():
+        ref = mask_to_points(_sitk_mask(img, labels), method='sitk')
+        assert res[name].shape == ref.shape
+        assert np.abs(_sorted(res[name]) - _sorted(ref)).max(initial=0.0) <= _tolerance
@@ -0,0 +1,101 @@
+import faulthandler
+import os
+import time
+
+import pytest
+
+from miua2024b.source.pool import IsolatingPool
+
+
+def _task(key):
+    if key == 'crash':
+        os._exit(3)
+    # the other tasks are still running when a task crashes
+    time.sleep(60 if key == 'hang' else 0.2)
+    return key
+
+
+@pytest.fixture(autouse=True)
+def watchdog():
+    # a scheduling error would wait for the pool forever
+    faulthandler.dump_traceback_later(120, exit=True)
+    yield
+    faulthandler.cancel_dump_traceback_later()
+
+
+def _run(pool: IsolatingPool, keys: list) -> dict:
+    """ runs the tasks like batch.run_batch, returns the result or error per key and the keys which were rerun """
+    results, reruns = dict(), list()
+    pending = list(reversed(keys))
+    try:
+        while pending or pool.running:
+            while pending and pool.can_submit(pending[-1]):
+                key = pending.pop()
+                pool.submit(key, key, _task, key)
+            finished, rerun = pool.wait()
+            for key, _, res, err in finished:
+                results[key] = res if err is None else err
+            reruns.extend(key for key, _ in rerun)
+            pending.extend(key for key, _ in rerun)
+    finally:
+        pool.shutdown()
+    return dict(results=results, reruns=reruns)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_isolating_pool(workers):
+    keys = ['a', 'crash', 'b', 'c']
+    res = _run(IsolatingPool(workers), keys)
+    assert res['results'] == dict(a='a', b='b', c='c',
+                                  crash="BrokenProcessPool: the worker process died with exit code 3")
+    # the tasks in flight with the crash are rerun once, each of them alone
+    assert sorted(res['reruns']) == ([] if workers == 1 else ['a', 'b', 'crash'])
+
+
+def test_isolating_pool_isolated():
+    pool = IsolatingPool(2)
+    pool.isolated.add('b')
+    try:
+        assert pool.can_submit('a')
+        pool.submit('a', 'a', _task, 'a')
+        # isolated tasks only start in an idle pool and block other tasks while running
+        assert not pool.can_submit('b')
+        assert pool.wait()[0][0][2] == 'a'
+        assert pool.can_submit('b')
+        pool.submit('b', 'b', _task, 'b')
+        assert not pool.can_submit('c')
+    finally:
+        pool.shutdown()
+
+
+def test_isolating_pool_stop():
+    pool = IsolatingPool(2)
+    pool.submit('hang', 'hang', _task, 'hang')
+    assert pool.wait(timeout=0.5) == ([], [])
+    stopped = pool.stop()
+    assert list(task for task, _ in stopped) == ['hang']
+    assert not pool.running
+    # the pool is restarted by the next task
+    pool.submit('a', 'a', _task, 'a')
+    assert pool.wait()[0][0][2] == 'a'
+    pool.shutdown()
+
+
+def test_isolating_pool_broken_submit():
+    pool = IsolatingPool(2)
+    try:
+        pool.submit('crash', 'crash', _task, 'crash')
+        # the pool is broken before the next task is submitted, which is rerun with the task in flight
+        time.sleep(1.0)
+        pool.submit('a', 'a', _task, 'a')
+        finished, rerun = pool.wait()
+        assert finished == []
+        assert sorted(task for task, _ in rerun) == ['a', 'crash']
+        assert pool.isolated == {'a', 'crash'}
+        # the tasks are run alone afterwards, which finds the crash
+        pool.submit('crash', 'crash', _task, 'crash')
+        assert pool.wait()[0][0][3] == "BrokenProcessPool: the worker process died with exit code 3"
+        pool.submit('a', 'a', _task, 'a')
+        assert pool.wait()[0][0][2] == 'a'
+    finally:
+        pool.shutdown()
@@ -0,0 +1,160 @@
+import numpy as np
+import pytest
+
+from miua2024b.source import registration as registration_module
+from miua2024b.source.main import symmetric_paths
+from miua2024b.source.points import transform_points
+from miua2024b.source.registration import (is_suspicious, register_points_icp, register_points_ransac_multi,
+                                           register_points_symmetric)
+
+
+def _vessels(rng) -> np.ndarray:
+    """ points along a few curved tubes, which give distinctive FPFH features """
+    t = np.linspace(0.0, 1.0, 800)
+    tubes = [np.stack([40.0 * t, 10.0 * np.sin(6.0 * t), 5.0 * t ** 2], axis=-1),
+             np.stack([20.0 + 8.0 * np.cos(4.0 * t), 30.0 * t, 12.0 * t], axis=-1),
+             np.stack([5.0 * t, 15.0 - 20.0 * t, 25.0 * np.sin(3.0 * t)], axis=-1)]
+    points = np.concatenate(tubes)
+    return points + rng.normal(scale=0.3, size=points.shape)
+
+
+def _rigid(rng) -> np.ndarray:
+    angles = rng.uniform(-0.3, 0.3, size=3)
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+    tm = np.eye(4)
+    tm[:3, :3] = (np.asarray([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+                  @ np.asarray([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+                  @ np.asarray([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]))
+    tm[:3, 3] = rng.uniform(-5.0, 5.0, size=3)
+    return tm
+
+
+def _pair(seed: int=0):
+    rng = np.random.default_rng(seed)
+    fixed = _vessels(rng)
+    tm = _rigid(rng)
+    # the registration maps the moving to the fixed points
+    moving = (fixed - tm[:3, 3]) @ tm[:3, :3]
+    return moving, fixed
+
+
+def test_register_points_ransac_multi_deterministic():
+    pytest.importorskip('open3d')
+    moving, fixed = _pair()
+    kwargs = dict(spacing=2.0, seeds=(0, 1), scales=(1.0, 1.5), maxit=20000, return_info=True)
+    tm, info = register_points_ransac_multi(moving, fixed, workers=0, **kwargs)
+    assert info['hypotheses'] == 4
+    # the same seeds give the same result, sequentially, repeated and in worker processes
+    for workers in (0, 2):
+        tm_other, info_other = register_points_ransac_multi(moving, fixed, workers=workers, **kwargs)
+        assert np.array_equal(np.asarray(tm_other), np.asarray(tm))
+        assert info_other == info
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_register_points_ransac_multi_errors(workers):
+    pytest.importorskip('open3d')
+    moving, fixed = _pair()
+    # the error of the failed hypotheses is raised instead of a missing result
+    with pytest.raises(RuntimeError, match="Unsupported FPFH sampling method: unknown"):
+        register_points_ransac_multi(moving, fixed, spacing=2.0, seeds=(0, 1), workers=workers, maxit=1000,
+                                     fpfh_sampling='unknown')
+
+
+
+def _offset_pair():
+    """ point clouds with a small rigid offset within the capture range of ICP, and the transform which aligns them """
+    fixed = _vessels(np.random.default_rng(3))
+    tm = np.eye(4)
+    c, s = np.cos(0.05), np.sin(0.05)
+    tm[:3, :3] = [[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]]
+    tm[:3, 3] = [1.5, -1.0, 0.5]
+    return (fixed - tm[:3, 3]) @ tm[:3, :3], fixed, tm
+
+
+def test_register_points_icp_schedule():
+    pytest.importorskip('open3d')
+    moving, fixed, tm = _offset_pair()
+    kwargs = dict(t_bounds=(5.0, 0.5), t_steps=40, return_info=True)
+    # without a tolerance, all steps of the schedule are run
+    tm_full, info_full = register_points_icp(moving, fixed, **kwargs)
+    assert info_full['steps'] == 40
+    tm_adaptive, info = register_points_icp(moving, fixed, tol_transform=1e-3, **kwargs)
+    # the converged runs skip ahead in the schedule, which ends at the lower bound like the full schedule
+    assert 1 < info['steps'] < 40
+    for res in (tm_full, tm_adaptive):
+        assert np.abs(np.asarray(res) - tm).max() < 1e-2
+        assert np.abs(transform_points(moving, res) - fixed).max() < 0.1
+    assert info['fitness'] == pytest.approx(info_full['fitness'], abs=1e-3)
+    assert info['inlier_rmse'] == pytest.approx(info_full['inlier_rmse'], abs=1e-2)
+    assert register_points_icp(moving, fixed, t_bounds=(5.0, 0.5), t_steps=1, tol_transform=1e-3,
+                               return_info=True)[1]['steps'] == 1
+
+def _translation(offset) -> np.ndarray:
+    tm = np.eye(4)
+    tm[:3, 3] = offset
+    return tm
+
+
+@pytest.mark.parametrize('offset', [0.0, 2.5])
+def test_register_points_symmetric_consistency(monkeypatch, offset):
+    pytest.importorskip('open3d')
+    rng = np.random.default_rng(0)
+    fixed = _vessels(rng)
+    tm = _rigid(rng)
+    # the moving points are permuted and fewer than the fixed ones, the metric does not need correspondences
+    moving = transform_points(fixed[rng.permutation(len(fixed))[:1000]], np.linalg.inv(tm))
+    # the backward registration is off by a translation of offset mm
+    tm_inv = _translation([0.0, 0.0, offset]) @ np.linalg.inv(tm)
+
+    def _register(a, b, **kwargs):
+        forward = a is moving
+        return (tm if forward else tm_inv), dict(icp_steps=3, fitness=0.9 if forward else 0.8,
+                                                 inlier_rmse=0.1 if forward else 0.2)
+
+    monkeypatch.setattr(registration_module, 'register_points_affine', _register)
+    for parallel in (True, False):
+        tm_fwd, tm_bwd, quality = register_points_symmetric(moving, fixed, parallel=parallel)
+        assert np.array_equal(tm_fwd, tm) and np.array_equal(tm_bwd, tm_inv)
+        assert quality['fitness'] == 0.9 and quality['fitness_inverse'] == 0.8
+        assert quality['inlier_rmse'] == 0.1 and quality['inlier_rmse_inverse'] == 0.2
+        assert quality['icp_steps'] == 6
+        # as the transform is rigid, the round trip moves each point of both clouds by the offset
+        assert quality['consistency_error'] == pytest.approx(offset, abs=1e-9)
+        assert quality['consistency_max'] == pytest.approx(offset, abs=1e-9)
+
+
+def test_register_points_symmetric():
+    pytest.importorskip('open3d')
+    moving, fixed = _pair()
+    moving = moving[np.random.default_rng(1).permutation(len(moving))]
+    tm_fwd, tm_bwd, quality = register_points_symmetric(moving, fixed, spacing_search=2.0, spacing_refine=1.0,
+                                                        icp_steps=20, downsampling='poisson')
+    assert np.allclose(np.asarray(tm_fwd) @ np.asarray(tm_bwd), np.eye(4), atol=1e-2)
+    assert quality['consistency_error'] < 0.5
+    assert not is_suspicious(quality)
+
+
+def test_is_suspicious():
+    quality = dict(consistency_error=0.5, fitness=0.8, fitness_inverse=0.6)
+    assert not is_suspicious(quality)
+    # the thresholds are exclusive
+    assert not is_suspicious(quality, max_consistency=0.5, min_fitness=0.6)
+    assert is_suspicious(quality, max_consistency=0.4)
+    assert is_suspicious(dict(quality, consistency_error=1.01))
+    # a low fitness in either direction is suspicious
+    assert is_suspicious(quality, min_fitness=0.7)
+    assert is_suspicious(dict(quality, fitness=0.05))
+    assert is_suspicious(dict(quality, fitness_inverse=0.05))
+
+
+def test_symmetric_paths():
+    assert symmetric_paths('out/forward.hdf') == ('out/forward.inverse.hdf', 'out/forward.quality.json')
+    assert symmetric_paths('out/forward.tfm') == ('out/forward.inverse.tfm', 'out/forward.quality.json')
+    assert symmetric_paths('forward') == ('forward.inverse', 'forward.quality.json')
+    # explicit paths are kept
+    assert symmetric_paths('out/forward.hdf', 'inv.hdf', 'q.json') == ('inv.hdf', 'q.json')
+    assert symmetric_paths('out/forward.hdf', quality_path='q.json') == ('out/forward.inverse.hdf', 'q.json')
+    # the empty defaults of the command line options are not used as paths
+    assert symmetric_paths('out/forward.hdf', '', '') == ('out/forward.inverse.hdf', 'out/forward.quality.json')
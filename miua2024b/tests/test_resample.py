@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from miua2024b.source.resample import get_interpolator, resample_image
+from miua2024b.source.roi import LabelProjections
+
+
+def _rotation(angles) -> list:
+    return sitk.Euler3DTransform([0.0, 0.0, 0.0], *angles).GetMatrix()
+
+
+def _moving(vector=False) -> sitk.Image:
+    arr = np.zeros((18, 20, 22), dtype=np.int16)
+    arr[4:12, 5:15, 6:18] = 1
+    arr[7:10, 8:12, 3:9] = 2
+    arr[13:16, 2:6, 10:14] = 3
+    if vector:
+        img = sitk.GetImageFromArray(np.stack([arr, 2 * arr], axis=-1), isVector=True)
+    else:
+        img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([1.2, 0.9, 1.5])
+    img.SetOrigin([-10.0, 5.0, 3.0])
+    img.SetDirection(_rotation([0.1, -0.2, 0.3]))
+    return img
+
+
+def _reference() -> sitk.Image:
+    # a grid of a different size, spacing and orientation than the moving image
+    ref = sitk.Image([17, 19, 23], sitk.sitkUInt8)
+    ref.SetSpacing([1.0, 1.1, 0.8])
+    ref.SetOrigin([-12.0, 2.0, 0.0])
+    ref.SetDirection(_rotation([-0.15, 0.05, 0.2]))
+    return ref
+
+
+def _transform() -> sitk.Transform:
+    return sitk.Euler3DTransform([0.0, 10.0, 12.0], 0.05, 0.1, -0.08, [1.0, -0.5, 2.0])
+
+
+def _extent(moving: sitk.Image):
+    return LabelProjections.compute(sitk.GetArrayViewFromImage(moving)).bounds(lambda v: v != 0)
+
+
+def _resample(moving, reference, tf, interpolator=None) -> sitk.Image:
+    # by default nearest neighbour for label maps and linear for the vector images
+    return sitk.Resample(moving, reference, tf, get_interpolator(moving, interpolator), 0.0, moving.GetPixelID())
+
+
+def _assert_same_image(res: sitk.Image, ref: sitk.Image):
+    assert res.GetSize() == ref.GetSize()
+    assert res.GetPixelID() == ref.GetPixelID()
+    assert np.allclose(res.GetOrigin(), ref.GetOrigin(), atol=1e-9)
+    assert np.allclose(res.GetSpacing(), ref.GetSpacing(), atol=1e-9)
+    assert np.allclose(res.GetDirection(), ref.GetDirection(), atol=1e-9)
+    assert np.array_equal(sitk.GetArrayFromImage(res), sitk.GetArrayFromImage(ref))
+
+
+@pytest.mark.parametrize('slab_size', [1, 5, 32])
+@pytest.mark.parametrize('bounded', [False, True])
+@pytest.mark.parametrize('interpolator', [None, 'linear'])
+def test_resample_slabs_match_sitk(slab_size, bounded, interpolator):
+    moving, reference, tf = _moving(), _reference(), _transform()
+    extent = _extent(moving) if bounded else None
+    res = resample_image(moving, reference, tf, interpolator=interpolator, slab_size=slab_size, extent=extent)
+    _assert_same_image(res, _resample(moving, reference, tf, interpolator))
+
+
+@pytest.mark.parametrize('vector', [False, True])
+@pytest.mark.parametrize('bounded', [False, True])
+def test_resample_nrrd_matches_sitk(tmp_path, vector, bounded):
+    moving, reference, tf = _moving(vector), _reference(), _transform()
+    extent = _extent(_moving()) if bounded else None
+    path = str(tmp_path / 'streamed.nrrd')
+    assert resample_image(moving, reference, tf, output_path=path, slab_size=4, extent=extent) is None
+
+    ref_path = str(tmp_path / 'reference.nrrd')
+    sitk.WriteImage(_resample(moving, reference, tf), ref_path)
+    res = sitk.ReadImage(path)
+    _assert_same_image(res, sitk.ReadImage(ref_path))
+    assert res.GetNumberOfComponentsPerPixel() == moving.GetNumberOfComponentsPerPixel()
+
+    with open(path, 'rb') as f:
+        header = f.read(1024).split(b'\n\n')[0].decode('ascii').splitlines()
+    assert 'space: left-posterior-superior' in header
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from miua2024b.source.cache import PointCache
+from miua2024b.source.roi import crop_to_labels, label_extent, label_projections
+from miua2024b.source.volume import Volume
+
+
+def _labels() -> sitk.Image:
+    # an anisotropic (z, y, x) shape, so that a flip of the axes changes the box
+    arr = np.zeros((9, 12, 15), dtype=np.uint8)
+    arr[2:5, 3:8, 4:13] = 1
+    arr[6, 10, 1] = 2
+    arr[1:3, 0:2, 11:15] = 3
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([0.7, 1.1, 1.6])
+    img.SetOrigin([-20.0, 8.0, 4.5])
+    img.SetDirection(sitk.Euler3DTransform([0.0, 0.0, 0.0], 0.2, -0.1, 0.3).GetMatrix())
+    return img
+
+
+def _reference_box(img: sitk.Image, labels, margin: int=0):
+    """ bounding box (index and size in x, y, z order) of the labels from the voxel coordinates """
+    idx = np.argwhere(np.isin(sitk.GetArrayViewFromImage(img), labels))[:, ::-1]
+    lower = np.maximum(idx.min(axis=0) - margin, 0)
+    upper = np.minimum(idx.max(axis=0) + margin + 1, img.GetSize())
+    return lower.tolist(), (upper - lower).tolist()
+
+
+def _assert_same_image(res: sitk.Image, ref: sitk.Image):
+    assert res.GetSize() == ref.GetSize()
+    assert np.allclose(res.GetOrigin(), ref.GetOrigin(), atol=1e-9)
+    assert np.allclose(res.GetSpacing(), ref.GetSpacing(), atol=1e-9)
+    assert np.allclose(res.GetDirection(), ref.GetDirection(), atol=1e-9)
+    assert np.array_equal(sitk.GetArrayFromImage(res), sitk.GetArrayFromImage(ref))
+
+
+@pytest.mark.parametrize('labels', [(1, ), (2, ), (3, ), (1, 2), (1, 2, 3)])
+@pytest.mark.parametrize('margin', [0, 2])
+def test_crop_to_labels_matches_sitk(labels, margin):
+    img = _labels()
+    index, size = _reference_box(img, labels, margin)
+    cropped = crop_to_labels(Volume.from_image(img), labels, margin=margin)
+    assert list(cropped.GetSize()) == size
+    # the crop keeps the physical space of the image
+    assert np.allclose(cropped.GetOrigin(), img.TransformIndexToPhysicalPoint(index), atol=1e-9)
+    _assert_same_image(cropped.to_image(), sitk.RegionOfInterest(img, size, index))
+
+
+def test_crop_to_labels_empty():
+    volume = Volume.from_image(_labels())
+    assert crop_to_labels(volume, (4, )) is None
+    assert crop_to_labels(volume, lambda v: v > 3) is None
+
+
+def test_label_extent():
+    img = _labels()
+    assert label_extent(Volume.from_image(img)) == _reference_box(img, (1, 2, 3))
+    empty = sitk.Image(img.GetSize(), sitk.sitkUInt8)
+    assert label_extent(Volume.from_image(empty)) == ([0, 0, 0], [0, 0, 0])
+
+
+def test_label_projections_cached(tmp_path):
+    img = _labels()
+    cache = PointCache(str(tmp_path))
+    ref = label_projections(Volume.from_image(img), cache=cache, key='labels')
+    # the second volume reads the projections from the cache
+    res = label_projections(Volume.from_image(img), cache=cache, key='labels')
+    assert np.array_equal(res.to_array(), ref.to_array())
+    for labels in [(1, ), (2, 3)]:
+        assert res.bounds(labels, margin=1) == _reference_box(img, labels, margin=1)
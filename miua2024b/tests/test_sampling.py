@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from miua2024b.source.sampling import PointSampler, _Grid
+
+
+def _points(dtype=np.float64):
+    rng = np.random.default_rng(2)
+    # a dense blob and a sparse shell, so that cells with many and with single candidates are covered
+    blob = rng.normal(scale=4.0, size=(1500, 3))
+    shell = rng.normal(size=(500, 3))
+    shell = 20.0 * shell / np.linalg.norm(shell, axis=-1, keepdims=True)
+    return np.concatenate([blob, shell]).astype(dtype)
+
+
+def _distances(a, b):
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return np.linalg.norm(a[:, None] - b[None], axis=-1)
+
+
+@pytest.mark.parametrize('dense', [True, False])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('radius', [0.5, 1.0, 2.5])
+def test_poisson_disk(monkeypatch, dense, dtype, radius):
+    if not dense:
+        monkeypatch.setattr(_Grid, 'dense_limit', 0)
+    # a small chunk size covers sampling the cells of a phase in several chunks
+    monkeypatch.setattr(PointSampler, 'chunk_size', 64)
+    points = _points(dtype)
+    idx = PointSampler(points).poisson(radius)
+    assert len(idx) > 0
+    assert np.array_equal(idx, np.unique(idx))
+
+    samples = points[idx]
+    d = _distances(samples, samples)
+    np.fill_diagonal(d, np.inf)
+    # no pair of samples is closer than the radius, up to the precision of the points
+    assert d.min() >= radius * (1 - 1e-6)
+    # maximal: every point lies within the radius of a sample, so that no further point can be added
+    assert _distances(points, samples).min(axis=1).max() < radius
+
+
+def test_poisson_disk_deterministic():
+    points = _points()
+    ref = PointSampler(points).poisson(1.0)
+    sampler = PointSampler(points)
+    sampler.voxel(1.0)
+    assert np.array_equal(sampler.poisson(1.0), ref)
+    assert np.array_equal(sampler.poisson(1.0), ref)
+
+
+def test_poisson_disk_empty():
+    assert len(PointSampler(np.empty((0, 3))).poisson(1.0)) == 0
+
+
+def _assert_voxel_sampling(points, idx, size, tol):
+    """ checks for a single point per occupied voxel, which is (one of) the closest to the centroid of the voxel """
+    points = np.asarray(points, dtype=np.float64)
+    keys = np.floor((points - points.min(axis=0)) / size).astype(np.int64)
+    occupied, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    assert np.array_equal(np.sort(inverse[idx]), np.arange(len(occupied)))
+    for i in idx:
+        members = points[inverse == inverse[i]]
+        d = np.linalg.norm(members - members.mean(axis=0), axis=-1)
+        # points at equal distance are selected by their order within the voxel, see _Grid
+        assert np.linalg.norm(points[i] - members.mean(axis=0)) <= d.min() + tol
+
+
+@pytest.mark.parametrize('dense', [True, False])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('size', [0.5, 1.0, 2.5])
+def test_voxel(monkeypatch, dense, dtype, size):
+    if not dense:
+        monkeypatch.setattr(_Grid, 'dense_limit', 0)
+    points = _points(dtype)
+    idx = PointSampler(points).voxel(size)
+    assert np.array_equal(idx, np.unique(idx))
+    # the distances of float32 points are computed in float32
+    _assert_voxel_sampling(points, idx, size, tol=1e-9 if dtype == np.float64 else 1e-5)
+
+
+def test_voxel_empty():
+    assert len(PointSampler(np.empty((0, 3))).voxel(1.0)) == 0
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from miua2024b.source.colors import palette_array
+from miua2024b.source.snapshot import cubic_bounds, project_points, render_projections, write_snapshot
+
+
+
+def _cloud(rng, n=500, center=(0.0, 0.0, 0.0)) -> np.ndarray:
+    return rng.normal(scale=(8.0, 5.0, 3.0), size=(n, 3)) + center
+
+
+def _project_reference(points, view, lower, pixel, size) -> np.ndarray:
+    """ counts the points per pixel one at a time """
+    rows, cols = dict(axial=(1, 0), coronal=(2, 0), sagittal=(2, 1))[view]
+    res = np.zeros((size, size), dtype=np.int64)
+    for p in points:
+        r, c = (min(max(int(np.floor((p[a] - lower[a]) / pixel)), 0), size - 1) for a in (rows, cols))
+        # superior is up
+        res[size - 1 - r if rows == 2 else r, c] += 1
+    return res
+
+
+@pytest.mark.parametrize('view', ['axial', 'coronal', 'sagittal'])
+def test_project_points(view):
+    rng = np.random.default_rng(0)
+    # some points lie outside of the region, which are counted at its border
+    points = _cloud(rng, n=300) * 1.5
+    lower, pixel, size = np.asarray([-20.0, -15.0, -10.0]), 1.3, 24
+    res = project_points(points, view, lower, pixel, size)
+    assert res.shape == (size, size)
+    assert res.sum() == len(points)
+    assert np.array_equal(res, _project_reference(points, view, lower, pixel, size))
+
+
+def test_project_points_orientation():
+    lower = np.zeros(3)
+    point = np.asarray([[1.5, 4.5, 7.5]])
+    assert np.argwhere(project_points(point, 'axial', lower, 1.0, 10)).tolist() == [[4, 1]]
+    # rows along z are flipped
+    assert np.argwhere(project_points(point, 'coronal', lower, 1.0, 10)).tolist() == [[2, 1]]
+    assert np.argwhere(project_points(point, 'sagittal', lower, 1.0, 10)).tolist() == [[2, 4]]
+
+
+def test_cubic_bounds():
+    clouds = [np.asarray([[0.0, 0.0, 0.0], [10.0, 2.0, 4.0]]), np.asarray([[-2.0, 6.0, 1.0]]), np.zeros((0, 3))]
+    lower, extent = cubic_bounds(clouds, margin=1.0)
+    assert extent == pytest.approx(14.0)
+    # the cube is centred on the box
+    assert np.allclose(lower + extent / 2, [4.0, 3.0, 2.0])
+    assert cubic_bounds([np.zeros((0, 3))]) == (pytest.approx(np.zeros(3)), 1.0)
+
+
+def test_render_projections():
+    rng = np.random.default_rng(1)
+    clouds = [_cloud(rng), _cloud(rng, center=(30.0, 0.0, 0.0)), np.zeros((0, 3))]
+    size, gap = 32, 3
+    img = render_projections(clouds, size=size, gap=gap)
+    assert img.dtype == np.uint8 and img.shape == (size, 3 * size + 2 * gap, 3)
+    assert not img[:, size:size + gap].any()
+
+    lower, extent = cubic_bounds(clouds)
+    palette = palette_array(3)
+    for v, view in enumerate(('axial', 'coronal', 'sagittal')):
+        panel = img[:, v * (size + gap):v * (size + gap) + size]
+        expected = np.zeros_like(panel)
+        for points, rgb in zip(clouds[:2], palette):
+            density = project_points(points, view, lower, extent / size, size)
+            # the densest pixel has (at least) the full color of its cloud
+            assert np.all(panel.reshape(-1, 3)[np.argmax(density)] >= rgb)
+            brightness = np.log1p(density) / np.log1p(density.max())
+            expected = np.maximum(expected, (brightness[..., None] * rgb).astype(np.uint8))
+        assert np.array_equal(panel, expected)
+
+    # the clouds mix by their maximum per channel, e.g. red and cyan to white
+    same = render_projections([clouds[0], clouds[0]], palette=np.asarray([(255, 0, 0), (0, 255, 255)]), size=size)
+    assert np.all(same[..., 0] == same[..., 1])
+    assert np.all(same[..., 1] == same[..., 2])
+    assert not render_projections([np.zeros((0, 3))], size=size).any()
+
+
+def _read_png(path) -> np.ndarray:
+    return sitk.GetArrayFromImage(sitk.ReadImage(path))
+
+
+def test_write_snapshot(tmp_path):
+    rng = np.random.default_rng(2)
+    target = _cloud(rng, n=2000)
+    tm = np.eye(4)
+    tm[:3, 3] = [6.0, -4.0, 2.0]
+    # the transform maps the source onto the target
+    source = target - tm[:3, 3]
+    size = 48
+    path = str(tmp_path / 'qc.png')
+    write_snapshot(path, source=source, target=target, tf=tm, size=size)
+    img = _read_png(path)
+    assert img.shape == (2 * size + 2, 3 * size + 4, 3)
+    before, after = img[:size], img[size + 2:]
+
+    # the source is red and the target cyan, which only overlap after the registration
+    lower, extent = cubic_bounds([source, target, target])
+    for v, view in enumerate(('axial', 'coronal', 'sagittal')):
+        panel = before[:, v * (size + 2):v * (size + 2) + size]
+        for points, channels in ((source, [0]), (target, [1, 2])):
+            density = project_points(points, view, lower, extent / size, size)
+            assert np.array_equal(panel[..., channels].any(axis=-1), density > 0)
+    assert np.all(after[..., 0] == after[..., 1])
+    assert np.all(after[..., 1] == after[..., 2])
+
+    # the larger clouds are subsampled, which keeps the region
+    write_snapshot(path, source=source, target=target, tf=tm, size=size, max_points=500)
+    assert _read_png(path).shape == img.shape
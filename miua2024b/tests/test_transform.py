@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from miua2024b.source.transform import evaluate_affines, evaluate_transforms
+from miua2024b.source.util import affine_from_transform
+
+
+def _random_affine(rng):
+    tf = sitk.AffineTransform(3)
+    tf.SetMatrix((np.eye(3) + rng.normal(scale=0.1, size=(3, 3))).flatten().tolist())
+    tf.SetTranslation(rng.uniform(-10.0, 10.0, size=3).tolist())
+    tf.SetCenter(rng.uniform(-50.0, 50.0, size=3).tolist())
+    return tf
+
+
+def _random_euler(rng):
+    return sitk.Euler3DTransform(rng.uniform(-50.0, 50.0, size=3).tolist(), *rng.uniform(-0.5, 0.5, size=3).tolist(),
+                                 rng.uniform(-10.0, 10.0, size=3).tolist())
+
+
+_transforms = dict(affine=_random_affine, euler=_random_euler)
+
+
+@pytest.mark.parametrize('pred_type', list(_transforms))
+@pytest.mark.parametrize('truth_type', list(_transforms))
+@pytest.mark.parametrize('shared_refs', [True, False])
+def test_evaluate_affines_matches_evaluate_transforms(pred_type, truth_type, shared_refs):
+    rng = np.random.default_rng(3)
+    n, m = 5, 4
+    preds = list(_transforms[pred_type](rng) for _ in range(n))
+    truths = list(_transforms[truth_type](rng) for _ in range(n))
+    refs = rng.uniform(-100.0, 100.0, size=(m, 3) if shared_refs else (n, m, 3))
+
+    n_diff, r_diff = evaluate_affines(list(map(affine_from_transform, preds)),
+                                      list(map(affine_from_transform, truths)), refs)
+    assert n_diff.shape == (n, m)
+    assert r_diff.shape == (n, )
+    for i, (pred, truth) in enumerate(zip(preds, truths)):
+        for j in range(m):
+            ref = tuple(refs[j] if shared_refs else refs[i, j])
+            n_ref, r_ref = evaluate_transforms(pred, truth, ref)
+            assert n_diff[i, j] == pytest.approx(n_ref, abs=1e-9)
+            assert r_diff[i] == pytest.approx(r_ref, abs=1e-6)
+
+
+def test_evaluate_affines_identical():
+    rng = np.random.default_rng(4)
+    tms = list(affine_from_transform(_random_affine(rng)) for _ in range(3))
+    n_diff, r_diff = evaluate_affines(tms, tms, rng.uniform(-100.0, 100.0, size=(2, 3)))
+    assert np.all(n_diff == 0.0)
+    # arccos is ill-conditioned at 1, the rounding of the unit vectors amounts to ~1e-6 degrees
+    assert np.all(r_diff < 1e-5)
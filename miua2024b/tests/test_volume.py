@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from miua2024b.source.cache import PointCache
+from miua2024b.source.profiling import profile
+from miua2024b.source.volume import Volume, as_volume, load_volume, read_volume, save_volume
+
+
+def _image(dtype=np.int16, vector=False) -> sitk.Image:
+    arr = np.random.default_rng(0).integers(0, 100, size=(7, 9, 11) + ((2, ) if vector else ())).astype(dtype)
+    img = sitk.GetImageFromArray(arr, isVector=vector)
+    img.SetSpacing([0.7, 1.1, 1.6])
+    img.SetOrigin([-20.0, 8.0, 4.5])
+    img.SetDirection(sitk.Euler3DTransform([0.0, 0.0, 0.0], 0.2, -0.1, 0.3).GetMatrix())
+    return img
+
+
+def _assert_same_image(res: sitk.Image, ref: sitk.Image):
+    assert res.GetSize() == ref.GetSize()
+    assert res.GetPixelID() == ref.GetPixelID()
+    assert np.allclose(res.GetOrigin(), ref.GetOrigin(), atol=1e-9)
+    assert np.allclose(res.GetSpacing(), ref.GetSpacing(), atol=1e-9)
+    assert np.allclose(res.GetDirection(), ref.GetDirection(), atol=1e-9)
+    assert np.array_equal(sitk.GetArrayFromImage(res), sitk.GetArrayFromImage(ref))
+
+
+def _conversions(prof) -> int:
+    return sum(e['name'] == 'convert_volume' for e in prof.events)
+
+
+@pytest.mark.parametrize('vector', [False, True])
+def test_save_load_volume(tmp_path, vector):
+    img = _image(vector=vector)
+    path = str(tmp_path / 'img.npy')
+    save_volume(img, path)
+    assert sorted(os.listdir(tmp_path)) == ['img.json', 'img.npy']
+
+    volume = load_volume(path)
+    # the voxels are memory-mapped instead of read
+    assert isinstance(volume.array, np.memmap)
+    _assert_same_image(volume.to_image(), img)
+    # the volume is written like an image
+    save_volume(volume, str(tmp_path / 'copy.npy'))
+    _assert_same_image(load_volume(str(tmp_path / 'copy.npy')).to_image(), img)
+
+    with pytest.raises(RuntimeError):
+        save_volume(img, str(tmp_path / 'img.nrrd'))
+
+
+def test_read_volume(tmp_path):
+    img = _image()
+    path = str(tmp_path / 'img.nrrd')
+    sitk.WriteImage(img, path)
+    save_volume(img, str(tmp_path / 'img.npy'))
+    assert isinstance(read_volume(str(tmp_path / 'img.npy')), Volume)
+    _assert_same_image(read_volume(path), img)
+    _assert_same_image(read_volume(path, PointCache(str(tmp_path / 'cache'), enabled=False)), img)
+
+    cache = PointCache(str(tmp_path / 'cache'))
+    with profile() as prof:
+        first = read_volume(path, cache)
+    assert _conversions(prof) == 1
+    _assert_same_image(first.to_image(), img)
+
+    # the converted volume is memory-mapped from the cache afterwards
+    with profile() as prof:
+        second = read_volume(path, cache)
+    assert _conversions(prof) == 0
+    assert isinstance(second.array, np.memmap)
+    _assert_same_image(second.to_image(), img)
+
+    # a changed image is converted again
+    changed = _image(dtype=np.uint8)
+    sitk.WriteImage(changed, path)
+    os.utime(path, ns=(10**9, 10**9))
+    with profile() as prof:
+        third = read_volume(path, cache)
+    assert _conversions(prof) == 1
+    _assert_same_image(third.to_image(), changed)
+
+
+@pytest.mark.parametrize('index, size', [((0, 0, 0), (11, 9, 7)), ((2, 3, 1), (5, 4, 3)), ((10, 8, 6), (1, 1, 1))])
+def test_volume_crop(index, size):
+    img = _image()
+    ref = sitk.RegionOfInterest(img, size, index)
+    volume = as_volume(img)
+    _assert_same_image(volume.to_image(index, size), ref)
+    cropped = volume.crop(index, size)
+    assert cropped.GetSize() == tuple(size)
+    _assert_same_image(cropped.to_image(), ref)
+    # the crop is a view of the volume
+    assert np.shares_memory(cropped.array, volume.array)
+
+
+def test_volume_geometry():
+    img = _image()
+    volume = Volume.from_image(img)
+    for idx in ([0, 0, 0], [3, 5, 2], [10, 8, 6]):
+        assert np.allclose(volume.TransformIndexToPhysicalPoint(idx), img.TransformIndexToPhysicalPoint(idx),
+                           atol=1e-9)
+    for point in ([-20.0, 8.0, 4.5], [-15.3, 12.1, 9.9]):
+        assert np.allclose(volume.TransformPhysicalPointToContinuousIndex(point),
+                           img.TransformPhysicalPointToContinuousIndex(point), atol=1e-9)
+    assert volume.GetSize() == img.GetSize()
+    assert (volume.GetWidth(), volume.GetHeight(), volume.GetDepth()) == img.GetSize()
+    assert np.array_equal(volume.geometry(), np.concatenate([img.GetOrigin(), img.GetSpacing(), img.GetDirection()]))
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int16, np.uint16, np.int32, np.float32, np.float64])
+@pytest.mark.parametrize('vector', [False, True])
+def test_volume_pixel_id(dtype, vector):
+    img = _image(dtype, vector)
+    volume = as_volume(img)
+    assert volume.GetPixelID() == img.GetPixelID()
+    assert volume.GetNumberOfComponentsPerPixel() == img.GetNumberOfComponentsPerPixel()
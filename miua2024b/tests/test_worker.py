@@ -0,0 +1,67 @@
+import io
+import json
+import os
+import tempfile
+import threading
+
+from miua2024b.source import worker
+
+
+def _serve(*lines, params=None) -> list:
+    stream_out = io.StringIO()
+    worker.serve_stream(dict() if params is None else params, io.StringIO(''.join(l + '\n' for l in lines)),
+                        stream_out)
+    return list(json.loads(l) for l in stream_out.getvalue().splitlines())
+
+
+def test_serve_stream():
+    responses = _serve(json.dumps(dict(id=1, command='ping')),
+                       '',
+                       '{"id": 2, "command"',
+                       '[1]',
+                       '3',
+                       json.dumps(dict(id=3, fixed='fixed.nrrd', moving='moving.nrrd')),
+                       json.dumps(dict(id=4, fixed='fixed.nrrd', moving='moving.nrrd', output='out.tfm',
+                                       params=dict(icp_stpes=10))),
+                       json.dumps(dict(id=5, command='unknown')),
+                       json.dumps(dict(id=6, command='ping')),
+                       json.dumps(dict(id=7, command='shutdown')),
+                       json.dumps(dict(id=8, command='ping')))
+
+    # a response per non-empty line up to the shutdown, in order
+    assert list(r['id'] for r in responses) == [1, None, None, None, 3, 4, 5, 6, 7]
+    assert list(r['status'] for r in responses) == ['ok'] + ['error'] * 6 + ['ok'] * 2
+    assert responses[0]['pid'] == os.getpid()
+    assert responses[1]['error'].startswith("Invalid request: ")
+    assert responses[2]['error'] == "Invalid request: expected a JSON object, got list"
+    assert responses[3]['error'] == "Invalid request: expected a JSON object, got int"
+    assert responses[4]['error'] == "Request is missing: output"
+    assert responses[5]['error'] == "Unknown parameters: icp_stpes"
+    assert responses[6]['error'] == "Unknown command: unknown"
+
+
+def test_serve_stream_default_params():
+    # the parameters of the worker are checked like the parameters of a request
+    responses = _serve(json.dumps(dict(id=1, fixed='fixed.nrrd', moving='moving.nrrd', output='out.tfm')),
+                       params=dict(serach_mm=1.0))
+    assert responses[0]['error'] == "Unknown parameters: serach_mm"
+
+
+def test_serve_socket():
+    with tempfile.TemporaryDirectory() as folder:
+        # the path of a UNIX socket is limited to ~100 characters
+        path = os.path.join(folder, 'worker.sock')
+        thread = threading.Thread(target=worker.serve_socket, args=(path, dict()), daemon=True)
+        thread.start()
+        for _ in range(500):
+            if os.path.exists(path):
+                break
+            thread.join(0.01)
+
+        responses = worker.submit(path, [dict(id=1, command='ping'), [1], dict(id=2, command='ping')], timeout=10)
+        assert list(r['status'] for r in responses) == ['ok', 'error', 'ok']
+        # requests of several connections are served by the same worker
+        assert worker.submit(path, [dict(command='shutdown')], timeout=10)[0]['status'] == 'ok'
+        thread.join(10)
+        assert not thread.is_alive()
+        assert not os.path.exists(path)